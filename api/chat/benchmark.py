@@ -0,0 +1,1675 @@
+"""
+チャットAPIのオフライン検証・ベンチマークスクリプト
+
+OpenAI / Supabase の代わりに遅延を設定できるローカルのスタブを
+ChatbotSingleton に差し込み、ASGI経由で /api/chat を呼び出す。
+APIキーやネットワーク接続は不要。
+
+使い方（api/chat ディレクトリで実行）:
+    python benchmark.py concurrency --requests 20 --latency 0.2
+    python benchmark.py parity --stub   # --stub なしでは実DBの RPC と比較する
+    python benchmark.py recall --rows 20000 --queries 100
+    python benchmark.py load --requests 500 --concurrency 20 --output baseline.json
+    python benchmark.py load --baseline baseline.json   # 悪化していれば終了コード1
+    python benchmark.py startup --runs 5
+    python benchmark.py entrypoint   # Vercel と同じ読み込み方で index を import できるか
+    python benchmark.py price   # 価格条件・並び順・件数の判定を表のケースで確認する
+    python benchmark.py workers --workers 4 --docs 2000   # Linux のみ
+    python benchmark.py hybrid --stub   # --stub なしでは実DBと埋め込みAPIで比較する
+    python benchmark.py ingest --embedding-latency 0.1
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+import httpx
+import numpy as np
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+import index
+import indexes
+import ingest
+
+EMBEDDING_DIMENSION = 1536
+
+# スタブの遅延のばらつき（latency × (1 ± jitter) の一様分布）
+_latency_jitter = 0.0
+_latency_random = random.Random(0)
+
+
+def stub_delay(latency: float) -> float:
+    if not _latency_jitter:
+        return latency
+    return latency * (1 + _latency_random.uniform(-_latency_jitter, _latency_jitter))
+
+
+# 上流（llm / embedding / supabase）ごとの実行中のスタブ呼び出し数と、その最大値
+_in_flight = {}
+peak_in_flight = {}
+
+
+async def stub_sleep(upstream: str, latency: float):
+    """上流の呼び出しを模して待つ。同時に待っている数の最大値を記録する"""
+    _in_flight[upstream] = _in_flight.get(upstream, 0) + 1
+    peak_in_flight[upstream] = max(
+        peak_in_flight.get(upstream, 0), _in_flight[upstream]
+    )
+    try:
+        await asyncio.sleep(stub_delay(latency))
+    finally:
+        _in_flight[upstream] -= 1
+
+
+def _stub_vector(text: str) -> list:
+    """テキストから決まる固定の埋め込みベクトル"""
+    seed = sum(map(ord, text)) % 97 + 1
+    return [((seed * (i + 1)) % 101) / 101 for i in range(EMBEDDING_DIMENSION)]
+
+
+def _pgvector(text: str) -> str:
+    """PostgREST が返す pgvector 列と同じ文字列形式にする"""
+    return json.dumps(_stub_vector(text))
+
+
+# --- スタブ: Supabase（非同期クライアント互換） ---
+class _StubResponse:
+    def __init__(self, data):
+        self.data = data
+
+
+class StubQuery:
+    """from_("products") 以降のクエリビルダーを模したスタブ"""
+
+    def __init__(self, backend, table: str):
+        self._backend = backend
+        self._table = table
+        self._write = None  # ("upsert" | "delete", 行, on_conflict)
+        self._filters = []
+        self._order = None
+        self._limit = None
+        self._range = None
+        self._single = False
+
+    def select(self, *columns):
+        return self
+
+    def upsert(self, rows, on_conflict="id"):
+        self._write = ("upsert", rows, on_conflict.split(","))
+        return self
+
+    def delete(self):
+        self._write = ("delete", [], None)
+        return self
+
+    def gt(self, column, value):
+        self._filters.append(lambda row: row.get(column) > value)
+        return self
+
+    def eq(self, column, value):
+        self._filters.append(lambda row: row.get(column) == value)
+        return self
+
+    def gte(self, column, value):
+        self._filters.append(lambda row: row.get(column) >= value)
+        return self
+
+    def in_(self, column, values):
+        self._filters.append(lambda row: row.get(column) in values)
+        return self
+
+    def order(self, column, desc=False):
+        self._order = (column, desc)
+        return self
+
+    def limit(self, count):
+        self._limit = count
+        return self
+
+    def range(self, start, end):
+        self._range = (start, end)
+        return self
+
+    def single(self):
+        self._single = True
+        return self
+
+    async def execute(self):
+        await self._backend.round_trip(self._table)
+        if self._write:
+            return _StubResponse(
+                self._backend.write(self._table, *self._write, self._filters)
+            )
+        rows = [
+            row
+            for row in self._backend.tables.get(self._table, [])
+            if all(f(row) for f in self._filters)
+        ]
+        if self._order:
+            column, desc = self._order
+            rows.sort(key=lambda row: row[column], reverse=desc)
+        if self._limit is not None:
+            rows = rows[: self._limit]
+        if self._range is not None:
+            start, end = self._range
+            rows = rows[start : end + 1]
+        if self._single:
+            return _StubResponse(rows[0] if rows else None)
+        return _StubResponse(rows)
+
+
+class StubRPC:
+    def __init__(self, backend, name: str, params: dict):
+        self._backend = backend
+        self._name = name
+        self._params = params
+
+    async def execute(self):
+        await self._backend.round_trip(self._name)
+        return _StubResponse(self._backend.rpc_results(self._name, self._params))
+
+
+# RPC の戻り値に含まれない列
+_HIDDEN_COLUMNS = ("embedding", "updated_at")
+
+
+class StubSupabase:
+    """
+    遅延付きの非同期Supabaseクライアントスタブ。
+    match_docs / match_products は全件のコサイン類似度を計算する厳密検索で応答する。
+    """
+
+    def __init__(self, latency: float = 0.0, products=None, docs=None):
+        self.latency = latency
+        self.calls: list[str] = []
+        self._clock = 0  # 書き込みの回数（書き込んだ行の updated_at に使う）
+        products = products if products is not None else []
+        docs = docs if docs is not None else []
+        self._matrices = {}
+        self.tables = {
+            "products": products,
+            "doc_embeddings": [
+                {**doc, "embedding": _pgvector(doc["content"])} for doc in docs
+            ],
+            "product_embeddings": [
+                {
+                    "id": f"pe-{product['id']}",
+                    "product_id": product["id"],
+                    "content": product["description"],
+                    "embedding": _pgvector(product["description"]),
+                    "updated_at": product["updated_at"],
+                }
+                for product in products
+            ],
+        }
+
+    async def round_trip(self, name: str):
+        self.calls.append(name)
+        await stub_sleep("supabase", self.latency)
+
+    def from_(self, table: str) -> StubQuery:
+        return StubQuery(self, table)
+
+    table = from_
+
+    def rpc(self, name: str, params: dict) -> StubRPC:
+        return StubRPC(self, name, params)
+
+    def write(self, table: str, action: str, rows: list, columns, filters) -> list:
+        """upsert / delete を適用する（updated_at は書き込みごとに進める）"""
+        stored = self.tables.setdefault(table, [])
+        if action == "delete":
+            self.tables[table] = [
+                row for row in stored if not all(f(row) for f in filters)
+            ]
+            return []
+        self._clock += 1
+        updated_at = f"2025-01-01T00:00:00.{self._clock:06d}+00:00"
+        written = []
+        for row in rows:
+            row = {**row, "updated_at": updated_at}
+            if isinstance(row.get("embedding"), list):
+                row["embedding"] = json.dumps(row["embedding"])
+            match = next(
+                (
+                    old
+                    for old in stored
+                    if all(old.get(c) == row.get(c) for c in columns)
+                ),
+                None,
+            )
+            if match is not None:
+                match.update(row)
+            else:
+                row.setdefault("id", f"{table}-{len(stored)}-{self._clock}")
+                stored.append(row)
+            written.append(row)
+        return written
+
+    def _matrix(self, table: str, rows: list) -> np.ndarray:
+        # 文字列の解析がスタブ側のCPU時間として計測に混ざらないよう、
+        # テーブルごとに正規化済みの行列をキャッシュする（行が変われば作り直す）
+        key = tuple(map(id, rows))
+        cached_key, matrix = self._matrices.get(table, (None, None))
+        if cached_key != key:
+            matrix = np.array([json.loads(row["embedding"]) for row in rows])
+            matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+            self._matrices[table] = (key, matrix)
+        return matrix
+
+    def rpc_results(self, name: str, params: dict) -> list:
+        table = {"match_docs": "doc_embeddings", "match_products": "product_embeddings"}
+        if name not in table:
+            return []
+        rows = [
+            row
+            for row in self.tables[table[name]]
+            if not params.get("doc_type") or row.get("type") == params["doc_type"]
+        ]
+        if not rows:
+            return []
+        query = np.asarray(params["query_embedding"], dtype=np.float64)
+        similarities = self._matrix(name, rows) @ (query / np.linalg.norm(query))
+        order = np.argsort(-similarities, kind="stable")[: params["match_count"]]
+        return [
+            {
+                **{k: v for k, v in rows[i].items() if k not in _HIDDEN_COLUMNS},
+                "similarity": float(similarities[i]),
+            }
+            for i in order
+            if similarities[i] > params["match_threshold"]
+        ]
+
+
+# --- スタブ: OpenAI ---
+class StubEmbeddings:
+    """遅延付きの埋め込みスタブ（固定ベクトルを返す）"""
+
+    model = "text-embedding-3-small"
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = 0
+
+    def _vector(self, text: str) -> list:
+        return _stub_vector(text)
+
+    def embed_query(self, text: str) -> list:
+        self.calls += 1
+        time.sleep(stub_delay(self.latency))
+        return self._vector(text)
+
+    def embed_documents(self, texts: list) -> list:
+        self.calls += 1
+        time.sleep(stub_delay(self.latency))
+        return [self._vector(text) for text in texts]
+
+    async def aembed_query(self, text: str) -> list:
+        self.calls += 1
+        await stub_sleep("embedding", self.latency)
+        return self._vector(text)
+
+    async def aembed_documents(self, texts: list) -> list:
+        self.calls += 1
+        await stub_sleep("embedding", self.latency)
+        return [self._vector(text) for text in texts]
+
+
+class StubChatModel(BaseChatModel):
+    """遅延付きのチャットモデルスタブ。意図分析のプロンプトには常に none を返す"""
+
+    latency: float = 0.0
+    calls: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "stub-chat"
+
+    def _reply(self, messages) -> str:
+        prompt = messages[-1].content
+        if "価格に関する質問かどうか" in prompt:
+            return '{"type": "none"}'
+        return "スタブの回答です。コンテキスト情報に基づいてお答えします。"
+
+    def _usage(self, messages, reply: str) -> dict:
+        # 1文字1トークンとみなした概算
+        prompt_tokens = sum(len(message.content) for message in messages)
+        return {
+            "input_tokens": prompt_tokens,
+            "output_tokens": len(reply),
+            "total_tokens": prompt_tokens + len(reply),
+        }
+
+    def _message(self, messages) -> AIMessage:
+        reply = self._reply(messages)
+        return AIMessage(content=reply, usage_metadata=self._usage(messages, reply))
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        self.calls += 1
+        time.sleep(stub_delay(self.latency))
+        message = self._message(messages)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        self.calls += 1
+        await stub_sleep("llm", self.latency)
+        message = self._message(messages)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        # 最初のトークンまでに latency、以降は数文字ずつ返す
+        self.calls += 1
+        await stub_sleep("llm", self.latency)
+        reply = self._reply(messages)
+        for i in range(0, len(reply), 4):
+            await asyncio.sleep(0)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=reply[i : i + 4]))
+        # OpenAI の stream_usage と同様に、最後に内容なしでトークン数だけを送る
+        yield ChatGenerationChunk(
+            message=AIMessageChunk(
+                content="", usage_metadata=self._usage(messages, reply)
+            )
+        )
+
+
+def build_products(count: int) -> list:
+    return [
+        {
+            "id": f"00000000-0000-0000-0000-{i:012d}",
+            "name": f"Stub App {i}",
+            "price": 500 + (i * 37) % 20000,
+            "description": f"Stub App {i} の説明です。",
+            "features": ["タスク管理", "通知"],
+            "updated_at": "2024-01-01T00:00:00+00:00",
+        }
+        for i in range(count)
+    ]
+
+
+def build_docs(count: int) -> list:
+    return [
+        {
+            "id": f"doc-{i}",
+            "type": "faq",
+            "title": f"よくある質問 {i}",
+            "content": f"Q: 質問 {i} の使い方は？\nA: 使い方 {i} の説明です。",
+            "updated_at": "2024-01-01T00:00:00+00:00",
+        }
+        for i in range(count)
+    ]
+
+
+def install_stubs(
+    latency: float,
+    products: int = 20,
+    docs: int = 20,
+    llm_latency: float = None,
+    embedding_latency: float = None,
+    jitter: float = 0.0,
+):
+    """
+    スタブを差し込んだ ChatbotSingleton を生成して登録する。
+    llm_latency / embedding_latency を省略した場合は latency（DBの往復）と同じ
+    """
+    global _latency_jitter
+    _latency_jitter = jitter
+    _latency_random.seed(0)
+    chatbot = index.ChatbotSingleton()
+    chatbot.llm = StubChatModel(latency=latency if llm_latency is None else llm_latency)
+    chatbot.emb = StubEmbeddings(
+        latency=latency if embedding_latency is None else embedding_latency
+    )
+    chatbot.supabase_client = StubSupabase(
+        latency=latency, products=build_products(products), docs=build_docs(docs)
+    )
+    chatbot._init_caches()
+    index.ChatbotSingleton._instance = chatbot
+    return chatbot
+
+
+async def _post_chat(client: httpx.AsyncClient, message: str):
+    response = await client.post("/api/chat", json={"message": message})
+    response.raise_for_status()
+    return response.json()
+
+
+# --- 並行性の検証 ---
+async def run_concurrency_check(requests: int, latency: float) -> bool:
+    """
+    N件の同時リクエストで、上流（LLM・埋め込み）のスタブ呼び出しが同時に実行されることを
+    確認する。どこかで同期I/Oがイベントループを塞いでいると同時実行数は1に近づく。
+    所要時間は同時実行数の制限（LLM_MAX_CONCURRENCY など）で変わるため判定に使わない。
+    """
+    install_stubs(latency)
+    transport = httpx.ASGITransport(app=index.app)
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://bench"
+    ) as client:
+        # カタログの初回読み込みを済ませてから計測する。
+        # キャッシュに当たらないよう、計測には毎回異なる質問を使う
+        await _post_chat(client, "使い方を教えて")
+
+        started = time.perf_counter()
+        await _post_chat(client, "使い方を教えて single")
+        single = time.perf_counter() - started
+
+        peak_in_flight.clear()
+        started = time.perf_counter()
+        await asyncio.gather(
+            *(_post_chat(client, f"使い方を教えて {i}") for i in range(requests))
+        )
+        concurrent = time.perf_counter() - started
+
+    print(f"single request       : {single * 1000:.1f} ms")
+    print(f"{requests} concurrent requests: {concurrent * 1000:.1f} ms")
+    ok = True
+    for limiter in (index.LLM_LIMITER, index.EMBEDDING_LIMITER):
+        # 全リクエストが同時に届くので、制限の上限まで重なって実行されるはず
+        expected = min(requests, limiter.max_concurrency)
+        peak = peak_in_flight.get(limiter.name, 0)
+        print(f"{limiter.name + ' in flight':<21}: max {peak} (limit {expected})")
+        if peak < expected:
+            print(f"NG: {limiter.name} の呼び出しが直列化されています")
+            ok = False
+        if peak > limiter.max_concurrency:
+            print(f"NG: {limiter.name} の同時実行数が上限を超えています")
+            ok = False
+    if ok:
+        print("OK")
+    return ok
+
+
+# --- ローカルベクトル検索と RPC の一致確認 ---
+PARITY_QUERIES = [
+    "使い方を教えて",
+    "料金プランについて知りたい",
+    "ログインできません",
+    "タスク管理ができるアプリはありますか",
+    "通知を止めたい",
+    "退会方法を教えてください",
+    "スマホでも使えますか",
+    "おすすめのアプリは？",
+]
+
+
+async def run_parity_check(stub: bool, min_recall: float) -> bool:
+    """
+    同じクエリ埋め込みで match_docs / match_products RPC と LocalVectorIndex を比較する。
+    RPC は ivfflat 索引による近似検索なので、実DBでは上位件数の一致率（recall）で判定する。
+    """
+    if stub:
+        chatbot = install_stubs(latency=0.0)
+    else:
+        chatbot = await index.ChatbotSingleton.get_instance()
+        if chatbot.init_error:
+            print(f"NG: 初期化に失敗しました: {chatbot.init_error}")
+            return False
+    local = index.LocalVectorIndex(chatbot.supabase_client)
+    await local.refresh()
+    print(f"local index: docs={len(local.docs)} products={len(local.products)}")
+
+    hits = total = 0
+    max_similarity_diff = 0.0
+    for query in PARITY_QUERIES:
+        embedding = await chatbot.emb.aembed_query(query)
+        for rpc_name, match_count in (
+            ("match_docs", index.MATCH_COUNT),
+            ("match_products", 3),
+        ):
+            response = await chatbot.supabase_client.rpc(
+                rpc_name,
+                {
+                    "query_embedding": embedding,
+                    "match_threshold": index.MATCH_THRESHOLD,
+                    "match_count": match_count,
+                },
+            ).execute()
+            expected = {row["id"]: row["similarity"] for row in response.data or []}
+            actual = {
+                row["id"]: row["similarity"]
+                for row in getattr(local, rpc_name)(
+                    embedding, index.MATCH_THRESHOLD, match_count
+                )
+            }
+            common = expected.keys() & actual.keys()
+            hits += len(common)
+            total += len(expected)
+            for row_id in common:
+                diff = abs(expected[row_id] - actual[row_id])
+                max_similarity_diff = max(max_similarity_diff, diff)
+            if expected.keys() != actual.keys():
+                print(f"  mismatch {rpc_name} {query!r}:")
+                print(f"    rpc  : {list(expected)}")
+                print(f"    local: {list(actual)}")
+
+    recall = hits / total if total else 1.0
+    ok = recall >= min_recall and max_similarity_diff < 1e-3
+    print(f"recall@k           : {recall:.3f} ({hits}/{total})")
+    print(f"max similarity diff: {max_similarity_diff:.2e}")
+    print("OK" if ok else "NG: ローカル検索の結果が RPC と一致しません")
+    return ok
+
+
+# --- 価格の質問の判定 ---
+def _upper(value, inclusive=True):
+    return {"max": value, "max_inclusive": inclusive}
+
+
+def _lower(value, inclusive=True):
+    return {"min": value, "min_inclusive": inclusive}
+
+
+# (質問, parse_price_range の期待値)
+PRICE_RANGE_CASES = [
+    # 算用数字
+    ("3000円以下のアプリ", _upper(3000)),
+    ("5,000円未満", _upper(5000, inclusive=False)),
+    ("¥1,200まで", _upper(1200)),
+    ("3000円以上", _lower(3000)),
+    ("2000円超のアプリ", _lower(2000, inclusive=False)),
+    ("1000円より高いアプリ", _lower(1000, inclusive=False)),
+    ("¥1,200〜¥3,000", {**_lower(1200), **_upper(3000)}),
+    ("¥800前後のアプリ", {"around": 800}),
+    ("予算2万円", _upper(20000)),
+    # 万・千
+    ("1万円以下のアプリ", _upper(10000)),
+    ("2万以下", _upper(20000)),
+    ("1.5万円以内", _upper(15000)),
+    ("1万5千円以下", _upper(15000)),
+    ("5千円〜1万円", {**_lower(5000), **_upper(10000)}),
+    ("3千円から", _lower(3000)),
+    # 漢数字
+    ("千円以下", _upper(1000)),
+    ("一万円以内", _upper(10000)),
+    ("百円以下", _upper(100)),
+    ("三千五百円以上", _lower(3500)),
+    ("二万五千円未満", _upper(25000, inclusive=False)),
+    ("二〇〇〇円以下", _upper(2000)),
+    ("二千円から五千円", {**_lower(2000), **_upper(5000)}),
+    ("五百円くらい", {"around": 500}),
+    # 金額ではない
+    ("安いアプリ", None),
+    ("一番安いアプリは？", None),
+    ("アプリを3つ教えて", None),
+    ("十個のアプリ", None),
+    ("千葉のアプリ", None),
+]
+# (質問, plan_price_query の期待値: 並び順, 件数, 価格条件)
+PRICE_PLAN_CASES = [
+    ("一番安いアプリは？", "asc", 1, None),
+    ("高いアプリを3つ教えて", "desc", 3, None),
+    ("最安値のアプリを教えて", "asc", 1, None),
+    ("最高値の商品", "desc", 1, None),
+    ("1万円以下のアプリ", "asc", 5, _upper(10000)),
+    ("千円以下で一番高いアプリ", "desc", 1, _upper(1000)),
+    ("一万円以内のアプリを3つ", "asc", 3, _upper(10000)),
+    ("3000円以上の高いアプリ", "desc", 5, _lower(3000)),
+    ("5千円〜1万円のアプリを2つ", "asc", 2, {**_lower(5000), **_upper(10000)}),
+    ("高いアプリ20個", "desc", 10, None),
+]
+
+
+def run_price_check() -> bool:
+    """価格条件の抽出と、ローカル判定からの並び順・件数・条件の決定を表のケースで確認する"""
+    failures = []
+    for query, expected in PRICE_RANGE_CASES:
+        actual = index.parse_price_range(query)
+        if actual != expected:
+            failures.append(
+                f"parse_price_range({query!r}) = {actual}, expected {expected}"
+            )
+    for query, sort, limit, price_range in PRICE_PLAN_CASES:
+        expected = {"sort": sort, "limit": limit, "range": price_range}
+        actual = index.plan_price_query(query, index.classify_intent_locally(query))
+        if actual != expected:
+            failures.append(
+                f"plan_price_query({query!r}) = {actual}, expected {expected}"
+            )
+    for failure in failures:
+        print(failure)
+    total = len(PRICE_RANGE_CASES) + len(PRICE_PLAN_CASES)
+    print(f"price cases: {total - len(failures)}/{total} passed")
+    print("NG" if failures else "OK")
+    return not failures
+
+
+# --- スナップショットの検索精度と速度 ---
+def build_synthetic_table(rows: int, dimension: int, seed: int = 0):
+    """クラスタ構造を持つランダムな埋め込みで VectorTable を作る"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((max(rows // 50, 1), dimension))
+    matrix = centers[rng.integers(len(centers), size=rows)]
+    matrix = matrix + rng.standard_normal((rows, dimension)) * 0.6
+    table = indexes.VectorTable(
+        "doc_embeddings", ["id", "type", "title", "content"], label_column="type"
+    )
+    table.rows = [
+        {"id": f"doc-{i}", "type": "faq", "title": f"doc {i}", "content": ""}
+        for i in range(rows)
+    ]
+    table.versions = ["2024-01-01T00:00:00+00:00"] * rows
+    table.matrix = indexes.normalize_rows(matrix.astype(np.float32))
+    table.labels = np.array(["faq"] * rows, dtype=object)
+    return table, rng
+
+
+def _recall(expected: list, actual: list) -> float:
+    expected_ids = {row["id"] for row in expected}
+    if not expected_ids:
+        return 1.0
+    return len(expected_ids & {row["id"] for row in actual}) / len(expected_ids)
+
+
+class Float16Table:
+    """
+    ベクトルを float16 で保持した場合の検索（評価用。スナップショットの形式には含めない）。
+    numpy には float16 の行列積の BLAS がないため、ブロックごとに float32 に戻して計算する
+    """
+
+    block_rows = 1024
+
+    def __init__(self, table):
+        self.rows = table.rows
+        self.matrix = table.matrix.astype(np.float16)
+        self._buffer = np.empty((self.block_rows, self.matrix.shape[1]), np.float32)
+
+    def search(self, query_embedding, threshold: float, count: int) -> list:
+        query = indexes.normalize_query(query_embedding)
+        similarities = np.empty(len(self.matrix), dtype=np.float32)
+        for start in range(0, len(self.matrix), self.block_rows):
+            block = self.matrix[start : start + self.block_rows]
+            buffer = self._buffer[: len(block)]
+            np.copyto(buffer, block)
+            similarities[start : start + len(block)] = buffer @ query
+        return [
+            {**self.rows[i], "similarity": float(similarities[i])}
+            for i in indexes.top_k_above(similarities, threshold, count)
+        ]
+
+
+def _time_searches(table, query_vectors, top_k: int, repeats: int = 3):
+    """全クエリを検索し、結果と1クエリあたりの時間（repeats 回の最小値, ms）を返す"""
+    best = float("inf")
+    for _ in range(repeats):
+        started = time.perf_counter()
+        results = [table.search(q, index.MATCH_THRESHOLD, top_k) for q in query_vectors]
+        best = min(best, time.perf_counter() - started)
+    return results, best / len(query_vectors) * 1000
+
+
+def run_recall_benchmark(
+    rows: int,
+    queries: int,
+    dimension: int,
+    top_k: int,
+    min_recall: float = 0.99,
+    max_slowdown: float = 1.5,
+) -> bool:
+    """
+    メモリマップしたスナップショットの検索結果をインメモリの float32 検索と比較し、
+    recall@k・1クエリあたりの時間・スナップショットを開く時間を表示する。
+    recall が min_recall を下回るか、検索時間がインメモリの max_slowdown 倍を超えたら NG。
+    参考として float16 で保持した場合のサイズ・時間・recall も表示する。
+    """
+    exact, rng = build_synthetic_table(rows, dimension)
+    # 既存の行に近いクエリ（実際の質問に似た文書がある状況）を作る
+    picks = rng.integers(rows, size=queries)
+    query_vectors = exact.matrix[picks] + rng.standard_normal(
+        (queries, dimension)
+    ).astype(np.float32) * (0.5 / np.sqrt(dimension))
+
+    expected, exact_ms = _time_searches(exact, query_vectors, top_k)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "snapshot.bin")
+        indexes.write_vector_snapshot(path, [exact])
+        started = time.perf_counter()
+        table = indexes.load_vector_snapshot(path)["doc_embeddings"]
+        load_ms = (time.perf_counter() - started) * 1000
+        size_mb = os.path.getsize(path) / 1024 / 1024
+        results, snapshot_ms = _time_searches(table, query_vectors, top_k)
+        del table  # メモリマップへの参照を外してから一時ディレクトリを消す
+
+    recall = np.mean([_recall(e, a) for e, a in zip(expected, results)])
+    vectors_mb = exact.matrix.nbytes / 1024 / 1024
+    # 参考: float16 で保存すればファイルとページキャッシュは半分になるが、検索は遅くなる
+    half = Float16Table(exact)
+    half_results, half_ms = _time_searches(half, query_vectors, top_k, repeats=1)
+    half_recall = np.mean([_recall(e, a) for e, a in zip(expected, half_results)])
+    print(f"rows={rows} dimension={dimension} queries={queries} k={top_k}")
+    print(f"{'in-memory float32':<18}: {vectors_mb:6.1f} MiB  {exact_ms:7.2f} ms/query")
+    print(
+        f"{'snapshot (mmap)':<18}: {size_mb:6.1f} MiB  {snapshot_ms:7.2f} ms/query  "
+        f"open {load_ms:.1f} ms  recall {recall:.3f}"
+    )
+    print(
+        f"{'float16 (参考)':<16}: {half.matrix.nbytes / 1024 / 1024:6.1f} MiB  "
+        f"{half_ms:7.2f} ms/query  recall {half_recall:.3f}  "
+        f"({half_ms / exact_ms:.1f}x, 判定には使わない)"
+    )
+
+    ok = True
+    if recall < min_recall:
+        print(f"NG: recall@{top_k} {recall:.3f} < {min_recall}")
+        ok = False
+    if snapshot_ms > exact_ms * max_slowdown:
+        print(
+            f"NG: スナップショットの検索がインメモリの {snapshot_ms / exact_ms:.2f} 倍遅い"
+            f"（上限 {max_slowdown} 倍）"
+        )
+        ok = False
+    if ok:
+        print("OK")
+    return ok
+
+
+# --- 負荷試験 ---
+QUERY_CLASSES = ("greeting", "faq", "price", "product", "semantic")
+DEFAULT_MIX = "greeting=1,price=2,product=2,semantic=5"
+GREETINGS = ["こんにちは", "ありがとうございます", "こんばんは"]
+PRICE_QUERIES = [
+    "一番安いアプリは？",
+    "高いアプリを3つ教えて",
+    "1万円以下のアプリ",
+    "¥800前後のアプリ",
+    "最も高いアプリは？",
+]
+FAQ_QUERIES = [
+    "パスワードを忘れました",
+    "支払い方法を教えて",
+    "返金はできますか？",
+    "退会したい",
+    "購入履歴はどこで見られますか",
+]
+
+
+def parse_mix(mix: str) -> dict:
+    """「greeting=1,price=2,...」形式のクエリ種別ごとの比率を解析する"""
+    weights = {}
+    for item in mix.split(","):
+        name, _, weight = item.partition("=")
+        if name.strip() not in QUERY_CLASSES:
+            raise ValueError(f"unknown query class: {name}")
+        weights[name.strip()] = float(weight or 1)
+    return weights
+
+
+def build_workload(
+    requests: int, mix: dict, products: int, docs: int, unique: bool, seed: int
+) -> list:
+    """
+    (クエリ種別, 質問文) のリストを作る。unique でない場合、商品名・意味検索の質問は
+    カタログ・コーパスの範囲で繰り返し現れ、キャッシュにも当たる
+    """
+    rng = random.Random(seed)
+    classes = rng.choices(list(mix), weights=list(mix.values()), k=requests)
+    workload = []
+    for i, query_class in enumerate(classes):
+        if query_class == "greeting":
+            query = rng.choice(GREETINGS)
+        elif query_class == "faq":
+            query = rng.choice(FAQ_QUERIES)
+        elif query_class == "price":
+            query = rng.choice(PRICE_QUERIES)
+        elif query_class == "product":
+            query = f"Stub App {rng.randrange(max(products, 1))} について教えて"
+        else:
+            query = f"質問 {rng.randrange(max(docs, 1))} の使い方は？"
+        if unique and query_class in ("product", "semantic"):
+            query = f"{query} #{i}"
+        workload.append((query_class, query))
+    return workload
+
+
+def parse_server_timing(header: str) -> dict:
+    timings = {}
+    for item in filter(None, (part.strip() for part in header.split(","))):
+        name, _, duration = item.partition(";dur=")
+        if duration:
+            timings[name] = float(duration)
+    return timings
+
+
+def summarize(latencies: list) -> dict:
+    if not latencies:
+        return {"count": 0}
+    values = np.asarray(latencies)
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {
+        "count": len(latencies),
+        "mean_ms": round(float(values.mean()), 2),
+        "p50_ms": round(float(p50), 2),
+        "p95_ms": round(float(p95), 2),
+        "p99_ms": round(float(p99), 2),
+    }
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+async def run_load_test(args) -> dict:
+    """
+    スタブを差し込んだ /api/chat に指定の同時実行数でリクエストを送り、
+    クエリ種別ごとのレイテンシ（p50/p95/p99）とスループットを集計する
+    """
+    install_stubs(
+        args.latency,
+        products=args.products,
+        docs=args.docs,
+        llm_latency=args.llm_latency,
+        embedding_latency=args.embedding_latency,
+        jitter=args.jitter,
+    )
+    workload = build_workload(
+        args.requests,
+        parse_mix(args.mix),
+        args.products,
+        args.docs,
+        args.unique,
+        args.seed,
+    )
+    latencies = {query_class: [] for query_class in QUERY_CLASSES}
+    stages = {query_class: {} for query_class in QUERY_CLASSES}
+    errors = {query_class: 0 for query_class in QUERY_CLASSES}
+    # 混雑で省略した処理（Server-Timing の degraded_{stage}）の件数
+    degraded = {query_class: {} for query_class in QUERY_CLASSES}
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    transport = httpx.ASGITransport(app=index.app)
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://bench", timeout=None
+    ) as client:
+        # カタログ・索引の初回読み込みは計測に含めない（定型応答では読み込まれない）
+        await client.post("/api/chat", json={"message": "使い方を教えて warmup"})
+
+        async def send(query_class: str, query: str):
+            async with semaphore:
+                started = time.perf_counter()
+                response = await client.post("/api/chat", json={"message": query})
+                elapsed_ms = (time.perf_counter() - started) * 1000
+            if response.status_code != 200:
+                errors[query_class] += 1
+                return
+            latencies[query_class].append(elapsed_ms)
+            timing = parse_server_timing(response.headers.get("server-timing", ""))
+            for stage, duration in timing.items():
+                if stage.startswith("degraded_"):
+                    stage = stage.removeprefix("degraded_")
+                    counts = degraded[query_class]
+                    counts[stage] = counts.get(stage, 0) + 1
+                    continue
+                stages[query_class].setdefault(stage, []).append(duration)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(send(*item) for item in workload))
+        elapsed = time.perf_counter() - started
+
+    # 実行中の同じ質問に合流して省略できた回答生成の数（ウォームアップ分を除く）
+    chatbot = await index.ChatbotSingleton.get_instance()
+    coalesced = chatbot.inflight.coalesced
+    classes = {}
+    for query_class in QUERY_CLASSES:
+        if not latencies[query_class] and not errors[query_class]:
+            continue
+        classes[query_class] = {
+            **summarize(latencies[query_class]),
+            "errors": errors[query_class],
+            "degraded": degraded[query_class],
+            "stages_p50_ms": {
+                stage: round(float(np.percentile(values, 50)), 2)
+                for stage, values in stages[query_class].items()
+            },
+        }
+    return {
+        "revision": _git_revision(),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "config": {
+            key: getattr(args, key)
+            for key in (
+                "requests",
+                "concurrency",
+                "latency",
+                "llm_latency",
+                "embedding_latency",
+                "jitter",
+                "products",
+                "docs",
+                "mix",
+                "unique",
+                "seed",
+            )
+        },
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(workload) / elapsed, 2),
+        "coalesced": coalesced,
+        # 定型応答（事前定義された応答・FAQ）で済んだ質問の割合
+        "faq_hit_ratio": index.FaqStats.as_dict()["hit_ratio"],
+        "overall": summarize(
+            [latency for values in latencies.values() for latency in values]
+        ),
+        "classes": classes,
+    }
+
+
+def print_load_report(result: dict):
+    print(
+        f"revision={result['revision']} requests={result['config']['requests']} "
+        f"concurrency={result['config']['concurrency']} "
+        f"throughput={result['throughput_rps']} req/s "
+        f"coalesced={result.get('coalesced', 0)} "
+        f"faq_hit_ratio={result.get('faq_hit_ratio', 0.0)}"
+    )
+    print(
+        f"{'class':<10} {'count':>6} {'err':>4} {'p50':>9} {'p95':>9} {'p99':>9}  "
+        "degraded"
+    )
+    rows = [*result["classes"].items(), ("overall", result["overall"])]
+    for query_class, stats in rows:
+        if not stats.get("count"):
+            continue
+        degraded = ", ".join(
+            f"{stage}={count}" for stage, count in stats.get("degraded", {}).items()
+        )
+        print(
+            f"{query_class:<10} {stats['count']:>6} {stats.get('errors', 0):>4} "
+            f"{stats['p50_ms']:>7.1f}ms {stats['p95_ms']:>7.1f}ms "
+            f"{stats['p99_ms']:>7.1f}ms  {degraded or '-'}"
+        )
+
+
+def compare_with_baseline(
+    result: dict, baseline: dict, tolerance: float, min_delta_ms: float
+) -> list:
+    """
+    ベースラインより悪化した指標を返す。比率が tolerance を超え、かつ
+    差が min_delta_ms 以上のものだけを回帰とみなす（小さな値の揺れを無視する）
+    """
+    regressions = []
+    if result["config"] != baseline.get("config"):
+        print("⚠️ ベースラインと設定が異なります。比較結果は参考値です")
+    for query_class, stats in result["classes"].items():
+        base = baseline.get("classes", {}).get(query_class)
+        if not base or not stats.get("count") or not base.get("count"):
+            continue
+        for metric in ("p50_ms", "p95_ms", "p99_ms"):
+            delta = stats[metric] - base[metric]
+            if delta >= min_delta_ms and stats[metric] > base[metric] * (1 + tolerance):
+                regressions.append(
+                    f"{query_class} {metric}: {base[metric]:.1f}ms → "
+                    f"{stats[metric]:.1f}ms (+{delta / base[metric]:.0%})"
+                )
+    if result["throughput_rps"] < baseline["throughput_rps"] * (1 - tolerance):
+        regressions.append(
+            f"throughput: {baseline['throughput_rps']} → {result['throughput_rps']} req/s"
+        )
+    if result["overall"].get("count", 0) < baseline["overall"].get("count", 0):
+        regressions.append("成功したリクエスト数がベースラインより少ない")
+    return regressions
+
+
+# --- コールドスタート ---
+# 新しいインタープリターで index を読み込み、最初のリクエストまでの所要時間を計測する。
+# クライアントは本物を生成し（import と生成の時間を含める）、通信部分だけスタブに差し替える
+STARTUP_PROBE = """
+import asyncio, json, sys, time
+
+started = time.perf_counter()
+import index
+
+imported = time.perf_counter()
+
+
+async def main(eager, latency):
+    import httpx
+    import benchmark
+
+    result = {"import_ms": (imported - started) * 1000}
+    mark = time.perf_counter()
+    chatbot = await index.ChatbotSingleton.get_instance()
+    result["init_ms"] = (time.perf_counter() - mark) * 1000
+    if chatbot.init_error:
+        raise SystemExit(chatbot.init_error)
+    chatbot.llm = benchmark.StubChatModel(latency=latency)
+    chatbot.emb = benchmark.StubEmbeddings(latency=latency)
+    chatbot.supabase_client = benchmark.StubSupabase(
+        latency=latency,
+        products=benchmark.build_products(20),
+        docs=benchmark.build_docs(20),
+    )
+    chatbot._init_caches()
+
+    if eager:
+        mark = time.perf_counter()
+        await index.warm_up()
+        result["warmup_ms"] = (time.perf_counter() - mark) * 1000
+    transport = httpx.ASGITransport(app=index.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for key, message in (("first_ms", "使い方を教えて"), ("second_ms", "返品について")):
+            mark = time.perf_counter()
+            response = await client.post("/api/chat", json={"message": message})
+            response.raise_for_status()
+            result[key] = (time.perf_counter() - mark) * 1000
+    print(json.dumps(result))
+
+
+asyncio.run(main(sys.argv[1] == "eager", float(sys.argv[2])))
+"""
+STARTUP_METRICS = ("import_ms", "init_ms", "warmup_ms", "first_ms", "second_ms")
+
+
+def run_startup_benchmark(runs: int, latency: float) -> dict:
+    """
+    起動時にウォームアップしない場合（lazy）とする場合（eager）について、
+    新しいプロセスで import・初期化・最初のリクエストの所要時間を計測し中央値を返す
+    """
+    env = {
+        **os.environ,
+        # Vercel と同じく .env を探索せず、ダミーの認証情報でクライアントを生成する
+        "VERCEL": "1",
+        "SUPABASE_URL": "http://127.0.0.1:9",
+        "SUPABASE_SERVICE_ROLE_KEY": "stub",
+        "OPENAI_API_KEY": "sk-stub",
+        "LOG_LEVEL": "WARNING",
+    }
+    results = {}
+    for mode in ("lazy", "eager"):
+        samples = []
+        for _ in range(runs):
+            completed = subprocess.run(
+                [sys.executable, "-c", STARTUP_PROBE, mode, str(latency)],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                env=env,
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+            samples.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+        results[mode] = {
+            metric: round(float(np.median([sample[metric] for sample in samples])), 1)
+            for metric in STARTUP_METRICS
+            if metric in samples[0]
+        }
+    return results
+
+
+def print_startup_report(results: dict):
+    print(f"{'mode':<6}" + "".join(f"{metric:>12}" for metric in STARTUP_METRICS))
+    for mode, medians in results.items():
+        cells = "".join(
+            f"{medians[metric]:>10.1f}ms" if metric in medians else f"{'-':>12}"
+            for metric in STARTUP_METRICS
+        )
+        print(f"{mode:<6}{cells}")
+    lazy = results["lazy"]
+    # ウォームアップなしでは、初期化（import を含む）も最初のリクエストが負担する
+    print(
+        f"cold first request: lazy={lazy['init_ms'] + lazy['first_ms']:.1f}ms "
+        f"eager={results['eager']['first_ms']:.1f}ms"
+    )
+
+
+# --- デプロイ時の読み込み ---
+# Vercel の Python ランタイムと同じく、リポジトリのルートを作業ディレクトリにして
+# index.py をファイルパスから読み込む（api/chat は sys.path にない）
+ENTRYPOINT_PROBE = """
+import importlib.util, json, sys
+
+spec = importlib.util.spec_from_file_location("__VC_HANDLER_MODULE", "api/chat/index.py")
+module = importlib.util.module_from_spec(spec)
+sys.modules[spec.name] = module
+spec.loader.exec_module(module)
+print(json.dumps({"app": type(module.app).__name__, "logger": module.logger.name}))
+"""
+
+
+def run_entrypoint_check() -> bool:
+    """index.py が同じディレクトリのモジュールを Vercel 上と同じ条件で import できるか"""
+    env = {key: value for key, value in os.environ.items() if key != "PYTHONPATH"}
+    env.update({"VERCEL": "1", "LOG_LEVEL": "WARNING"})
+    completed = subprocess.run(
+        [sys.executable, "-c", ENTRYPOINT_PROBE],
+        cwd=os.path.join(os.path.dirname(os.path.abspath(__file__)), "../.."),
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    if completed.returncode != 0:
+        print(completed.stderr.strip().splitlines()[-1])
+        print("NG")
+        return False
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+    print(f"app: {result['app']}  logger: {result['logger']}")
+    print("OK")
+    return True
+
+
+# --- 複数ワーカーでの共有状態（SHARED_STATE_DIR）の検証 ---
+WORKER_PROBE = """
+import asyncio, gc, json, os, sys, time
+
+import benchmark
+import index
+
+
+def pss_kb():
+    # 共有ページは共有しているプロセス数で按分される（全ワーカーの合計が実際の使用量）
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            if line.startswith("Pss:"):
+                return int(line.split()[1])
+    return 0
+
+
+def barrier(directory, name, count):
+    open(os.path.join(directory, f"{name}-{os.getpid()}"), "w").close()
+    while sum(1 for entry in os.listdir(directory) if entry.startswith(name)) < count:
+        time.sleep(0.05)
+
+
+async def main(barrier_dir, workers, products, docs, latency):
+    chatbot = benchmark.install_stubs(latency, products=products, docs=docs)
+    gc.collect()
+    before = pss_kb()
+    mark = time.perf_counter()
+    await chatbot.catalog.get()
+    await chatbot.vector_index.get()
+    load_ms = (time.perf_counter() - mark) * 1000
+    query = benchmark._stub_vector("質問 1 の使い方は？")
+    found = chatbot.vector_index.match_docs(query, index.MATCH_THRESHOLD, index.MATCH_COUNT)
+    gc.collect()
+    # 読み込み中の一時的な領域をOSに返し、保持し続けるメモリだけを計測する（glibc）
+    try:
+        import ctypes
+
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except OSError:
+        pass
+    # 全ワーカーが読み込み終えてから計測する
+    barrier(barrier_dir, "loaded", workers)
+    shared = chatbot.shared_state
+    result = {
+        "role": (
+            "private" if shared is None
+            else "publisher" if shared.is_publisher
+            else "follower"
+        ),
+        "db_calls": len(chatbot.supabase_client.calls),
+        "load_ms": load_ms,
+        "index_pss_kb": pss_kb() - before,
+        "found": len(found),
+    }
+    barrier(barrier_dir, "measured", workers)
+    print(json.dumps(result))
+
+
+asyncio.run(main(sys.argv[1], *map(int, sys.argv[2:5]), float(sys.argv[5])))
+"""
+
+
+def run_workers_benchmark(
+    workers: int, products: int, docs: int, latency: float
+) -> dict:
+    """
+    ワーカーごとに読み込む場合（private）と SHARED_STATE_DIR で共有する場合（shared）に
+    ついて、N個のプロセスを同時に起動し、DBへの往復数と索引のメモリ（PSS）を比べる
+    """
+    results = {}
+    for mode in ("private", "shared"):
+        with tempfile.TemporaryDirectory() as workdir:
+            env = {**os.environ, "LOCAL_VECTOR_INDEX": "1", "LOG_LEVEL": "WARNING"}
+            env.pop("SHARED_STATE_DIR", None)
+            if mode == "shared":
+                env["SHARED_STATE_DIR"] = os.path.join(workdir, "shared")
+            barrier_dir = os.path.join(workdir, "barrier")
+            os.makedirs(barrier_dir)
+            processes = [
+                subprocess.Popen(
+                    [
+                        sys.executable,
+                        "-c",
+                        WORKER_PROBE,
+                        barrier_dir,
+                        str(workers),
+                        str(products),
+                        str(docs),
+                        str(latency),
+                    ],
+                    cwd=os.path.dirname(os.path.abspath(__file__)),
+                    env=env,
+                    stdout=subprocess.PIPE,
+                    text=True,
+                )
+                for _ in range(workers)
+            ]
+            samples = []
+            for process in processes:
+                stdout, _ = process.communicate()
+                if process.returncode != 0:
+                    raise RuntimeError(f"worker probe failed ({mode})")
+                samples.append(json.loads(stdout.strip().splitlines()[-1]))
+        results[mode] = samples
+    return results
+
+
+def print_workers_report(results: dict):
+    print(f"{'mode':<8} {'role':<10} {'db_calls':>8} {'load':>10} {'index_pss':>11}")
+    for mode, samples in results.items():
+        for sample in sorted(samples, key=lambda sample: sample["role"], reverse=True):
+            print(
+                f"{mode:<8} {sample['role']:<10} {sample['db_calls']:>8} "
+                f"{sample['load_ms']:>8.1f}ms {sample['index_pss_kb'] / 1024:>8.1f}MiB"
+            )
+    for mode, samples in results.items():
+        print(
+            f"{mode}: total db_calls={sum(s['db_calls'] for s in samples)} "
+            f"total index_pss={sum(s['index_pss_kb'] for s in samples) / 1024:.1f}MiB"
+        )
+
+
+# --- ハイブリッド検索（字句 + ベクトル）と ベクトル検索のみの比較 ---
+def build_markdown_docs() -> list:
+    """
+    取り込み対象の docs（ingest.DOC_SOURCES）を見出しごとに分けて doc_embeddings の行にする。
+    見出しは質問（title）として使うため、本文（content）には含めない
+    """
+    docs = []
+    for path, doc_type in ingest.DOC_SOURCES:
+        with open(os.path.join(ingest.REPO_ROOT, path), encoding="utf-8") as f:
+            text = f.read()
+        for section in re.split(r"\n(?=#+ )", text):
+            heading, _, body = section.strip().partition("\n")
+            title = heading.lstrip("#").strip()
+            body = body.strip()
+            if not title or len(body) < 10:
+                continue
+            docs.append(
+                {
+                    "id": f"{doc_type}-{len(docs)}",
+                    "type": doc_type,
+                    "title": title,
+                    "content": body,
+                    "updated_at": "2024-01-01T00:00:00+00:00",
+                }
+            )
+    return docs
+
+
+class HashingEmbeddings(StubEmbeddings):
+    """
+    文字 bi-gram をハッシュして次元に振り分ける埋め込みスタブ。
+    同じ語を含む文が近くなるだけで、言い換えは捉えない（実際の埋め込みの代わりではない）
+    """
+
+    def _vector(self, text: str) -> list:
+        vector = np.zeros(EMBEDDING_DIMENSION)
+        normalized = text.lower()
+        for i in range(len(normalized) - 1):
+            h = zlib.crc32(normalized[i : i + 2].encode())
+            vector[h % EMBEDDING_DIMENSION] += 1.0 if h & 1 << 31 else -1.0
+        if not vector.any():
+            vector[0] = 1.0
+        return vector.tolist()
+
+
+def _rank_metrics(expected: set, ranked_ids: list, count: int) -> tuple:
+    """(recall@count, 逆順位)"""
+    top = ranked_ids[:count]
+    recall = len(expected & set(top)) / len(expected)
+    reciprocal_rank = next(
+        (1.0 / rank for rank, doc_id in enumerate(top, start=1) if doc_id in expected),
+        0.0,
+    )
+    return recall, reciprocal_rank
+
+
+async def run_hybrid_benchmark(
+    stub: bool, queries_path: str, count: int, embedding_latency: float
+) -> dict:
+    """
+    見出し（または --queries の質問）から期待するドキュメントを引けるかを、
+    ベクトル検索のみと、字句検索を RRF で統合したハイブリッド検索で比較する。
+    ハイブリッドでは字句検索の結果が確実なら埋め込みを作らないので、その割合も表示する
+    """
+    if stub:
+        chatbot = index.ChatbotSingleton()
+        chatbot.llm = StubChatModel()
+        chatbot.emb = HashingEmbeddings(latency=embedding_latency)
+        chatbot.supabase_client = StubSupabase(docs=build_markdown_docs())
+        # 索引側のベクトルも質問と同じスタブで作る
+        for row in chatbot.supabase_client.tables["doc_embeddings"]:
+            row["embedding"] = json.dumps(chatbot.emb._vector(row["content"]))
+        chatbot._init_caches()
+    else:
+        chatbot = await index.ChatbotSingleton.get_instance()
+        if chatbot.init_error:
+            raise RuntimeError(f"初期化に失敗しました: {chatbot.init_error}")
+
+    vector_index = index.LocalVectorIndex(chatbot.supabase_client)
+    await vector_index.refresh()
+    lexical_index = index.LexicalIndex(chatbot.supabase_client, chatbot.catalog)
+    await lexical_index.refresh()
+    docs = vector_index.docs.rows
+    ids_by_title = {}
+    for doc in docs:
+        ids_by_title.setdefault(doc["title"], set()).add(doc["id"])
+
+    if queries_path:
+        # 1行1件の JSON: {"query": "...", "title": "期待するドキュメントのタイトル"}
+        with open(queries_path, encoding="utf-8") as f:
+            cases = [json.loads(line) for line in f if line.strip()]
+        cases = [
+            (case["query"], ids_by_title[case["title"]])
+            for case in cases
+            if case["title"] in ids_by_title
+        ]
+    else:
+        cases = list(ids_by_title.items())
+    print(f"docs={len(docs)} items={lexical_index.item_count} queries={len(cases)}")
+
+    async def vector_ranking(query: str) -> list:
+        embedding = await chatbot.emb.aembed_query(query)
+        matches = vector_index.match_docs(embedding, index.MATCH_THRESHOLD, count)
+        return [doc["id"] for doc in matches]
+
+    results = {}
+    for mode in ("vector", "hybrid"):
+        recalls, reciprocal_ranks, latencies = [], [], []
+        skipped = decisive_correct = 0
+        for query, expected in cases:
+            started = time.perf_counter()
+            if mode == "vector":
+                ranked = await vector_ranking(query)
+            else:
+                hits, decisive = lexical_index.search(query, count)
+                lexical = [hit["id"] for hit in hits if hit["kind"] == "doc"]
+                if decisive:
+                    skipped += 1
+                    decisive_correct += bool(lexical) and lexical[0] in expected
+                    ranked = lexical
+                else:
+                    fused = index.reciprocal_rank_fusion(
+                        await vector_ranking(query), lexical
+                    )
+                    ranked = [doc_id for _, doc_id in fused]
+            latencies.append((time.perf_counter() - started) * 1000)
+            recall, reciprocal_rank = _rank_metrics(expected, ranked, count)
+            recalls.append(recall)
+            reciprocal_ranks.append(reciprocal_rank)
+        results[mode] = {
+            f"recall@{count}": round(float(np.mean(recalls)), 4),
+            "mrr": round(float(np.mean(reciprocal_ranks)), 4),
+            "embedding_skip_ratio": round(skipped / len(cases), 4),
+            # 埋め込みを省略したとき、字句検索の1位が正解だった割合
+            "decisive_precision": (
+                round(decisive_correct / skipped, 4) if skipped else None
+            ),
+            **summarize(latencies),
+        }
+    return results
+
+
+def print_hybrid_report(results: dict):
+    for mode, result in results.items():
+        recall_key = next(key for key in result if key.startswith("recall@"))
+        print(
+            f"{mode:<8} {recall_key} {result[recall_key]:.3f}  mrr {result['mrr']:.3f}  "
+            f"mean {result['mean_ms']:6.1f} ms  p50 {result['p50_ms']:6.1f} ms  "
+            f"embedding skipped {result['embedding_skip_ratio']:.0%}"
+            + (
+                f" (top-1 correct {result['decisive_precision']:.0%})"
+                if result["decisive_precision"] is not None
+                else ""
+            )
+        )
+
+
+# --- 埋め込みの取り込み（全件を1件ずつ と 差分をバッチで の比較） ---
+async def _ingest_once(client, emb, chunks: list, args: list) -> dict:
+    options = ingest.build_parser().parse_args(args)
+    db_calls = len(client.calls)
+    started = time.perf_counter()
+    docs = await ingest.ingest_docs(client, emb, chunks, options)
+    products = await ingest.ingest_products(client, emb, options)
+    return {
+        "seconds": round(time.perf_counter() - started, 3),
+        "embedded": docs["embedded"] + products["embedded"],
+        "embedding_calls": docs["embedding_calls"] + products["embedding_calls"],
+        "db_calls": len(client.calls) - db_calls,
+    }
+
+
+async def run_ingest_benchmark(
+    products: int, latency: float, embedding_latency: float
+) -> dict:
+    """
+    リポジトリの docs と商品をスタブのDBに取り込み、従来のスクリプトと同じ
+    1件ずつの全件埋め込みと、ingest.py の差分・バッチ埋め込みを比べる
+    """
+    chunks = ingest.build_doc_chunks()
+
+    def fresh_db():
+        client = StubSupabase(latency=latency, products=build_products(products))
+        client.tables["product_embeddings"] = []
+        return client
+
+    emb = StubEmbeddings(latency=embedding_latency)
+    results = {}
+    results["per-item, all"] = await _ingest_once(
+        fresh_db(), emb, chunks, ["--all", "--batch-size=1", "--concurrency=1"]
+    )
+    client = fresh_db()
+    results["batched, all"] = await _ingest_once(client, emb, chunks, [])
+    results["batched, no change"] = await _ingest_once(client, emb, chunks, [])
+    edited = [dict(chunk) for chunk in chunks]
+    edited[0]["content"] += "\n（追記）"
+    client.tables["products"][0]["description"] += "（改訂）"
+    results["batched, 1 doc + 1 product"] = await _ingest_once(client, emb, edited, [])
+    print(f"doc chunks={len(chunks)} products={products}")
+    return results
+
+
+def print_ingest_report(results: dict):
+    print(
+        f"{'scenario':<28} {'time':>9} {'embedded':>9} {'api_calls':>10} {'db_calls':>9}"
+    )
+    for scenario, result in results.items():
+        print(
+            f"{scenario:<28} {result['seconds']:>8.2f}s {result['embedded']:>9} "
+            f"{result['embedding_calls']:>10} {result['db_calls']:>9}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    concurrency = subparsers.add_parser(
+        "concurrency", help="同時リクエストの並行性を検証"
+    )
+    concurrency.add_argument("--requests", type=int, default=20)
+    concurrency.add_argument("--latency", type=float, default=0.2)
+
+    parity = subparsers.add_parser(
+        "parity", help="ローカルベクトル検索と RPC の結果を比較"
+    )
+    parity.add_argument(
+        "--stub", action="store_true", help="実DBの代わりにスタブで比較する"
+    )
+    parity.add_argument("--min-recall", type=float, default=0.9)
+
+    recall = subparsers.add_parser(
+        "recall", help="スナップショット検索の recall@k と速度をインメモリ検索と比較"
+    )
+    recall.add_argument("--rows", type=int, default=20000)
+    recall.add_argument("--queries", type=int, default=100)
+    recall.add_argument("--dimension", type=int, default=EMBEDDING_DIMENSION)
+    recall.add_argument("--top-k", type=int, default=index.MATCH_COUNT)
+    recall.add_argument("--min-recall", type=float, default=0.99)
+    recall.add_argument(
+        "--max-slowdown",
+        type=float,
+        default=1.5,
+        help="インメモリ検索に対して許容する検索時間の倍率",
+    )
+
+    load = subparsers.add_parser(
+        "load", help="クエリ種別ごとのレイテンシとスループットを計測"
+    )
+    load.add_argument("--requests", type=int, default=500)
+    load.add_argument("--concurrency", type=int, default=20)
+    load.add_argument("--latency", type=float, default=0.05, help="DBの往復（秒）")
+    load.add_argument("--llm-latency", type=float, default=0.5)
+    load.add_argument("--embedding-latency", type=float, default=0.1)
+    load.add_argument("--jitter", type=float, default=0.2)
+    load.add_argument("--products", type=int, default=200)
+    load.add_argument("--docs", type=int, default=500)
+    load.add_argument("--mix", default=DEFAULT_MIX)
+    load.add_argument(
+        "--unique",
+        action="store_true",
+        help="商品名・意味検索の質問を毎回変え、キャッシュに当たらないようにする",
+    )
+    load.add_argument("--seed", type=int, default=0)
+    load.add_argument("--output", help="結果をJSONで保存する（ベースライン）")
+    load.add_argument("--baseline", help="比較するベースラインのJSON")
+    load.add_argument("--tolerance", type=float, default=0.2)
+    load.add_argument("--min-delta-ms", type=float, default=25.0)
+
+    startup = subparsers.add_parser(
+        "startup", help="コールドスタート時の import と最初のリクエストの所要時間"
+    )
+    startup.add_argument("--runs", type=int, default=5)
+    startup.add_argument("--latency", type=float, default=0.0)
+
+    subparsers.add_parser("price", help="価格の質問の判定（表のケース）")
+
+    subparsers.add_parser(
+        "entrypoint", help="Vercel と同じ読み込み方で index を import できるか"
+    )
+
+    workers = subparsers.add_parser(
+        "workers", help="複数ワーカーで共有状態を使う場合のDB往復数とメモリ（Linux）"
+    )
+    workers.add_argument("--workers", type=int, default=4)
+    workers.add_argument("--products", type=int, default=200)
+    workers.add_argument("--docs", type=int, default=2000)
+    workers.add_argument("--latency", type=float, default=0.0)
+
+    hybrid = subparsers.add_parser(
+        "hybrid", help="字句検索を統合したハイブリッド検索とベクトル検索のみの比較"
+    )
+    hybrid.add_argument(
+        "--stub",
+        action="store_true",
+        help="リポジトリの docs と文字 bi-gram の埋め込みスタブで比較する",
+    )
+    hybrid.add_argument(
+        "--queries", help='1行1件の JSON（{"query": ..., "title": ...}）'
+    )
+    hybrid.add_argument("--count", type=int, default=index.MATCH_COUNT)
+    hybrid.add_argument(
+        "--embedding-latency",
+        type=float,
+        default=0.1,
+        help="スタブの埋め込みの遅延（秒）",
+    )
+
+    ingest_parser = subparsers.add_parser(
+        "ingest", help="埋め込みの取り込み（全件を1件ずつ / 差分をバッチで）の比較"
+    )
+    ingest_parser.add_argument("--products", type=int, default=30)
+    ingest_parser.add_argument(
+        "--latency", type=float, default=0.02, help="DBの往復（秒）"
+    )
+    ingest_parser.add_argument("--embedding-latency", type=float, default=0.05)
+
+    parser.add_argument(
+        "--verbose", action="store_true", help="チャットAPIのINFOログを表示"
+    )
+
+    args = parser.parse_args()
+    if not args.verbose:
+        index.logger.setLevel(logging.WARNING)
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+    if args.command == "concurrency":
+        ok = asyncio.run(run_concurrency_check(args.requests, args.latency))
+        sys.exit(0 if ok else 1)
+    if args.command == "parity":
+        ok = asyncio.run(run_parity_check(args.stub, args.min_recall))
+        sys.exit(0 if ok else 1)
+    if args.command == "recall":
+        ok = run_recall_benchmark(
+            args.rows,
+            args.queries,
+            args.dimension,
+            args.top_k,
+            args.min_recall,
+            args.max_slowdown,
+        )
+        sys.exit(0 if ok else 1)
+    if args.command == "startup":
+        print_startup_report(run_startup_benchmark(args.runs, args.latency))
+    if args.command == "price":
+        sys.exit(0 if run_price_check() else 1)
+    if args.command == "entrypoint":
+        sys.exit(0 if run_entrypoint_check() else 1)
+    if args.command == "workers":
+        print_workers_report(
+            run_workers_benchmark(args.workers, args.products, args.docs, args.latency)
+        )
+    if args.command == "ingest":
+        print_ingest_report(
+            asyncio.run(
+                run_ingest_benchmark(
+                    args.products, args.latency, args.embedding_latency
+                )
+            )
+        )
+    if args.command == "hybrid":
+        print_hybrid_report(
+            asyncio.run(
+                run_hybrid_benchmark(
+                    args.stub, args.queries, args.count, args.embedding_latency
+                )
+            )
+        )
+    if args.command == "load":
+        result = asyncio.run(run_load_test(args))
+        print_load_report(result)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(result, f, ensure_ascii=False, indent=2)
+            print(f"saved: {args.output}")
+        if args.baseline:
+            with open(args.baseline) as f:
+                regressions = compare_with_baseline(
+                    result, json.load(f), args.tolerance, args.min_delta_ms
+                )
+            for regression in regressions:
+                print(f"NG: {regression}")
+            if not regressions:
+                print("OK: ベースラインからの悪化なし")
+            sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
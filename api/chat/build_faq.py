@@ -0,0 +1,126 @@
+"""
+FAQ の定型回答表の作成スクリプト
+
+docs/FAQ.md の「### 質問」と続く段落から、チャットボットが検索・LLMを使わずに
+答える定型回答の表（faq.json）を作成する。既存の faq.json にある項目の id と
+正規表現（patterns）などは質問文をキーに引き継ぐので、回答文の修正は FAQ.md を
+編集して再実行するだけでよい。patterns が空の項目は正規表現では照合せず、
+"embedding": false の項目は埋め込みでも照合しない（内容が古くなりやすい回答など）。
+
+--embed を付けると、FAQ_EMBEDDING_THRESHOLD を設定した場合に使う質問の埋め込みを
+faq-embeddings.npz に保存する（OpenAI の環境変数が必要）。
+
+使い方（api/chat ディレクトリで実行）:
+    python build_faq.py --source ../../docs/FAQ.md --output faq.json [--embed]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import re
+import sys
+
+import faq
+import index
+
+HEADING_PATTERN = re.compile(r"^###\s+(.+?)\s*$", re.MULTILINE)
+# 項目の先頭に並べるキー（それ以外のキーは既存の faq.json からそのまま引き継ぐ）
+GENERATED_KEYS = ("id", "question", "answer", "patterns")
+
+
+def parse_faq_markdown(text: str) -> list:
+    """「### 質問」見出しと、次の見出しまでの本文を (質問, 回答) の組にする"""
+    headings = list(HEADING_PATTERN.finditer(text))
+    pairs = []
+    for i, heading in enumerate(headings):
+        end = headings[i + 1].start() if i + 1 < len(headings) else len(text)
+        paragraphs = [
+            " ".join(line.strip() for line in paragraph.splitlines() if line.strip())
+            for paragraph in text[heading.end() : end].split("\n\n")
+            if paragraph.strip() and not paragraph.lstrip().startswith("#")
+        ]
+        if paragraphs:
+            pairs.append((heading.group(1), "\n\n".join(paragraphs)))
+    return pairs
+
+
+def merge_entries(pairs: list, existing: list) -> list:
+    """既存の項目から id と patterns を引き継ぎ、新しい質問には連番の id を振る"""
+    by_question = {entry["question"]: entry for entry in existing}
+    used_ids = {entry["id"] for entry in existing}
+    entries = []
+    for question, answer in pairs:
+        previous = by_question.get(question, {})
+        entry_id = previous.get("id")
+        if entry_id is None:
+            entry_id = next(
+                f"faq-{n}"
+                for n in range(len(used_ids) + 1)
+                if f"faq-{n}" not in used_ids
+            )
+            used_ids.add(entry_id)
+            print(
+                f"新しい質問です（patterns を追加してください）: {entry_id} {question}"
+            )
+        # patterns や embedding などの手で設定した項目はそのまま残す
+        entries.append(
+            {
+                "id": entry_id,
+                "question": question,
+                "answer": answer,
+                "patterns": previous.get("patterns", []),
+                **{k: v for k, v in previous.items() if k not in GENERATED_KEYS},
+            }
+        )
+    return entries
+
+
+async def embed_questions(entries: list, output: str) -> bool:
+    chatbot = await index.ChatbotSingleton.get_instance()
+    if chatbot.init_error:
+        print(f"初期化に失敗しました: {chatbot.init_error}")
+        return False
+
+    questions = [entry["question"] for entry in entries]
+    vectors = await chatbot.emb.aembed_documents(questions)
+    faq.save_faq_vectors(output, chatbot.emb.model, dict(zip(questions, vectors)))
+    print(f"{output}: {len(questions)} questions ({chatbot.emb.model})")
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--source",
+        default=os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "..", "..", "docs", "FAQ.md"
+        ),
+    )
+    parser.add_argument("--output", default=index.FAQ_PATH)
+    parser.add_argument("--embed", action="store_true", help="質問の埋め込みも作成する")
+    parser.add_argument("--embeddings-output", default=index.FAQ_EMBEDDINGS_PATH)
+    args = parser.parse_args()
+
+    with open(args.source, encoding="utf-8") as f:
+        pairs = parse_faq_markdown(f.read())
+    existing = []
+    if os.path.exists(args.output):
+        with open(args.output, encoding="utf-8") as f:
+            existing = json.load(f)
+    entries = merge_entries(pairs, existing)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(entries, f, ensure_ascii=False, indent=2)
+        f.write("\n")
+    print(
+        f"{args.output}: {len(entries)} entries "
+        f"({sum(1 for entry in entries if entry['patterns'])} with patterns)"
+    )
+
+    if args.embed:
+        ok = asyncio.run(embed_questions(entries, args.embeddings_output))
+        sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""
+ベクトルスナップショットの作成スクリプト
+
+doc_embeddings / product_embeddings を Supabase から読み込み、
+ローカルベクトル索引（LOCAL_VECTOR_INDEX=1）が起動時にメモリマップで開く
+スナップショットファイルを書き出す。デプロイ前のビルド工程で実行する。
+
+使い方（api/chat ディレクトリで実行）:
+    python build_snapshot.py --output vector-snapshot.bin
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+import index
+import indexes
+
+
+async def build(output: str) -> bool:
+    chatbot = await index.ChatbotSingleton.get_instance()
+    if chatbot.init_error:
+        print(f"初期化に失敗しました: {chatbot.init_error}")
+        return False
+
+    started = time.perf_counter()
+    vector_index = index.LocalVectorIndex(chatbot.supabase_client)
+    await vector_index.refresh()
+    indexes.write_vector_snapshot(output, [vector_index.docs, vector_index.products])
+    print(
+        f"{output}: docs={len(vector_index.docs)} "
+        f"products={len(vector_index.products)} "
+        f"size={os.path.getsize(output) / 1024 / 1024:.1f} MiB "
+        f"({time.perf_counter() - started:.1f} s)"
+    )
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--output", default="vector-snapshot.bin")
+    args = parser.parse_args()
+    ok = asyncio.run(build(args.output))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+"""
+トークナイザー（tiktoken のエンコーディング）の同梱スクリプト
+
+コンテキストのトークン数を数える tiktoken のエンコーディングを取得し、
+CONTEXT_TOKENIZER_DIR（既定 api/chat/tiktoken-cache）に保存する。
+保存したファイルは vercel.json の includeFiles でデプロイに含まれ、起動時は
+ネットワークから取得せずにこのファイルから読み込む（ネットワーク接続が必要なのはこのスクリプトのみ）。
+
+使い方（api/chat ディレクトリで実行）:
+    python build_tokenizer.py
+"""
+
+import argparse
+import os
+import sys
+
+import index
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--encoding", default=index.CONTEXT_TOKENIZER)
+    parser.add_argument("--output", default=index.CONTEXT_TOKENIZER_DIR)
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+    os.environ["TIKTOKEN_CACHE_DIR"] = args.output
+    import tiktoken
+
+    encoding = tiktoken.get_encoding(args.encoding)
+    path = index.tokenizer_cache_path(args.encoding, args.output)
+    if not os.path.exists(path):
+        print(f"{args.encoding} のファイルが {args.output} に保存されませんでした")
+        sys.exit(1)
+    print(
+        f"{path}: {args.encoding} ({encoding.n_vocab} tokens, "
+        f"{os.path.getsize(path) / 1024 / 1024:.1f} MiB)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+"""
+クエリ埋め込みのLRUキャッシュと、意味的に同じ質問への回答キャッシュ
+"""
+
+import asyncio
+import hashlib
+import os
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from settings import (
+    ANSWER_CACHE_MAX_DISTANCE,
+    ANSWER_CACHE_SIZE,
+    ANSWER_CACHE_TTL_SECONDS,
+    EMBEDDING_CACHE_SIZE,
+)
+from chat_logging import logger
+from indexes import normalize_string
+
+
+# --- クエリ埋め込みのLRUキャッシュ ---
+class EmbeddingCache:
+    """
+    正規化済みクエリとモデル名をキーに、埋め込みを float32 で保持するLRUキャッシュ。
+    persist_path を指定すると一定件数の追加ごとにディスクへ保存する。
+    """
+
+    # この件数だけ新規追加されたらバックグラウンドで保存する
+    PERSIST_EVERY = 50
+
+    def __init__(self, max_entries: int = EMBEDDING_CACHE_SIZE, persist_path=None):
+        self.max_entries = max_entries
+        self.persist_path = persist_path
+        self._entries: OrderedDict = OrderedDict()
+        self._unsaved = 0
+        self._persist_task = None  # 実行中の保存（同時に1つだけ）
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(model: str, text: str) -> tuple:
+        return (model, normalize_string(text))
+
+    def get(self, model: str, text: str):
+        key = self._key(model, text)
+        vector = self._entries.get(key)
+        if vector is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return vector.tolist()
+
+    def has(self, model: str, text: str) -> bool:
+        """ヒット/ミスの集計に影響を与えずに存在だけを確認する"""
+        return self._key(model, text) in self._entries
+
+    def put(self, model: str, text: str, vector):
+        key = self._key(model, text)
+        self._entries[key] = np.asarray(vector, dtype=np.float32)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+        self._unsaved += 1
+        if self.persist_path and self._unsaved >= self.PERSIST_EVERY:
+            self._schedule_persist()
+
+    def _schedule_persist(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return  # イベントループ外（スクリプトなど）では終了時の save() に任せる
+        if self._persist_task and not self._persist_task.done():
+            return  # 保存中なら、次に追加されたときに改めて保存する
+        self._unsaved = 0
+        # 書き込み中に辞書が変化しないよう、ここで取り出してからスレッドで保存する
+        items = list(self._entries.items())
+        self._persist_task = loop.create_task(
+            asyncio.to_thread(self._write, self.persist_path, items)
+        )
+        self._persist_task.add_done_callback(self._on_persisted)
+
+    def _on_persisted(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception():
+            logger.warning(
+                f"[EmbeddingCache] failed to save to {self.persist_path}: "
+                f"{task.exception()}"
+            )
+
+    async def wait_persisted(self):
+        """実行中のバックグラウンド保存が終わるまで待つ（save() と書き込みが重ならないように）"""
+        if self._persist_task and not self._persist_task.done():
+            await asyncio.wait([self._persist_task])
+
+    @staticmethod
+    def _write(path: str, items: list):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                models=np.array([model for (model, _), _ in items], dtype=str),
+                texts=np.array([text for (_, text), _ in items], dtype=str),
+                vectors=np.stack([vector for _, vector in items]),
+            )
+        os.replace(tmp_path, path)  # 書きかけのファイルを読まないよう差し替えで保存
+
+    def save(self, path: str):
+        if not self._entries:
+            return
+        try:
+            self._write(path, list(self._entries.items()))
+            logger.info(f"[EmbeddingCache] saved {len(self._entries)} entries")
+        except Exception as e:
+            logger.warning(f"[EmbeddingCache] failed to save to {path}: {e}")
+
+    def load(self, path: str):
+        if not os.path.exists(path):
+            return
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                for model, text, vector in zip(
+                    data["models"], data["texts"], data["vectors"]
+                ):
+                    self._entries[(str(model), str(text))] = vector
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            logger.info(f"[EmbeddingCache] loaded {len(self._entries)} entries")
+        except Exception as e:
+            logger.warning(f"[EmbeddingCache] failed to load {path}: {e}")
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+# --- 意味的に同じ質問への回答キャッシュ ---
+class AnswerCache:
+    """
+    最終LLM呼び出しの手前に置く回答キャッシュ。
+    クエリ埋め込みのコサイン距離が max_distance 以内で、かつ検索されたコンテキストの
+    フィンガープリントが一致する場合に保存済みの回答を返す。
+    埋め込みを作らなかった質問（字句検索で確定）は、質問文の完全一致で引く。
+    """
+
+    def __init__(
+        self,
+        max_entries: int = ANSWER_CACHE_SIZE,
+        ttl_seconds: float = ANSWER_CACHE_TTL_SECONDS,
+        max_distance: float = ANSWER_CACHE_MAX_DISTANCE,
+    ):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_distance = max_distance
+        self._entries: list[dict] = []
+        self._matrix = None  # 正規化済み埋め込みを行に並べた行列（遅延構築）
+        self._exact = {}  # (質問文, フィンガープリント) → (回答, 期限)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def fingerprint(context: str) -> str:
+        return hashlib.sha256(context.encode()).hexdigest()
+
+    @staticmethod
+    def _unit(vector) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _evict_expired(self):
+        now = time.monotonic()
+        alive = [entry for entry in self._entries if entry["expires_at"] > now]
+        if len(alive) != len(self._entries):
+            self._entries = alive
+            self._matrix = None
+
+    def lookup(self, query_embedding, context_fingerprint: str, query: str = None):
+        if query_embedding is None:
+            answer, expires_at = self._exact.get(
+                (query, context_fingerprint), (None, 0)
+            )
+            if answer is not None and expires_at > time.monotonic():
+                self.hits += 1
+                return answer
+            self.misses += 1
+            return None
+        self._evict_expired()
+        if self._entries:
+            if self._matrix is None:
+                self._matrix = np.stack([entry["vector"] for entry in self._entries])
+            similarities = self._matrix @ self._unit(query_embedding)
+            for i in np.argsort(-similarities):
+                if similarities[i] < 1 - self.max_distance:
+                    break
+                entry = self._entries[i]
+                if entry["fingerprint"] == context_fingerprint:
+                    self.hits += 1
+                    return entry["answer"]
+        self.misses += 1
+        return None
+
+    def put(
+        self, query_embedding, context_fingerprint: str, answer: str, query: str = None
+    ):
+        if query_embedding is None:
+            self._exact[(query, context_fingerprint)] = (
+                answer,
+                time.monotonic() + self.ttl_seconds,
+            )
+            if len(self._exact) > self.max_entries:
+                del self._exact[next(iter(self._exact))]  # 最も古い回答から破棄
+            return
+        self._entries.append(
+            {
+                "vector": self._unit(query_embedding),
+                "fingerprint": context_fingerprint,
+                "answer": answer,
+                "expires_at": time.monotonic() + self.ttl_seconds,
+            }
+        )
+        if len(self._entries) > self.max_entries:
+            self._entries.pop(0)  # 最も古い回答から破棄
+        self._matrix = None
+
+    def invalidate(self, *_):
+        """全回答を破棄する（商品カタログやドキュメントの更新時に呼ぶ）"""
+        if self._entries or self._exact:
+            logger.info(
+                f"[AnswerCache] invalidated {len(self._entries) + len(self._exact)} answers"
+            )
+        self._entries = []
+        self._exact = {}
+        self._matrix = None
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries) + len(self._exact),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+        }
@@ -0,0 +1,86 @@
+"""
+ロギング設定（JSON形式・リクエストIDの付与・サンプリング・非同期書き出し）
+"""
+
+import atexit
+import json
+import logging
+import queue
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+
+from settings import LOG_ASYNC, LOG_FORMAT, LOG_LEVEL
+
+# --- ロギング設定 ---
+log_formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+
+# リクエスト単位のログの相関とサンプリング用（ミドルウェアで設定する）
+request_id_var: ContextVar = ContextVar("request_id", default=None)
+trace_sampled_var: ContextVar = ContextVar("trace_sampled", default=True)
+
+
+class JsonLogFormatter(logging.Formatter):
+    """1レコードを1行のJSONとして出力する"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "request_id", None):
+            entry["request_id"] = record.request_id
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class RequestLogFilter(logging.Filter):
+    """
+    レコードにリクエストIDを付与し、サンプリング対象外のリクエストでは
+    WARNING 未満のレコードを捨てる（エラーや警告は常に出力する）
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING and not trace_sampled_var.get():
+            return False
+        record.request_id = request_id_var.get()
+        return True
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    レコードをキューに積むだけのハンドラー。標準の QueueHandler と異なり、
+    メッセージの組み立て（%s の展開を含む）もリスナーのスレッドで行う。
+    そのため、ログの引数にはログ出力後に変更されるオブジェクトを渡さないこと。
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def configure_logging():
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonLogFormatter() if LOG_FORMAT == "json" else log_formatter)
+    if LOG_ASYNC:
+        log_queue = queue.SimpleQueue()
+        listener = QueueListener(log_queue, handler)
+        listener.start()
+        # 終了時にキューに残ったレコードを書き出す
+        atexit.register(listener.stop)
+        handler = DeferredQueueHandler(log_queue)
+    logging.basicConfig(level=LOG_LEVEL, handlers=[handler])
+
+
+def log_enabled(level: int) -> bool:
+    """ログの組み立て自体を省くための判定（レベルとサンプリングの両方を見る）"""
+    return trace_sampled_var.get() and logger.isEnabledFor(level)
+
+
+# --- ロガーのセットアップ ---
+# Vercelの標準ログ出力に合わせ、フォーマットを指定
+configure_logging()
+# チャットAPIのモジュールで共有するロガー（JSONログの "logger" は "chat"）
+logger = logging.getLogger("chat")
+logger.addFilter(RequestLogFilter())
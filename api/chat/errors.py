@@ -0,0 +1,24 @@
+"""
+チャットAPIの例外クラス
+"""
+
+
+# --- カスタム例外クラス ---
+class DatabaseError(Exception):
+    """データベース関連のエラー"""
+
+    pass
+
+
+class UpstreamUnavailable(Exception):
+    """
+    上流（OpenAI / Supabase）の呼び出しを受け付けられない、または応答しない。
+    status_code: 429（同時実行数の上限と待ち行列が埋まっている） /
+    503（上流の期限切れ・レート制限）。retry_after は再試行までの目安（秒）。
+    """
+
+    def __init__(self, upstream: str, status_code: int, retry_after: int, reason: str):
+        super().__init__(f"{upstream}: {reason}")
+        self.upstream = upstream
+        self.status_code = status_code
+        self.retry_after = retry_after
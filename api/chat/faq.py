@@ -0,0 +1,221 @@
+"""
+よくある質問の高速応答（事前定義された応答と FAQ の定型回答）
+"""
+
+import asyncio
+import json
+import os
+import re
+
+import numpy as np
+
+from settings import FAQ_MAX_QUERY_CHARS
+from chat_logging import logger
+from limiters import EMBEDDING_LIMITER
+from indexes import normalize_string
+
+# --- 事前定義された応答 ---
+PREDEFINED_RESPONSES = {
+    r"ありがとう|どうも": "どういたしまして。他にご不明な点はございますか？",
+    r"こんにちは|こんばんは|やあ": "こんにちは！Showcase・コンシェルジュです。ご用の際はお気軽にお声がけください。",
+}
+
+
+# --- よくある質問の高速応答（検索・LLMを使わない定型回答） ---
+class FaqStats:
+    """
+    定型回答の照合件数と、項目の種類（faq / predefined）・段階（lexical / embedding）・
+    項目ごとのヒット数を集計する。hits・hit_ratio は FAQ の項目だけを数え、
+    挨拶などの事前定義された応答は predefined_hits に分ける
+    """
+
+    lookups = 0
+    hits: dict = {}  # (種類, 段階, 項目ID) → 件数
+
+    @classmethod
+    def record(cls, entry: dict, tier: str):
+        key = (entry["source"], tier, entry["id"])
+        cls.hits[key] = cls.hits.get(key, 0) + 1
+
+    @classmethod
+    def as_dict(cls) -> dict:
+        by_source, by_tier, by_entry = {}, {}, {}
+        for (source, tier, entry_id), count in cls.hits.items():
+            by_source[source] = by_source.get(source, 0) + count
+            by_entry[entry_id] = by_entry.get(entry_id, 0) + count
+            if source == "faq":
+                by_tier[tier] = by_tier.get(tier, 0) + count
+        faq_hits = by_source.get("faq", 0)
+        return {
+            "lookups": cls.lookups,
+            "hits": faq_hits,
+            "hit_ratio": round(faq_hits / cls.lookups, 4) if cls.lookups else 0.0,
+            "predefined_hits": by_source.get("predefined", 0),
+            "by_tier": by_tier,
+            "by_entry": dict(sorted(by_entry.items(), key=lambda item: -item[1])),
+        }
+
+
+def load_faq_entries(path: str) -> list:
+    """build_faq.py で作成した FAQ の表を読み込む（ファイルがなければ空）"""
+    if not path or not os.path.exists(path):
+        return []
+    try:
+        with open(path, encoding="utf-8") as f:
+            entries = json.load(f)
+    except Exception as e:
+        logger.warning(f"[FAQ] failed to load {path}: {e}")
+        return []
+    return [entry for entry in entries if entry.get("answer")]
+
+
+class FaqMatcher:
+    """
+    定型回答の表。挨拶などの事前定義された応答と FAQ の正規表現を名前付きグループで
+    1つの正規表現にまとめておき、正規化したクエリを1回走査するだけで該当する回答を探す。
+    埋め込みの段階では、FAQ の質問文の埋め込みとのコサイン類似度で照合する。
+    """
+
+    def __init__(self, entries: list):
+        self.entries = entries
+        self._groups = {}  # グループ名 → 項目
+        alternatives = []
+        for i, entry in enumerate(entries):
+            if not entry.get("patterns"):
+                continue
+            group = f"e{i}"
+            self._groups[group] = entry
+            body = "|".join(f"(?:{pattern})" for pattern in entry["patterns"])
+            alternatives.append(f"(?P<{group}>{body})")
+        self.pattern = re.compile("|".join(alternatives)) if alternatives else None
+        # 埋め込みの段階の照合対象（"embedding": false の項目は除く）
+        self._embeddable = [
+            entry
+            for entry in entries
+            if entry["source"] == "faq" and entry.get("embedding", True)
+        ]
+        self._vectors = {}  # 質問文 → 埋め込み（load_vectors で設定）
+        self._vector_entries = []
+        self._matrix = None
+        self._embedding_task = None
+
+    @classmethod
+    def from_sources(cls, faq_path: str):
+        """事前定義された応答（優先）と FAQ ファイルの項目から組み立てる"""
+        predefined = [
+            {
+                "id": f"predefined-{i}",
+                "answer": response,
+                "patterns": [regex],
+                "source": "predefined",
+            }
+            for i, (regex, response) in enumerate(PREDEFINED_RESPONSES.items())
+        ]
+        faq = [dict(entry, source="faq") for entry in load_faq_entries(faq_path)]
+        return cls(predefined + faq)
+
+    def match(self, query: str):
+        """
+        正規表現に該当する項目を返す。FAQ は長い質問の一部にだけ一致した場合に
+        誤答しないよう、FAQ_MAX_QUERY_CHARS 以下の短い質問に限る
+        """
+        if self.pattern is None:
+            return None
+        normalized = normalize_string(query)
+        for m in self.pattern.finditer(normalized):
+            entry = self._groups[m.lastgroup]
+            if entry["source"] == "faq" and len(normalized) > FAQ_MAX_QUERY_CHARS:
+                continue
+            return entry
+        return None
+
+    def missing_vector_entries(self) -> list:
+        """質問の埋め込みがまだない FAQ の項目"""
+        return [
+            entry
+            for entry in self._embeddable
+            if entry["question"] not in self._vectors
+        ]
+
+    def load_vectors(self, vectors: dict):
+        """質問文 → 埋め込み の対応を取り込み、照合に使う正規化済みの行列を作り直す"""
+        self._vectors.update(vectors)
+        entries = [
+            entry for entry in self._embeddable if entry["question"] in self._vectors
+        ]
+        if not entries:
+            return
+        matrix = np.stack(
+            [
+                np.asarray(self._vectors[entry["question"]], dtype=np.float32)
+                for entry in entries
+            ]
+        )
+        matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+        self._vector_entries, self._matrix = entries, matrix
+
+    async def embed_missing(self, emb) -> int:
+        """
+        ファイルになかった（質問文が変わった）FAQ の質問だけを1回の呼び出しで
+        まとめて埋め込む。返り値は埋め込んだ件数
+        """
+        questions = [entry["question"] for entry in self.missing_vector_entries()]
+        if not questions:
+            return 0
+        embeddings = await EMBEDDING_LIMITER.call(emb.aembed_documents(questions))
+        self.load_vectors(dict(zip(questions, embeddings)))
+        logger.info(f"[FAQ] embedded {len(questions)} questions")
+        return len(questions)
+
+    async def _embed_in_background(self, emb):
+        try:
+            await self.embed_missing(emb)
+        except Exception as e:
+            # 埋め込みの段階を使えないだけなので、次のリクエストで再試行する
+            logger.warning(f"[FAQ] failed to embed questions: {e}")
+
+    def schedule_embedding(self, emb):
+        """埋め込みのない質問があれば、リクエストを待たせずにバックグラウンドで埋め込む"""
+        if self._embedding_task is None or self._embedding_task.done():
+            if self.missing_vector_entries():
+                self._embedding_task = asyncio.create_task(
+                    self._embed_in_background(emb)
+                )
+
+    def match_embedding(self, query_embedding, threshold: float):
+        """クエリの埋め込みと最も近い FAQ の質問の類似度が threshold 以上ならその項目を返す"""
+        if self._matrix is None or threshold <= 0:
+            return None
+        query = np.asarray(query_embedding, dtype=np.float32)
+        similarities = self._matrix @ (query / np.linalg.norm(query))
+        best = int(np.argmax(similarities))
+        if similarities[best] < threshold:
+            return None
+        return self._vector_entries[best]
+
+
+def load_faq_vectors(path: str, model: str) -> dict:
+    """build_faq.py --embed で保存した FAQ の質問の埋め込みを読み込む（質問文 → 埋め込み）"""
+    if not path or not os.path.exists(path):
+        return {}
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            if str(data["model"]) != model:
+                logger.warning(f"[FAQ] {path} was embedded with {data['model']}")
+                return {}
+            return dict(zip(map(str, data["questions"]), data["vectors"]))
+    except Exception as e:
+        logger.warning(f"[FAQ] failed to load {path}: {e}")
+        return {}
+
+
+def save_faq_vectors(path: str, model: str, vectors: dict):
+    with open(path, "wb") as f:
+        np.savez(
+            f,
+            model=np.array(model),
+            questions=np.array(list(vectors), dtype=str),
+            vectors=np.stack(
+                [np.asarray(vector, dtype=np.float32) for vector in vectors.values()]
+            ),
+        )
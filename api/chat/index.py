@@ -1,55 +1,212 @@
 import os
 import re  # 正規表現ライブラリをインポート
 import json
+import hashlib
 import logging  # loggingをインポート
+import random
+import uuid
+import threading
+import unicodedata
+import importlib.util
 import traceback  # スタックトレース出力のためにインポート
 from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from langchain_openai import ChatOpenAI, OpenAIEmbeddings
-from supabase.client import create_client
-from postgrest import APIError  # v2の正式なエラー型をインポート
 import asyncio
-from dotenv import load_dotenv, find_dotenv
-from langchain_core.prompts import PromptTemplate
+import time
+from contextlib import aclosing, asynccontextmanager, suppress
+import sys
+
+# Vercel のランタイムは index.py をリポジトリのルートからファイルパスで読み込み、
+# api/chat を sys.path に加えない。同じディレクトリのモジュールを import できるよう先頭に加える
+# （python benchmark.py entrypoint で確認できる）
+MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
+if MODULE_DIR not in sys.path:
+    sys.path.insert(0, MODULE_DIR)
+
+from errors import DatabaseError, UpstreamUnavailable
+from settings import (
+    BATCH_CONCURRENCY,
+    BATCH_MAX_MESSAGES,
+    CHAT_ADMIN_TOKEN,
+    CONTEXT_DEDUP_THRESHOLD,
+    CONTEXT_TOKENIZER,
+    CONTEXT_TOKENIZER_DIR,
+    CONTEXT_TOKEN_BUDGET,
+    EMBEDDING_CACHE_PATH,
+    FAQ_EMBEDDINGS_PATH,
+    FAQ_EMBEDDING_THRESHOLD,
+    FAQ_PATH,
+    HTTP2_ENABLED,
+    HTTP_CONNECT_TIMEOUT_SECONDS,
+    HTTP_KEEPALIVE_EXPIRY_SECONDS,
+    HTTP_MAX_CONNECTIONS,
+    HTTP_MAX_KEEPALIVE_CONNECTIONS,
+    HTTP_POOL_TIMEOUT_SECONDS,
+    HTTP_PREWARM_CONNECTIONS,
+    HTTP_READ_TIMEOUT_SECONDS,
+    INTENT_CONFIDENCE_THRESHOLD,
+    LEXICAL_INDEX,
+    LOCAL_VECTOR_INDEX,
+    LOG_SAMPLE_RATE,
+    MATCH_COUNT,
+    MATCH_THRESHOLD,
+    SHARED_STATE_DIR,
+    VECTOR_SNAPSHOT_PATH,
+    WARMUP_ON_STARTUP,
+)
+from chat_logging import log_enabled, logger, request_id_var, trace_sampled_var
+from metrics import (
+    REQUEST_LATENCY,
+    STAGE_LATENCY,
+    TokenUsage,
+    format_server_timing,
+    mark_degraded,
+    request_timings_var,
+    span,
+    traced,
+)
+from limiters import (
+    EMBEDDING_LIMITER,
+    LLM_LIMITER,
+    SUPABASE_LIMITER,
+    SingleFlight,
+    UPSTREAM_LIMITERS,
+    discard_task,
+    gather_or_cancel,
+)
+from shared_state import SharedState
+from indexes import (
+    LexicalIndex,
+    LexicalStats,
+    LocalVectorIndex,
+    ProductCatalog,
+    format_product_context,
+    normalize_string,
+    reciprocal_rank_fusion,
+)
+from caches import AnswerCache, EmbeddingCache
+from faq import FaqMatcher, FaqStats, load_faq_vectors
 
+# --- プロンプト（チェーンは初期化時に1度だけ組み立てる） ---
+ANSWER_PROMPT_TEMPLATE = """
+    あなたは、企業の製品やサービスについて回答する、親切で優秀なAIアシスタント「Showcase・コンシェルジュ」です。
+    以下のルールを厳密に守って、ユーザーの質問に日本語で回答してください。
 
-# --- カスタム例外クラス ---
-class DatabaseError(Exception):
-    """データベース関連のエラー"""
+    # ルール
+    - 誠実で、丁寧な言葉遣いを徹底してください。
+    - 提供された「コンテキスト情報」に書かれている事実のみに基づいて回答してください。
+    - 感謝の言葉や挨拶以外の、定型的な応答（例：「他にご不明な点はございますか？」）は不要です。自然な会話を心がけてください。
+    - コンテキスト情報に記載のない事柄については、「恐れ入れますが、その件に関する情報は持ち合わせておりません。」と正直に回答してください。
+    - 例外として、「プライバシーポリシー」や「利用規約」に関する情報が見つからなかった場合に限り、「プライバシーポリシーや利用規約については、お問い合わせページをご確認いただけます。」と案内してください。
+    - 回答は、まず結論から述べ、その後に理由や詳細を簡潔に説明してください。
 
-    pass
+    # コンテキスト情報
+    {context}
 
+    # ユーザーの質問
+    {question}
 
-# --- 設定定数 ---
-MATCH_THRESHOLD = 0.05
-MATCH_COUNT = 5
+    # 回答
+    """
+
+INTENT_PROMPT_TEMPLATE = """あなたはユーザーの質問を分析するAIです。価格に関する質問かどうかを判定してください。
 
-# --- .envファイルのパスを動的に検索して読み込む ---
-dotenv_path = find_dotenv()
-if dotenv_path:
-    load_dotenv(dotenv_path=dotenv_path, override=True)
-else:
-    load_dotenv(override=True)  # フォールバック
+質問: {query}
 
-# --- ロギング設定 ---
-log_formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+以下のキーワードが含まれる場合は必ず価格比較と判定してください：
+- 安い、安価、低価格、お手頃、コスパ、予算、格安、リーズナブル
+- 高い、高価、高額、プレミアム、高級、値段が張る
+- 価格、値段、料金
+
+JSON形式で回答してください：
 
-# --- ロガーのセットアップ ---
-# Vercelの標準ログ出力に合わせ、フォーマットを指定
-logging.basicConfig(
-    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+価格に関する質問の場合:
+{{"type": "price_comparison", "sort": "asc or desc", "limit": 数値}}
+- sort: "asc"（安い系のキーワード）または "desc"（高い系のキーワード）
+- limit: 数値が明示されている場合はその数、なければ1
+
+価格に関係ない質問の場合:
+{{"type": "none"}}
+
+例:
+「安いアプリ」→ {{"type": "price_comparison", "sort": "asc", "limit": 1}}
+「コスパの良いアプリ3つ」→ {{"type": "price_comparison", "sort": "asc", "limit": 3}}
+「低価格アプリ5つ」→ {{"type": "price_comparison", "sort": "asc", "limit": 5}}
+「一番安いアプリは？」→ {{"type": "price_comparison", "sort": "asc", "limit": 1}}
+「使い方を教えて」→ {{"type": "none"}}
+
+JSONのみ回答:
+"""
+# LLMの応答からJSON部分を抽出する（マークダウンのコードブロックなどを除去）
+JSON_OBJECT_PATTERN = re.compile(r"\{.*\}", re.DOTALL)
+
+# --- 価格関連キーワードと件数抽出パターン ---
+PRICE_ASC_KEYWORDS = [
+    "安い",
+    "安価",
+    "低価格",
+    "手頃",
+    "コスパ",
+    "予算",
+    "格安",
+    "リーズナブル",
+]
+PRICE_DESC_KEYWORDS = ["高い", "高価", "高額", "プレミアム", "高級", "値段が張る"]
+PRICE_SUPERLATIVE_PATTERN = re.compile(
+    r"(一番|最も|いちばん)(安|高)|最安|最高値|(安い|高い)順|(安|高)い?もの?から"
+)
+# 「価格」「料金」のように価格の話題ではあるが、比較かどうか・並び順が決まらない語
+PRICE_TOPIC_PATTERN = re.compile(r"価格|値段|料金|費用|コスト|円|¥|￥|無料")
+# キーワードに当たらない価格の言い回し（「安く」「安め」「高め」「価格帯」など）に含まれる字
+PRICE_STEM_PATTERN = re.compile(r"[安高価値]")
+# 価格の字を含むが価格とは関係のない語（PRICE_STEM_PATTERN の判定から除く）
+NON_PRICE_STEM_PATTERN = re.compile(
+    r"安全|安心|安定|不安|高速|高性能|高機能|高精度|高画質|最高(?!値)|評価|価値|数値"
+)
+# 「評価が高い」「機能が高い」など価格以外の高低を表す語
+NON_PRICE_QUALIFIER_PATTERN = re.compile(
+    r"評価|人気|性能|機能|満足度|評判|精度|品質|レビュー"
+)
+COUNT_PATTERN = re.compile(
+    r"(\d+)\s*(つ|個|件)|(?:商品|製品|もの|アプリ)\s*(\d+)\s*(?:つ|個|件)?|トップ\s*(\d+)"
+)
+# 金額（NFKC正規化後）。算用数字と漢数字（「1万5千」「一万」「三千五百」など）を含み、
+# 「¥」「円」が付くか「万」「千」を含むものだけを金額とみなす
+PRICE_AMOUNT_PATTERN = re.compile(
+    r"(¥)?\s*((?:\d[\d,]*(?:\.\d+)?|[〇一二三四五六七八九十百千万])+)\s*(円)?"
 )
-logger = logging.getLogger(__name__)
+AMOUNT_TOKEN_PATTERN = re.compile(r"\d+(?:\.\d+)?|[〇一二三四五六七八九十百千万]")
+KANJI_DIGITS = {digit: value for value, digit in enumerate("〇一二三四五六七八九")}
+KANJI_UNITS = {"十": 10, "百": 100, "千": 1000}
+# 金額の直後に続く条件の表現
+PRICE_UPPER_PATTERN = re.compile(r"\s*(以下|以内|まで|未満|を?切る|より(安|下))")
+PRICE_LOWER_PATTERN = re.compile(r"\s*(以上|超|から|より(高|上))")
+PRICE_AROUND_PATTERN = re.compile(r"\s*(前後|くらい|ぐらい|程度|位|付近|近辺|ほど)")
+PRICE_RANGE_SEPARATOR_PATTERN = re.compile(r"\s*(から|〜|~|-|ー)\s*")
+PRICE_BUDGET_PATTERN = re.compile(r"予算(は|が)?\s*$")
+# 価格帯の質問で件数の指定がない場合に返す件数
+PRICE_RANGE_DEFAULT_LIMIT = 5
 
-# --- 事前定義された応答 ---
-PREDEFINED_RESPONSES = {
-    r"ありがとう|どうも": "どういたしまして。他にご不明な点はございますか？",
-    r"こんにちは|こんばんは|やあ": "こんにちは！Showcase・コンシェルジュです。ご用の際はお気軽にお声がけください。",
-}
 
 # --- FastAPIアプリとミドルウェア ---
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 起動時: 最初のリクエストを待たずに、バックグラウンドで初期化を済ませておく
+    warmup_task = asyncio.create_task(warm_up()) if WARMUP_ON_STARTUP else None
+    yield
+    if warmup_task:
+        discard_task(warmup_task)
+    chatbot = ChatbotSingleton._instance
+    if chatbot:
+        # 終了時: クエリ埋め込みキャッシュをディスクに保存してから接続を閉じる
+        if chatbot.embedding_cache and EMBEDDING_CACHE_PATH:
+            await chatbot.embedding_cache.wait_persisted()
+            chatbot.embedding_cache.save(EMBEDDING_CACHE_PATH)
+        await chatbot.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -59,30 +216,193 @@ app.add_middleware(
 )
 
 
-# --- ヘルパー関数: 高度な文字列正規化 ---
-def normalize_string(text: str) -> str:
-    """スペース、改行、タブなどの空白をすべて除去し、小文字に変換する"""
-    if not text:
-        return ""
-    # \s+ は1つ以上の任意の空白文字（スペース、タブ、改行など）にマッチ
-    text = re.sub(r"\s+", "", text)
-    return text.lower()
+@app.middleware("http")
+async def request_context_middleware(request: Request, call_next):
+    """
+    リクエストIDの付与とログのサンプリング判定を行い、
+    ステージごとの所要時間を Server-Timing ヘッダーで返してヒストグラムに集計する
+    """
+    request_id = request.headers.get("x-request-id") or uuid.uuid4().hex[:16]
+    request_id_var.set(request_id)
+    trace_sampled_var.set(random.random() < LOG_SAMPLE_RATE)
+
+    timings = {}
+    token = request_timings_var.set(timings)
+    started = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        request_timings_var.reset(token)
+    timings["total"] = time.perf_counter() - started
+
+    # ストリーミングではヘッダー送信時点までの計測になる（全体は done イベントで返す）
+    route = request.scope.get("route")
+    REQUEST_LATENCY.observe(route.path if route else "other", timings["total"])
+    response.headers["Server-Timing"] = format_server_timing(timings)
+    response.headers["X-Request-ID"] = request_id
+    response.headers["Timing-Allow-Origin"] = "*"
+    return response
+
+
+# --- 上流とのHTTP接続プール（OpenAI / Supabase のクライアントで共有） ---
+class HttpPool:
+    """
+    上流ごとに1つの httpx.AsyncClient を持ち、keep-alive（対応していれば HTTP/2）で
+    接続を使い回す。リクエスト数・新規接続数・空き接続待ちの回数を集計する。
+    """
+
+    def __init__(self, name: str, base_url: str):
+        import httpx
+
+        self.name = name
+        self.base_url = base_url
+        self.http2 = HTTP2_ENABLED and importlib.util.find_spec("h2") is not None
+        self.max_connections = HTTP_MAX_CONNECTIONS
+        self._transport = httpx.AsyncHTTPTransport(
+            http2=self.http2,
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY_SECONDS,
+            ),
+        )
+        self.client = httpx.AsyncClient(
+            transport=self._transport,
+            timeout=httpx.Timeout(
+                HTTP_READ_TIMEOUT_SECONDS,
+                connect=HTTP_CONNECT_TIMEOUT_SECONDS,
+                pool=HTTP_POOL_TIMEOUT_SECONDS,
+            ),
+            follow_redirects=True,
+            event_hooks={"request": [self._on_request]},
+        )
+        self.requests = 0
+        self.waits = 0  # 全接続が使用中で、空きを待つことになったリクエスト数
+        self.connections_opened = 0
+        self.tls_handshakes = 0
+
+    def _connections(self) -> list:
+        # httpx は接続プールを公開していないため、内部の httpcore のプールを参照する
+        pool = getattr(self._transport, "_pool", None)
+        return list(pool.connections) if pool is not None else []
+
+    async def _on_request(self, request):
+        self.requests += 1
+        connections = self._connections()
+        if len(connections) >= self.max_connections and not any(
+            connection.is_available() for connection in connections
+        ):
+            self.waits += 1
+        request.extensions["trace"] = self._trace
+
+    async def _trace(self, event_name: str, info: dict):
+        if event_name == "connection.connect_tcp.complete":
+            self.connections_opened += 1
+        elif event_name == "connection.start_tls.complete":
+            self.tls_handshakes += 1
+
+    async def prewarm(self, count: int, headers: dict = None) -> int:
+        """
+        HEAD リクエストで接続（TCP + TLS）を確立しておく。応答のステータスは問わない。
+        確立できた接続数（HTTP/2 では1本に多重化される）を返す。
+        """
+        results = await asyncio.gather(
+            *(self.client.head(self.base_url, headers=headers) for _ in range(count)),
+            return_exceptions=True,
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                logger.warning(f"[HttpPool] {self.name} prewarm failed: {result}")
+        return len(self._connections())
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    def stats(self) -> dict:
+        connections = self._connections()
+        idle = sum(1 for connection in connections if connection.is_idle())
+        return {
+            "http2": self.http2,
+            "max_connections": self.max_connections,
+            "connections": len(connections),
+            "in_use": len(connections) - idle,
+            "idle": idle,
+            "requests": self.requests,
+            "waits": self.waits,
+            "connections_opened": self.connections_opened,
+            "tls_handshakes": self.tls_handshakes,
+            "reuse_ratio": (
+                round(1 - self.connections_opened / self.requests, 4)
+                if self.requests
+                else 0.0
+            ),
+        }
 
 
 # --- LangChainコンポーネントのシングルトン管理 ---
+def import_upstream_clients():
+    """
+    OpenAI / Supabase のクライアントを読み込む。合わせて数秒かかることがあるため、
+    モジュールの読み込み時ではなく初期化時（ウォームアップまたは最初のリクエスト）まで遅らせる
+    """
+    from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+    from supabase import AsyncClientOptions, acreate_client
+
+    return ChatOpenAI, OpenAIEmbeddings, acreate_client, AsyncClientOptions
+
+
+def build_answer_chain(llm):
+    """コンテキストと質問から回答を生成するチェーンを組み立てる"""
+    from langchain_core.prompts import PromptTemplate
+
+    prompt = PromptTemplate(
+        template=ANSWER_PROMPT_TEMPLATE, input_variables=["context", "question"]
+    )
+    return prompt | llm
+
+
+def build_intent_chain(llm):
+    """質問が価格比較かどうかをLLMで判定するチェーンを組み立てる"""
+    from langchain_core.prompts import PromptTemplate
+
+    prompt = PromptTemplate(template=INTENT_PROMPT_TEMPLATE, input_variables=["query"])
+    return prompt | llm
+
+
 class ChatbotSingleton:
     _instance = None
-    _lock = asyncio.Lock()
+    # asyncio.Lock は最初に使ったイベントループに結び付くため、ループごとに作る
+    _lock = None
+    _lock_loop = None
 
     llm = None
     emb = None
     supabase_client = None
+    answer_chain = None
+    intent_chain = None
+    http_pools = None  # 上流名 → HttpPool
+    catalog = None
+    embedding_cache = None
+    answer_cache = None
+    vector_index = None
+    token_counter = None
+    inflight = None
+    faq = None
+    lexical_index = None
+    shared_state = None
     init_error = None
 
+    @classmethod
+    def _get_lock(cls) -> asyncio.Lock:
+        loop = asyncio.get_running_loop()
+        if cls._lock_loop is not loop:
+            cls._lock, cls._lock_loop = asyncio.Lock(), loop
+        return cls._lock
+
     @classmethod
     async def get_instance(cls):
         if cls._instance is None:
-            async with cls._lock:
+            async with cls._get_lock():
                 if cls._instance is None:
                     instance = cls()
                     await instance._initialize()
@@ -105,13 +425,45 @@ class ChatbotSingleton:
                 raise ValueError(f"環境変数が未設定です: {', '.join(missing_vars)}")
             logger.info("環境変数チェックOK")
 
+            # import はブロッキングなので、その間もイベントループが他の処理を進められるようにする
+            (
+                ChatOpenAI,
+                OpenAIEmbeddings,
+                acreate_client,
+                AsyncClientOptions,
+            ) = await asyncio.to_thread(import_upstream_clients)
+
+            # LLMと埋め込みは同じ接続プールを共有し、Supabase は別のプールを使う
+            self.http_pools = {
+                "openai": HttpPool(
+                    "openai",
+                    os.environ.get("OPENAI_BASE_URL", "https://api.openai.com/v1"),
+                ),
+                "supabase": HttpPool("supabase", f"{SUPABASE_URL}/rest/v1/"),
+            }
+            openai_http = self.http_pools["openai"].client
             self.llm = ChatOpenAI(
-                model="gpt-4o-mini", temperature=0.1, openai_api_key=OPENAI_API_KEY
+                model="gpt-4o-mini",
+                temperature=0.1,
+                openai_api_key=OPENAI_API_KEY,
+                # ストリーミング時も最後のチャンクでトークン数を受け取る
+                stream_usage=True,
+                http_async_client=openai_http,
             )
             self.emb = OpenAIEmbeddings(
-                model="text-embedding-3-small", openai_api_key=OPENAI_API_KEY
+                model="text-embedding-3-small",
+                openai_api_key=OPENAI_API_KEY,
+                http_async_client=openai_http,
+            )
+            # 非同期クライアントを使い、DBアクセス中もイベントループをブロックしない
+            self.supabase_client = await acreate_client(
+                SUPABASE_URL,
+                SUPABASE_KEY,
+                options=AsyncClientOptions(
+                    httpx_client=self.http_pools["supabase"].client
+                ),
             )
-            self.supabase_client = create_client(SUPABASE_URL, SUPABASE_KEY)
+            self._init_caches()
             logger.info("--- Chatbot初期化正常完了 ---")
 
         except Exception as e:
@@ -119,57 +471,268 @@ class ChatbotSingleton:
             logger.error(f"!!! {self.init_error} !!!")
             logger.error(traceback.format_exc())  # トレースバックもログに出力
 
+    async def prewarm_connections(self) -> dict:
+        """上流ごとに接続を確立しておく。返り値は上流ごとの接続数"""
+        if not self.http_pools:
+            return {}
+        counts = await asyncio.gather(
+            *(
+                pool.prewarm(HTTP_PREWARM_CONNECTIONS)
+                for pool in self.http_pools.values()
+            )
+        )
+        return dict(zip(self.http_pools, counts))
+
+    async def aclose(self):
+        """接続プールと公開担当のロックを閉じる（プロセス終了時）"""
+        for pool in (self.http_pools or {}).values():
+            await pool.aclose()
+        if self.shared_state:
+            self.shared_state.close()
+
+    def _init_caches(self):
+        """クライアント生成後に、それらを使うチェーンやキャッシュ類を構築する"""
+        self.answer_chain = build_answer_chain(self.llm)
+        self.intent_chain = build_intent_chain(self.llm)
+        if SHARED_STATE_DIR:
+            self.shared_state = SharedState(SHARED_STATE_DIR)
+        self.catalog = ProductCatalog(self.supabase_client, shared=self.shared_state)
+        self.embedding_cache = EmbeddingCache(persist_path=EMBEDDING_CACHE_PATH)
+        if EMBEDDING_CACHE_PATH:
+            self.embedding_cache.load(EMBEDDING_CACHE_PATH)
+        # 商品の価格などが変わったら古い回答を返さないよう破棄する
+        self.answer_cache = AnswerCache()
+        self.catalog.add_listener(self.answer_cache.invalidate)
+        self.token_counter = TokenCounter()
+        self.inflight = SingleFlight()
+        if LEXICAL_INDEX:
+            self.lexical_index = LexicalIndex(
+                self.supabase_client, self.catalog, shared=self.shared_state
+            )
+            self.catalog.add_listener(self.lexical_index.invalidate)
+        self.faq = FaqMatcher.from_sources(FAQ_PATH)
+        if FAQ_EMBEDDING_THRESHOLD > 0:
+            self.faq.load_vectors(load_faq_vectors(FAQ_EMBEDDINGS_PATH, self.emb.model))
+        if LOCAL_VECTOR_INDEX:
+            self.vector_index = LocalVectorIndex(
+                self.supabase_client,
+                snapshot_path=VECTOR_SNAPSHOT_PATH,
+                shared=self.shared_state,
+            )
+            self.catalog.add_listener(self.vector_index.invalidate)
+            if self.shared_state:
+                # 他のワーカーが公開したドキュメントの変更でも回答キャッシュを破棄する
+                self.vector_index.add_listener(self.answer_cache.invalidate)
+
+
+# --- ローカル意図分類（キーワード + 正規表現） ---
+def extract_requested_count(query: str):
+    """「3つ」「商品5個」「トップ3」などの件数指定を抽出する。指定がなければNone"""
+    count_match = COUNT_PATTERN.search(query)
+    if not count_match:
+        return None
+    return int(count_match.group(1) or count_match.group(3) or count_match.group(4))
+
+
+def parse_amount(text: str) -> float:
+    """「5,000」「1.5万」「1万5千」「千」「三千五百」などの金額の表記を数値にする"""
+    total = section = 0
+    number = None
+    for token in AMOUNT_TOKEN_PATTERN.findall(text.replace(",", "")):
+        if token in KANJI_DIGITS:
+            # 「二〇〇〇」のような位取りの漢数字にも対応する
+            digit = KANJI_DIGITS[token]
+            number = digit if number is None else number * 10 + digit
+        elif token in KANJI_UNITS:
+            section += (1 if number is None else number) * KANJI_UNITS[token]
+            number = None
+        elif token == "万":
+            total += (section + (number or 0) or 1) * 10000
+            section, number = 0, None
+        else:
+            number = float(token)
+    return float(total + section + (number or 0))
 
-# --- クエリ意図分析（LLM使用） ---
-async def analyze_query_intent(chatbot: ChatbotSingleton, query: str) -> dict:
+
+def _is_amount(match) -> bool:
+    return bool(match.group(1) or match.group(3)) or any(
+        unit in match.group(2) for unit in "万千"
+    )
+
+
+def parse_price_range(query: str):
     """
-    LLMを使ってクエリの意図を分析
-    返り値: {"type": "price_comparison", "sort": "asc/desc", "limit": int} or None
+    「1万円以下」「3000円以上」「5千円〜1万円」「¥5,000前後」「予算2万円」
+    「千円以下」「一万円以内」などの価格条件を抽出する。条件がなければNone。
+    返り値: {"min", "min_inclusive", "max", "max_inclusive"} または {"around"}
     """
-    intent_prompt = PromptTemplate(
-        template="""あなたはユーザーの質問を分析するAIです。価格に関する質問かどうかを判定してください。
+    text = unicodedata.normalize("NFKC", query)
+    amounts = [
+        match for match in PRICE_AMOUNT_PATTERN.finditer(text) if _is_amount(match)
+    ]
+    price_range = {}
+    for i, match in enumerate(amounts):
+        value = parse_amount(match.group(2))
+        rest = text[match.end() :]
+        next_match = amounts[i + 1] if i + 1 < len(amounts) else None
+        separator = PRICE_RANGE_SEPARATOR_PATTERN.match(rest)
+        if (
+            separator
+            and next_match
+            and match.end() + separator.end() == next_match.start()
+        ):
+            # 「5千円〜1万円」: 範囲の下限。上限は次の金額で判定する
+            price_range.update(min=value, min_inclusive=True)
+            price_range.setdefault("max", parse_amount(next_match.group(2)))
+            price_range.setdefault("max_inclusive", True)
+        elif upper := PRICE_UPPER_PATTERN.match(rest):
+            exclusive = upper.group(1) in ("未満", "切る", "を切る") or upper.group(2)
+            price_range.update(max=value, max_inclusive=not exclusive)
+        elif lower := PRICE_LOWER_PATTERN.match(rest):
+            exclusive = lower.group(1) == "超" or lower.group(2)
+            price_range.update(min=value, min_inclusive=not exclusive)
+        elif PRICE_AROUND_PATTERN.match(rest):
+            return {"around": value}
+        elif PRICE_BUDGET_PATTERN.search(text[: match.start()]):
+            price_range.update(max=value, max_inclusive=True)
+    return price_range or None
+
+
+def format_price_range(price_range: dict) -> str:
+    """価格条件を回答文用の表現にする（例: ¥5,000〜¥10,000）"""
+    if "around" in price_range:
+        return f"¥{price_range['around']:,.0f}前後"
+    low, high = price_range.get("min"), price_range.get("max")
+    if low is not None and high is not None:
+        return f"¥{low:,.0f}〜¥{high:,.0f}"
+    if high is not None:
+        return f"¥{high:,.0f}{'以下' if price_range['max_inclusive'] else '未満'}"
+    return f"¥{low:,.0f}{'以上' if price_range['min_inclusive'] else '超'}"
+
+
+def classify_intent_locally(query: str) -> dict:
+    """
+    キーワードと正規表現だけでクエリの意図を判定する（LLM呼び出しなし）。
+    返り値: {"type": ..., "sort": ..., "limit": ..., "confidence": 0.0〜1.0}
+    """
+    has_asc = any(k in query for k in PRICE_ASC_KEYWORDS)
+    has_desc = any(k in query for k in PRICE_DESC_KEYWORDS)
+    price_range = parse_price_range(query)
+
+    if price_range and not (has_asc and has_desc):
+        # 「1万円以下のアプリ」「5000円前後で高いもの」など価格帯の指定
+        is_superlative = PRICE_SUPERLATIVE_PATTERN.search(query)
+        requested = extract_requested_count(query)
+        default_limit = 1 if is_superlative else PRICE_RANGE_DEFAULT_LIMIT
+        return {
+            "type": "price_comparison",
+            "sort": "desc" if has_desc else "asc",
+            "limit": min(max(requested or default_limit, 1), 10),
+            "range": price_range,
+            "confidence": 0.5 if NON_PRICE_QUALIFIER_PATTERN.search(query) else 0.9,
+        }
+
+    if not has_asc and not has_desc:
+        superlative_sorts = {
+            "asc" if "安" in match.group(0) else "desc"
+            for match in PRICE_SUPERLATIVE_PATTERN.finditer(query)
+        }
+        if len(superlative_sorts) == 1:
+            # 「最安のアプリ」「最高値の商品」など「安い」「高い」を伴わない最上級
+            return {
+                "type": "price_comparison",
+                "sort": superlative_sorts.pop(),
+                "limit": min(max(extract_requested_count(query) or 1, 1), 10),
+                "confidence": 0.95,
+            }
+        if (
+            superlative_sorts
+            or PRICE_TOPIC_PATTERN.search(query)
+            or PRICE_STEM_PATTERN.search(NON_PRICE_STEM_PATTERN.sub("", query))
+        ):
+            # 価格の話題だが並び順が読み取れない（例: 「AppBuzzの料金は？」
+            # 「安く買えるアプリ」）。LLMに判定させる
+            return {"type": "none", "confidence": 0.4}
+        return {"type": "none", "confidence": 0.9}
+
+    if has_asc and has_desc:
+        # 「安いのと高いの」など両方向のキーワードが混在
+        return {"type": "none", "confidence": 0.3}
+
+    limit = min(max(extract_requested_count(query) or 1, 1), 10)
+    intent = {
+        "type": "price_comparison",
+        "sort": "asc" if has_asc else "desc",
+        "limit": limit,
+    }
+    if PRICE_SUPERLATIVE_PATTERN.search(query):
+        intent["confidence"] = 0.95
+    elif NON_PRICE_QUALIFIER_PATTERN.search(query):
+        # 「評価が高いアプリ」のように価格以外の高低の可能性がある
+        intent["confidence"] = 0.5
+    else:
+        intent["confidence"] = 0.85
+    return intent
 
-質問: {query}
 
-以下のキーワードが含まれる場合は必ず価格比較と判定してください：
-- 安い、安価、低価格、お手頃、コスパ、予算、格安、リーズナブル
-- 高い、高価、高額、プレミアム、高級、値段が張る
-- 価格、値段、料金
+class IntentStats:
+    """ローカル判定で完結した件数とLLMにフォールバックした件数を集計する"""
 
-JSON形式で回答してください：
+    fast_path = 0
+    llm_fallback = 0
+    degraded = 0  # LLMの混雑で意図分析のLLM呼び出しを省略した件数
 
-価格に関する質問の場合:
-{{"type": "price_comparison", "sort": "asc or desc", "limit": 数値}}
-- sort: "asc"（安い系のキーワード）または "desc"（高い系のキーワード）
-- limit: 数値が明示されている場合はその数、なければ1
+    @classmethod
+    def as_dict(cls) -> dict:
+        total = cls.fast_path + cls.llm_fallback
+        return {
+            "fast_path": cls.fast_path,
+            "llm_fallback": cls.llm_fallback,
+            "degraded": cls.degraded,
+            "fast_path_ratio": round(cls.fast_path / total, 4) if total else 0.0,
+        }
 
-価格に関係ない質問の場合:
-{{"type": "none"}}
 
-例:
-「安いアプリ」→ {{"type": "price_comparison", "sort": "asc", "limit": 1}}
-「コスパの良いアプリ3つ」→ {{"type": "price_comparison", "sort": "asc", "limit": 3}}
-「低価格アプリ5つ」→ {{"type": "price_comparison", "sort": "asc", "limit": 5}}
-「一番安いアプリは？」→ {{"type": "price_comparison", "sort": "asc", "limit": 1}}
-「使い方を教えて」→ {{"type": "none"}}
+# --- クエリ意図分析（ローカル判定 + 曖昧な場合のみLLM） ---
+async def analyze_query_intent(chatbot: ChatbotSingleton, query: str) -> dict:
+    """
+    クエリの意図を分析する。ローカル判定の確信度が閾値以上ならそのまま返し、
+    曖昧な場合のみLLMで分析する。
+    返り値: {"type": "price_comparison", "sort": "asc/desc", "limit": int} or {"type": "none"}
+    """
+    local_intent = classify_intent_locally(query)
+    if local_intent["confidence"] >= INTENT_CONFIDENCE_THRESHOLD:
+        IntentStats.fast_path += 1
+        logger.info("[Intent Analysis] Local: '%s' → %s", query, local_intent)
+        return local_intent
+
+    if LLM_LIMITER.is_congested:
+        # LLMの待ち行列が長い間は最終回答の生成を優先し、意図分析のLLM呼び出しを省略する
+        # （LLMが失敗した場合と同じく、価格キーワードによるフォールバック判定に任せる）
+        LLM_LIMITER.degraded += 1
+        IntentStats.degraded += 1
+        mark_degraded("intent")
+        logger.warning("[Intent Analysis] LLM is congested, skipping: '%s'", query)
+        return {"type": "none"}
 
-JSONのみ回答:
-""",
-        input_variables=["query"],
+    IntentStats.llm_fallback += 1
+    logger.info(
+        f"[Intent Analysis] Local confidence {local_intent['confidence']} below threshold, falling back to LLM"
     )
-
     try:
-        chain = intent_prompt | chatbot.llm
-        response = await chain.ainvoke({"query": query})
+        response = await LLM_LIMITER.call(
+            chatbot.intent_chain.ainvoke({"query": query})
+        )
+        TokenUsage.record("intent", response)
 
         # JSONを抽出（マークダウンのコードブロックなどを除去）
         content = response.content.strip()
-        json_match = re.search(r"\{.*\}", content, re.DOTALL)
+        json_match = JSON_OBJECT_PATTERN.search(content)
         if json_match:
             content = json_match.group(0)
 
         intent_data = json.loads(content)
-        logger.info(f"[Intent Analysis] Query: '{query}' → {intent_data}")
+        logger.info("[Intent Analysis] Query: '%s' → %s", query, intent_data)
         return intent_data
     except Exception as e:
         logger.warning(f"[Intent Analysis] Failed for '{query}': {e}")
@@ -179,395 +742,1225 @@ JSONのみ回答:
         return {"type": "none"}
 
 
-# --- 回答生成ロジック ---
-async def generate_final_answer(chatbot: ChatbotSingleton, query: str):
-    # この関数内のエラーは呼び出し元(handle_chat)に伝播させ、そこで一元的に処理します。
-    logger.info("--- answering_process_started ---")
-    logger.info(f"1. raw_query: '{query}'")
+# --- 価格比較クエリへの回答 ---
+# LLM/ローカル判定で価格比較とならなかった場合にも拾うフォールバック用キーワード
+FALLBACK_PRICE_DESC_KEYWORDS = ["一番高い", "最も高い", "高い", "高価格", "高額"]
+FALLBACK_PRICE_ASC_KEYWORDS = ["一番安い", "最も安い", "安い", "低価格"]
+
+
+def is_price_query(query: str, intent: dict) -> bool:
+    """answer_price_query で回答すべきクエリかどうか（DBアクセスなしで判定）"""
+    return intent.get("type") == "price_comparison" or any(
+        keyword in query
+        for keyword in FALLBACK_PRICE_DESC_KEYWORDS + FALLBACK_PRICE_ASC_KEYWORDS
+    )
 
-    # --- 0. 事前定義された応答のチェック ---
-    normalized_query_for_greeting = normalize_string(query)
-    for regex, response in PREDEFINED_RESPONSES.items():
-        if re.search(regex, normalized_query_for_greeting):
-            logger.info(f"✅ Predefined response found for '{query}'")
-            return response
 
-    # --- 1. LLMによる意図分析 ---
-    intent = await analyze_query_intent(chatbot, query)
-    logger.info(f"[Intent] Detected: {intent}")
+def is_local_price_query(query: str) -> bool:
+    """
+    LLMを呼ばずに is_price_query と確定するクエリかどうか（検索・埋め込みが不要）。
+    ローカル判定の確信度が閾値未満なら、意図分析を省略した場合と同じくキーワードだけで判定する
+    """
+    intent = classify_intent_locally(query)
+    if intent["confidence"] < INTENT_CONFIDENCE_THRESHOLD:
+        intent = {"type": "none"}
+    return is_price_query(query, intent)
 
-    if intent.get("type") == "price_comparison":
-        logger.info("価格比較クエリを検出（LLM分析）")
-        # 1) LLM解析結果をベースにしつつ、質問文から件数/並び順を再判定して上書き（堅牢化）
-        # 件数の明示指定（例: 3つ/5個/商品3つ/トップ3 など）を正規表現で抽出
-        count_match = re.search(
-            r"(\d+)\s*(つ|個|件)|(?:商品|製品|もの|アプリ)\s*(\d+)\s*(?:つ|個|件)?|トップ\s*(\d+)",
-            query,
-        )
-        extracted_count = None
-        if count_match:
-            try:
-                extracted_count = int(
-                    count_match.group(1) or count_match.group(3) or count_match.group(4)
-                )
-            except Exception:
-                extracted_count = None
-        # LLMのlimit → 正規表現の順で採用し、最大10件にクランプ
-        limit = intent.get("limit") or extracted_count or 1
-        limit = min(max(int(limit), 1), 10)
 
-        # 並び順はLLMの結果を優先しつつ、未指定/誤判定時はキーワードから補正
+def plan_price_query(query: str, intent: dict) -> dict:
+    """
+    意図分析の結果と質問文から、並び順・件数・価格条件を決める。
+    LLMの結果も質問文からの再判定で補正する（堅牢化）。
+    """
+    price_range = intent.get("range") or parse_price_range(query)
+    if intent.get("type") == "price_comparison":
         sort_order = intent.get("sort")
-        if sort_order not in ("asc", "desc"):
-            asc_keywords = ["安", "低価格", "お手頃", "コスパ", "格安", "リーズナブル"]
-            desc_keywords = ["高", "高価", "高額", "プレミアム", "高級"]
-            if any(k in query for k in asc_keywords):
-                sort_order = "asc"
-            elif any(k in query for k in desc_keywords):
-                sort_order = "desc"
-            else:
-                sort_order = "asc"  # デフォルトは安い順
-
-        # データベースから価格順に商品を取得
-        is_desc = sort_order == "desc"
-        result = (
-            chatbot.supabase_client.from_("products")
-            .select("name, price")
-            .gt("price", 0)
-            .order("price", desc=is_desc)
-            .limit(limit)
-            .execute()
+        limit = intent.get("limit") or extract_requested_count(query)
+    else:
+        # LLM/ローカル判定で価格比較とならなかったがキーワードが含まれる場合
+        sort_order = (
+            "desc"
+            if any(keyword in query for keyword in FALLBACK_PRICE_DESC_KEYWORDS)
+            else "asc"
         )
+        limit = extract_requested_count(query)
+
+    # 並び順が未指定/誤判定の場合はキーワードから補正
+    if sort_order not in ("asc", "desc"):
+        if any(k in query for k in ["安"] + PRICE_ASC_KEYWORDS):
+            sort_order = "asc"
+        elif any(k in query for k in ["高"] + PRICE_DESC_KEYWORDS):
+            sort_order = "desc"
+        else:
+            sort_order = "asc"  # デフォルトは安い順
+
+    if not limit:
+        limit = PRICE_RANGE_DEFAULT_LIMIT if price_range else 1
+    # 最大10件にクランプ
+    limit = min(max(int(limit), 1), 10)
+    return {"sort": sort_order, "limit": limit, "range": price_range}
+
+
+def format_price_answer(products: list, plan: dict) -> str:
+    """価格順の検索結果から回答文を組み立てる"""
+    price_range = plan["range"]
+    is_desc = plan["sort"] == "desc"
+    condition = format_price_range(price_range) if price_range else None
+
+    if not products:
+        if condition:
+            return f"申し訳ありません、{condition}の製品は見つかりませんでした。"
+        return "申し訳ありません、現在価格情報のある商品が見つかりませんでした。"
+
+    if len(products) == 1 and plan["limit"] == 1:
+        product = products[0]
+        price_desc = "最も価格が高い" if is_desc else "最も価格が安い"
+        if condition and "around" in price_range:
+            price_desc = f"{condition}で最も近い価格の"
+        elif condition:
+            price_desc = f"{condition}で{price_desc}"
+        response = f"{price_desc}製品は「{product['name']}」で、価格は¥{product['price']:,}です。"
+    else:
+        count = len(products)
+        order_desc = "価格が高い順" if is_desc else "価格が安い順"
+        if condition and "around" in price_range:
+            title = f"{condition}の製品を価格が近い順に{count}件ご紹介します"
+        elif condition:
+            title = f"{condition}の製品を{order_desc}に{count}件ご紹介します"
+        else:
+            title = f"{order_desc}に{count}件の製品をご紹介します"
+        response = f"{title}：\n\n"
+        for i, product in enumerate(products, 1):
+            response += f"{i}. {product['name']} - ¥{product['price']:,}\n"
+
+    response += "\n正確な最新情報については、各製品ページをご確認ください。"
+    return response
+
+
+def answer_price_query(catalog: ProductCatalog, query: str, intent: dict) -> str:
+    """カタログの価格索引から回答文を組み立てる（DBアクセスなし）"""
+    plan = plan_price_query(query, intent)
+    logger.info("[Price Comparison] plan: %s", plan)
+    price_range = plan["range"] or {}
+    if "around" in price_range:
+        products = catalog.price_index.around(price_range["around"], plan["limit"])
+    else:
+        products = catalog.price_index.search(plan["sort"], plan["limit"], price_range)
 
-        if result.data and len(result.data) > 0:
-            if limit == 1:
-                # 1件の場合
-                product = result.data[0]
-                logger.info(f"商品: {product['name']} - ¥{product['price']}")
-                price_desc = "最も価格が高い" if is_desc else "最も価格が安い"
-                response = f"{price_desc}製品は「{product['name']}」で、価格は¥{product['price']:,}です。"
-            else:
-                # 複数件の場合
-                logger.info(f"商品{len(result.data)}件を取得")
-                price_desc = "価格が高い順" if is_desc else "価格が安い順"
-                response = (
-                    f"{price_desc}に{len(result.data)}件の製品をご紹介します：\n\n"
-                )
-                for i, product in enumerate(result.data, 1):
-                    response += f"{i}. {product['name']} - ¥{product['price']:,}\n"
+    if not products:
+        logger.warning("条件に合う価格データを持つ商品が見つかりませんでした")
+    response = format_price_answer(products, plan)
+    logger.debug("[Price Comparison] Returning: %s...", response[:100])
+    return response
 
-            response += "\n正確な最新情報については、各製品ページをご確認ください。"
-            logger.info(f"[Price Comparison] Returning: {response[:100]}...")
-            return response
-        else:
-            logger.warning("有効な価格データを持つ商品が見つかりませんでした")
-            return "申し訳ありません、現在価格情報のある商品が見つかりませんでした。"
 
-    # --- 2. 従来のキーワードベースの価格比較（フォールバック） ---
-    # 高い/安いのキーワードを幅広く拾うように修正
-    if any(
-        keyword in query
-        for keyword in ["一番高い", "最も高い", "高い", "高価格", "高額"]
-    ):
-        logger.info("価格比較クエリ（最高値）を検出")
+# --- 検索ステージ ---
+def match_keyword_product(catalog: ProductCatalog, query: str):
+    """
+    クエリに含まれる商品名をカタログから探す（DBアクセスなし）。
+    返り値: (マッチした商品名 or None, 商品コンテキスト)
+    """
+    normalized_query = normalize_string(query)
+    logger.info("2. normalized_query: '%s'", normalized_query)
+
+    if not catalog.products:
+        logger.info("3. no_products_found_in_catalog")
+        return None, ""
 
-        # 複数商品を求めているかチェック
-        # パターン: 「3つ」「5個」「商品3つ」「もの3つ」「トップ3」など
-        count_match = re.search(
-            r"(\d+)\s*(つ|個|件)|(?:商品|製品|もの|アプリ)\s*(\d+)\s*(?:つ|個|件)?|トップ\s*(\d+)",
-            query,
+    logger.info("3. product_names_loaded: %d件", len(catalog.products))
+    matched_names = catalog.matcher.find_all(normalized_query)
+    if not matched_names:
+        logger.info("  ❌ 4. no_keyword_match_found")
+        return None, ""
+
+    # 複数マッチした場合は最も長い商品名を採用
+    matched_product_name = matched_names[0]
+    logger.info(
+        "  ✅ 4. MATCH_FOUND! product_name='%s' (candidates=%s)",
+        matched_product_name,
+        matched_names,
+    )
+
+    # 製品名をホワイトリストで検証
+    product = catalog.by_name.get(matched_product_name)
+    if not product:
+        logger.error(
+            f"  ❌ 5. matched_product_name '{matched_product_name}' is not in the whitelist of valid product names."
         )
-        limit = 1
-        if count_match:
-            # マッチしたグループから数値を取得（どのグループにマッチしたかチェック）
-            limit = int(
-                count_match.group(1) or count_match.group(3) or count_match.group(4)
+        return None, ""
+
+    logger.info("  ✅ 5. product_details_loaded_and_context_created")
+    return matched_product_name, format_product_context(product)
+
+
+async def get_vector_index(chatbot: ChatbotSingleton):
+    """
+    ローカルベクトル索引が有効なら読み込み済みの索引を返す。
+    無効、または初回読み込みに失敗した場合は None（RPCで検索する）。
+    """
+    if not chatbot.vector_index:
+        return None
+    try:
+        return await chatbot.vector_index.get()
+    except Exception as e:
+        logger.warning(f"[VectorIndex] unavailable, falling back to RPC: {e}")
+        return None
+
+
+async def search_lexical(chatbot: ChatbotSingleton, query: str) -> tuple:
+    """
+    字句索引が有効なら (上位の項目, 埋め込みを省略してよいか) を返す。
+    無効、または読み込みに失敗した場合は (None, False)（ベクトル検索のみで回答する）。
+    """
+    if not chatbot.lexical_index:
+        return None, False
+    try:
+        lexical_index = await chatbot.lexical_index.get()
+    except Exception as e:
+        logger.warning(f"[LexicalIndex] unavailable, using vector search only: {e}")
+        return None, False
+    with span("lexical"):
+        hits, decisive = lexical_index.search(query, MATCH_COUNT)
+    logger.info(f"  - 1.1 lexical_search: found {len(hits)} (decisive={decisive})")
+    return hits, decisive
+
+
+def fuse_lexical_hits(chunks: list, lexical_hits: list, include_products: bool):
+    """
+    ベクトル検索の (類似度, 本文) と字句検索の結果を RRF で統合する。
+    返り値は build_context に渡す (RRF スコア, 本文) のリスト
+    """
+    vector_ranking = [
+        content for _, content in sorted(chunks, key=lambda c: c[0], reverse=True)
+    ]
+    lexical_ranking = [
+        hit["content"]
+        for hit in lexical_hits
+        if include_products or hit["kind"] == "doc"
+    ]
+    return reciprocal_rank_fusion(vector_ranking, lexical_ranking)
+
+
+async def search_documents(chatbot: ChatbotSingleton, query_embedding) -> list:
+    """match_docs RPC でドキュメントを検索する。失敗時は DatabaseError を送出"""
+    from postgrest import APIError  # v2の正式なエラー型（supabase と共に読み込み済み）
+
+    vector_index = await get_vector_index(chatbot)
+    if vector_index:
+        with span("match_docs"):
+            docs = vector_index.match_docs(
+                query_embedding, MATCH_THRESHOLD, MATCH_COUNT
             )
-            limit = min(limit, 10)  # 最大10件に制限
-            logger.info(f"複数商品リクエスト検出: {limit}件")
-
-        # データベース側で価格の降順ソートして指定件数を取得
-        result = (
-            chatbot.supabase_client.from_("products")
-            .select("name, price")
-            .gt("price", 0)
-            .order("price", desc=True)
-            .limit(limit)
-            .execute()
-        )
-        if result.data and len(result.data) > 0:
-            if limit == 1:
-                # 1件の場合
-                highest_product = result.data[0]
-                logger.info(
-                    f"最高値商品: {highest_product['name']} - ¥{highest_product['price']}"
+        logger.info(f"  - 6.2 local_match_docs_executed: found {len(docs)} documents")
+        return docs
+
+    try:
+        with span("match_docs"):
+            docs_response = await SUPABASE_LIMITER.call(
+                chatbot.supabase_client.rpc(
+                    "match_docs",
+                    {
+                        "query_embedding": query_embedding,
+                        "match_threshold": MATCH_THRESHOLD,
+                        "match_count": MATCH_COUNT,
+                    },
+                ).execute()
+            )
+    except APIError as e:
+        logger.error(f"  ❌ Supabase RPC 'match_docs' failed: {e.message}")
+        raise DatabaseError(
+            f"ドキュメント検索中にデータベースエラーが発生しました: {e.message}"
+        ) from e
+
+    logger.info(
+        f"  - 6.2 rpc_match_docs_executed: found {len(docs_response.data)} documents"
+    )
+    return docs_response.data or []
+
+
+async def search_products(
+    chatbot: ChatbotSingleton, catalog: ProductCatalog, query_embedding
+) -> list:
+    """
+    match_products RPC で商品を検索し、詳細をカタログから補完する。
+    返り値は (類似度, 商品コンテキスト) のリスト（類似度順）。
+    商品検索の失敗は致命的ではないので、空リストを返して処理を続行する。
+    """
+    from postgrest import APIError
+
+    vector_index = await get_vector_index(chatbot)
+    try:
+        with span("match_products"):
+            if vector_index:
+                matches = vector_index.match_products(
+                    query_embedding, MATCH_THRESHOLD, 3
                 )
-                response = f"最も価格が高い製品は「{highest_product['name']}」で、価格は¥{highest_product['price']:,}です。"
             else:
-                # 複数件の場合
-                logger.info(f"高価格商品{len(result.data)}件を取得")
-                response = (
-                    f"価格が高い順に{len(result.data)}件の製品をご紹介します：\n\n"
+                products_response = await SUPABASE_LIMITER.call(
+                    chatbot.supabase_client.rpc(
+                        "match_products",
+                        {
+                            "query_embedding": query_embedding,
+                            "match_threshold": MATCH_THRESHOLD,
+                            "match_count": 3,
+                        },
+                    ).execute()
                 )
-                for i, product in enumerate(result.data, 1):
-                    response += f"{i}. {product['name']} - ¥{product['price']:,}\n"
+                matches = products_response.data or []
+        logger.info(
+            f"  - 6.3 {'local' if vector_index else 'rpc'}_match_products_executed: "
+            f"found {len(matches)} products"
+        )
+        similarities = {p["product_id"]: p.get("similarity", 0.0) for p in matches}
+        product_ids = [p["product_id"] for p in matches]
+        if not product_ids:
+            return []
+
+        # 詳細はカタログから取得し、カタログ未反映の商品のみDBに問い合わせる
+        with span("hydration"):
+            products = {
+                pid: catalog.by_id[pid] for pid in product_ids if pid in catalog.by_id
+            }
+            missing_ids = [pid for pid in product_ids if pid not in products]
+            if missing_ids:
+                details_response = await SUPABASE_LIMITER.call(
+                    chatbot.supabase_client.from_("products")
+                    .select("id, name, description, price, features")
+                    .in_("id", missing_ids)
+                    .execute()
+                )
+                products.update({p["id"]: p for p in details_response.data or []})
+    except APIError as e:
+        logger.error(f"  ❌ Supabase RPC 'match_products' failed: {e.message}")
+        logger.warning("  ⚠️ 商品のベクトル検索に失敗しましたが、処理を続行します")
+        return []
+    except UpstreamUnavailable as e:
+        # 期限切れ・混雑（429/503）でも回答自体は商品なしで続ける
+        mark_degraded("products")
+        logger.warning(f"  ⚠️ 商品のベクトル検索を省略しました: {e}")
+        return []
+
+    # 類似度順を維持する
+    product_contexts = [
+        (similarities[pid], format_product_context(products[pid]))
+        for pid in product_ids
+        if pid in products
+    ]
+    logger.info(
+        f"  - 6.4 vector_search_product_context_added: {len(product_contexts)} products"
+    )
+    return product_contexts
 
-            response += "\n正確な最新情報については、各製品ページをご確認ください。"
-            return response
-        else:
-            logger.warning("有効な価格データを持つ商品が見つかりませんでした")
-            return "申し訳ありません、現在価格情報のある商品が見つかりませんでした。"
 
-    if any(keyword in query for keyword in ["一番安い", "最も安い", "安い", "低価格"]):
-        logger.info("価格比較クエリ（最安値）を検出")
+async def embed_query_cached(chatbot: ChatbotSingleton, query: str) -> list:
+    """クエリ埋め込みをキャッシュから取得し、なければOpenAIで生成して保存する"""
+    model = chatbot.emb.model
+    cached = chatbot.embedding_cache.get(model, query)
+    if cached is not None:
+        logger.info("  - 6.1 query_embedding_cache_hit")
+        return cached
+    with span("embedding"):
+        query_embedding = await EMBEDDING_LIMITER.call(chatbot.emb.aembed_query(query))
+    chatbot.embedding_cache.put(model, query, query_embedding)
+    return query_embedding
 
-        # 複数商品を求めているかチェック
-        # パターン: 「3つ」「5個」「商品3つ」「もの3つ」「トップ3」など
-        count_match = re.search(
-            r"(\d+)\s*(つ|個|件)|(?:商品|製品|もの|アプリ)\s*(\d+)\s*(?:つ|個|件)?|トップ\s*(\d+)",
-            query,
-        )
-        limit = 1
-        if count_match:
-            # マッチしたグループから数値を取得（どのグループにマッチしたかチェック）
-            limit = int(
-                count_match.group(1) or count_match.group(3) or count_match.group(4)
-            )
-            limit = min(limit, 10)  # 最大10件に制限
-            logger.info(f"複数商品リクエスト検出: {limit}件")
-
-        # データベース側で価格の昇順ソートして指定件数を取得
-        result = (
-            chatbot.supabase_client.from_("products")
-            .select("name, price")
-            .gt("price", 0)
-            .order("price", desc=False)
-            .limit(limit)
-            .execute()
-        )
-        if result.data and len(result.data) > 0:
-            if limit == 1:
-                # 1件の場合
-                lowest_product = result.data[0]
-                logger.info(
-                    f"最安値商品: {lowest_product['name']} - ¥{lowest_product['price']}"
+
+# --- トークン予算に基づくコンテキストの組み立て ---
+def approximate_token_count(text: str) -> int:
+    """
+    トークナイザーを使えない場合の概算。日本語などの非ASCII文字は1文字1トークン、
+    ASCII文字は4文字で1トークンとみなす（o200k_base の実測よりやや多めに出る）。
+    """
+    ascii_chars = sum(1 for c in text if c.isascii())
+    return len(text) - ascii_chars + (ascii_chars + 3) // 4
+
+
+# tiktoken はエンコーディングを TIKTOKEN_CACHE_DIR に、取得元URLの SHA-1 をファイル名にして保存する
+TIKTOKEN_ENCODING_URL = (
+    "https://openaipublic.blob.core.windows.net/encodings/{}.tiktoken"
+)
+
+
+def tokenizer_cache_path(encoding_name: str, directory: str = CONTEXT_TOKENIZER_DIR):
+    """同梱したエンコーディングのファイルのパス（tiktoken のキャッシュの形式）"""
+    url = TIKTOKEN_ENCODING_URL.format(encoding_name)
+    return os.path.join(directory, hashlib.sha1(url.encode()).hexdigest())
+
+
+class TokenCounter:
+    """
+    tiktoken でトークン数を数える。エンコーディングは CONTEXT_TOKENIZER_DIR に同梱した
+    ファイルからのみ読み込み、ネットワークからは取得しない。tiktoken が未インストール、
+    またはファイルが同梱されていない場合は文字数から概算する。
+    """
+
+    def __init__(self, encoding_name: str = CONTEXT_TOKENIZER):
+        self.encoding_name = encoding_name
+        self.encoding = None
+        self.is_loaded = False
+        self._lock = threading.Lock()
+
+    def load(self):
+        """エンコーディングを読み込む（ブロッキングなのでスレッドで呼び出す）"""
+        with self._lock:
+            if self.is_loaded:
+                return
+            path = tokenizer_cache_path(self.encoding_name)
+            if not os.path.exists(path):
+                logger.warning(
+                    f"[Context] tokenizer {self.encoding_name} is not bundled in "
+                    f"{CONTEXT_TOKENIZER_DIR} (run build_tokenizer.py), "
+                    "approximating token counts"
                 )
-                response = f"最も価格が安い製品は「{lowest_product['name']}」で、価格は¥{lowest_product['price']:,}です。"
-            else:
-                # 複数件の場合
-                logger.info(f"低価格商品{len(result.data)}件を取得")
-                response = (
-                    f"価格が安い順に{len(result.data)}件の製品をご紹介します：\n\n"
+                self.is_loaded = True
+                return
+            try:
+                # 同梱したファイルをキャッシュとして読ませる（ネットワークに取りに行かない）
+                os.environ["TIKTOKEN_CACHE_DIR"] = CONTEXT_TOKENIZER_DIR
+                import tiktoken
+
+                self.encoding = tiktoken.get_encoding(self.encoding_name)
+                logger.info(f"[Context] tokenizer loaded: {self.encoding_name}")
+            except Exception as e:
+                logger.warning(
+                    f"[Context] tokenizer unavailable, approximating token counts: {e}"
                 )
-                for i, product in enumerate(result.data, 1):
-                    response += f"{i}. {product['name']} - ¥{product['price']:,}\n"
-
-            response += "\n正確な最新情報については、各製品ページをご確認ください。"
-            return response
-        else:
-            logger.warning("有効な価格データを持つ商品が見つかりませんでした")
-            return "申し訳ありません、現在価格情報のある商品が見つかりませんでした。"
+            self.is_loaded = True
+
+    @property
+    def is_approximate(self) -> bool:
+        return self.encoding is None
+
+    def count(self, text: str) -> int:
+        if self.encoding is None:
+            return approximate_token_count(text)
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """先頭から max_tokens トークン以内に収まる部分を返す"""
+        if max_tokens <= 0:
+            return ""
+        if self.encoding is None:
+            used = 0.0
+            for i, c in enumerate(text):
+                used += 0.25 if c.isascii() else 1.0
+                if used > max_tokens:
+                    return text[:i]
+            return text
+        tokens = self.encoding.encode(text, disallowed_special=())
+        # マルチバイト文字の途中で切れた場合の置換文字は取り除く
+        return self.encoding.decode(tokens[:max_tokens]).rstrip("�")
+
+
+class ContextStats:
+    """コンテキストに採用したトークン数と、予算超過・重複で削ったトークン数を集計する"""
+
+    requests = 0
+    trimmed_requests = 0
+    used_tokens = 0
+    trimmed_tokens = 0
+    duplicate_tokens = 0
 
-    # --- 2. 動的なキーワードベースの製品検索 ---
-    product_context = ""
-    normalized_query = normalize_string(query)
-    logger.info(f"2. normalized_query: '{normalized_query}'")
+    @classmethod
+    def record(cls, report: dict):
+        cls.requests += 1
+        cls.trimmed_requests += 1 if report["trimmed_tokens"] else 0
+        cls.used_tokens += report["used_tokens"]
+        cls.trimmed_tokens += report["trimmed_tokens"]
+        cls.duplicate_tokens += report["duplicate_tokens"]
 
-    # 1a. DBから全商品名を取得
-    logger.info("3. fetching_all_product_names_from_db")
-    products_response = (
-        chatbot.supabase_client.from_("products").select("name").execute()
+    @classmethod
+    def as_dict(cls) -> dict:
+        return {
+            "requests": cls.requests,
+            "trimmed_requests": cls.trimmed_requests,
+            "used_tokens": cls.used_tokens,
+            "trimmed_tokens": cls.trimmed_tokens,
+            "duplicate_tokens": cls.duplicate_tokens,
+            "avg_used_tokens": (
+                round(cls.used_tokens / cls.requests, 1) if cls.requests else 0.0
+            ),
+        }
+
+
+# 予算の残りがこのトークン数未満なら、切り詰めた断片は入れずに打ち切る
+CONTEXT_MIN_FRAGMENT_TOKENS = 32
+CONTEXT_SEPARATOR = "\n---\n"
+PASSAGE_SEPARATOR_PATTERN = re.compile(r"\n\s*\n")
+
+
+def char_shingles(text: str, size: int = 3) -> frozenset:
+    """重複判定用の文字 n-gram の集合（空白・記号の揺れは正規化で吸収する）"""
+    normalized = normalize_string(text)
+    if len(normalized) <= size:
+        return frozenset([normalized])
+    return frozenset(
+        normalized[i : i + size] for i in range(len(normalized) - size + 1)
     )
 
-    matched_product_name = None
-    if products_response.data:
-        logger.info(f"4. product_names_fetched: {len(products_response.data)}件")
-        for i, product in enumerate(products_response.data):
-            product_name = product.get("name")
-            if not product_name:
+
+def is_near_duplicate(shingles: frozenset, seen: list, threshold: float) -> bool:
+    for other in seen:
+        union = len(shingles | other)
+        if union and len(shingles & other) / union >= threshold:
+            return True
+    return False
+
+
+def build_context(
+    counter: TokenCounter,
+    pinned: str,
+    chunks: list,
+    budget: int = CONTEXT_TOKEN_BUDGET,
+    dedup_threshold: float = CONTEXT_DEDUP_THRESHOLD,
+):
+    """
+    検索結果からトークン予算内のコンテキストを組み立てる。
+
+    pinned（キーワードマッチした商品）は常に先頭に置き、chunks は
+    (類似度, テキスト) を類似度の高い順に採用する。既に採用した段落とほぼ同じ段落は
+    除外し、予算を超えたチャンクは段落単位（1段落目は途中まで）で切り詰め、
+    それより類似度の低いチャンクは採用しない。
+    返り値: (コンテキスト文字列, 集計 dict)
+    """
+    used = trimmed = duplicates = 0
+    seen = []
+
+    if pinned:
+        pinned_tokens = counter.count(pinned)
+        if pinned_tokens > budget:
+            pinned = counter.truncate(pinned, budget)
+            trimmed += pinned_tokens - budget
+            pinned_tokens = budget
+        used += pinned_tokens
+        seen.append(char_shingles(pinned))
+
+    selected = []
+    exhausted = False
+    # sorted は安定ソートなので、同じ類似度なら検索結果の順序を維持する
+    for _, text in sorted(chunks, key=lambda chunk: chunk[0], reverse=True):
+        kept = []
+        for passage in PASSAGE_SEPARATOR_PATTERN.split(text.strip()):
+            if not passage.strip():
+                continue
+            tokens = counter.count(passage)
+            if exhausted:
+                trimmed += tokens
+                continue
+            shingles = char_shingles(passage)
+            if is_near_duplicate(shingles, seen, dedup_threshold):
+                duplicates += tokens
                 continue
+            remaining = budget - used
+            if tokens > remaining:
+                # 予算を使い切ったら、以降の段落・チャンクはすべて削る
+                exhausted = True
+                if remaining >= CONTEXT_MIN_FRAGMENT_TOKENS and not kept:
+                    passage = counter.truncate(passage, remaining)
+                    trimmed += tokens - remaining
+                    tokens = remaining
+                else:
+                    trimmed += tokens
+                    continue
+            kept.append(passage)
+            seen.append(shingles)
+            used += tokens
+        if kept:
+            selected.append("\n\n".join(kept))
+
+    context = f"{pinned}\n\n{CONTEXT_SEPARATOR.join(selected)}".strip()
+    return context, {
+        "used_tokens": used,
+        "trimmed_tokens": trimmed,
+        "duplicate_tokens": duplicates,
+        "budget": budget,
+        "chunks": len(selected),
+    }
 
-            normalized_name = normalize_string(product_name)
-            logger.info(f"  - 4.{i+1} checking: normalized_db_name='{normalized_name}'")
 
-            if normalized_name and normalized_name in normalized_query:
-                matched_product_name = product_name
-                logger.info(
-                    f"  ✅ 4.{i+1} MATCH_FOUND! product_name='{matched_product_name}'"
-                )
-                break
+# --- 回答生成ロジック ---
+class PreparedAnswer:
+    """
+    検索ステージの結果。answer が確定していればそのまま返し、
+    そうでなければ context をもとに最終LLMで回答を生成する。
+    """
 
-        if not matched_product_name:
-            logger.info("  ❌ 4. no_keyword_match_found")
-    else:
-        logger.info("4. no_products_found_in_db")
-
-    # 1b. マッチした場合、その製品の詳細を取得
-    if matched_product_name:
-        # 製品名をホワイトリストで検証
-        valid_product_names = [
-            product.get("name")
-            for product in products_response.data
-            if product.get("name")
-        ]
-        if matched_product_name not in valid_product_names:
-            logger.error(
-                f"  ❌ 5. matched_product_name '{matched_product_name}' is not in the whitelist of valid product names."
-            )
-            matched_product_name = None  # 無効な製品名の場合はリセット
+    def __init__(
+        self,
+        answer=None,
+        source="llm",
+        context="",
+        query_embedding=None,
+        context_report=None,
+        lexical_query=None,
+    ):
+        self.answer = answer
+        # predefined / faq / price_comparison / no_context / answer_cache / llm
+        self.source = source
+        self.context = context
+        self.query_embedding = query_embedding
+        # 字句検索で埋め込みを省略した場合の質問文（回答キャッシュの完全一致のキー）
+        self.lexical_query = lexical_query
+        # build_context の集計（採用・削除したトークン数）
+        self.context_report = context_report
+        self.context_fingerprint = AnswerCache.fingerprint(context) if context else None
+
+    @property
+    def is_cacheable(self) -> bool:
+        # 混雑時にベクトル検索を省略した回答は、埋め込みも質問文のキーもない
+        return self.query_embedding is not None or self.lexical_query is not None
+
+
+async def prepare_answer(chatbot: ChatbotSingleton, query: str) -> PreparedAnswer:
+    """最終LLM呼び出しの直前までの処理（意図分析・検索・コンテキスト作成）"""
+    logger.info("--- answering_process_started ---")
+    logger.info("1. raw_query: '%s'", query)
+
+    # --- 0. 事前定義された応答・FAQ のチェック（検索・LLMを使わない） ---
+    FaqStats.lookups += 1
+    entry = chatbot.faq.match(query)
+    if entry:
+        logger.info("✅ %s response found for '%s'", entry["source"], query)
+        FaqStats.record(entry, "lexical")
+        return PreparedAnswer(answer=entry["answer"], source=entry["source"])
+
+    # --- 1. 意図分析（埋め込み・カタログ取得を投機的に並行実行） ---
+    # 字句検索（ローカル）の結果が確実であれば、埋め込み自体を作らない
+    lexical_hits, lexical_decisive = await search_lexical(chatbot, query)
+    # 埋め込みは価格比較と判明した時点で破棄する。ローカル判定で完結する場合は
+    # イベントループに制御が戻らないため、埋め込みのAPI呼び出し自体が発生しない
+    embedding_task = (
+        None
+        if lexical_decisive
+        else asyncio.create_task(embed_query_cached(chatbot, query))
+    )
+    catalog_task = asyncio.create_task(traced("catalog", chatbot.catalog.get()))
+    try:
+        with span("intent"):
+            intent = await analyze_query_intent(chatbot, query)
+        logger.info("[Intent] Detected: %s", intent)
+
+        if is_price_query(query, intent):
+            discard_task(embedding_task)
+            catalog = await catalog_task
+            answer = answer_price_query(catalog, query, intent)
+            return PreparedAnswer(answer=answer, source="price_comparison")
+
+        # --- 2. 動的なキーワードベースの製品検索（カタログ上で完結） ---
+        catalog = await catalog_task
+        matched_product_name, product_context = match_keyword_product(catalog, query)
+
+        # --- 3. ベクトル検索（ドキュメント + 商品を並行実行） ---
+        if lexical_decisive:
+            # 字句検索の1位が質問の語をほぼ含み、他より明らかに高い
+            LexicalStats.decisive += 1
+            logger.info("6. lexical_result_is_decisive: skipping embedding")
+            query_embedding, results = None, [[]]
         else:
-            logger.info(
-                f"5. fetching_details_for_matched_product: '{matched_product_name}'"
-            )
-            details_response = (
-                chatbot.supabase_client.from_("products")
-                .select("name, description, price, features")
-                .eq("name", matched_product_name)
-                .single()
-                .execute()
+            # 埋め込みAPIの待ち行列が長く、キャッシュにもない場合、商品名でマッチしていれば
+            # ベクトル検索を省略して商品情報だけで回答する
+            if (
+                matched_product_name
+                and EMBEDDING_LIMITER.is_congested
+                and not embedding_task.done()
+                and not chatbot.embedding_cache.has(chatbot.emb.model, query)
+            ):
+                EMBEDDING_LIMITER.degraded += 1
+                mark_degraded("search")
+                logger.warning("  ⚠️ 6. embedding is congested, skipping vector search")
+                return PreparedAnswer(context=product_context)
+
+            logger.info("6. starting_vector_search")
+            query_embedding = await embedding_task
+            logger.info("  - 6.1 query_embedding_created")
+
+            # 言い回しの違う FAQ も、質問文の埋め込みに十分近ければ定型回答で済ませる
+            if FAQ_EMBEDDING_THRESHOLD > 0:
+                chatbot.faq.schedule_embedding(chatbot.emb)
+            if not matched_product_name:
+                entry = chatbot.faq.match_embedding(
+                    query_embedding, FAQ_EMBEDDING_THRESHOLD
+                )
+                if entry:
+                    logger.info("  ✅ 6.1.1 faq matched by embedding: %s", entry["id"])
+                    FaqStats.record(entry, "embedding")
+                    return PreparedAnswer(answer=entry["answer"], source="faq")
+
+            searches = [search_documents(chatbot, query_embedding)]
+            # 商品検索はキーワードマッチがない場合のみ
+            if not matched_product_name:
+                searches.append(search_products(chatbot, catalog, query_embedding))
+            results = await gather_or_cancel(*searches)
+    finally:
+        discard_task(embedding_task)
+        discard_task(catalog_task)
+
+    docs = results[0]
+    product_chunks = results[1] if len(results) > 1 else []
+    if log_enabled(logging.DEBUG):
+        for doc in docs:
+            logger.debug(
+                "  - 6.2.1 doc: id=%s similarity=%.4f title=%s",
+                doc.get("id"),
+                doc.get("similarity", 0.0),
+                doc.get("title"),
             )
 
-            if details_response.data:
-                product = details_response.data
-                features = product.get("features", [])
-                features_str = (
-                    ", ".join(features)
-                    if isinstance(features, list)
-                    else str(features)
-                    if features
-                    else ""
-                )
-                product_context = f"[製品情報]\n商品名: {product.get('name')}\n価格: ¥{product.get('price')}\n説明: {product.get('description')}\n機能: {features_str}"
-                logger.info("  ✅ 5. product_details_fetched_and_context_created")
-            else:
-                logger.info(
-                    f"  ❌ 5. failed_to_fetch_details for '{matched_product_name}'"
-                )
+    # --- 4. 類似度順にトークン予算内でコンテキストを組み立てる ---
+    logger.info("7. preparing_final_prompt")
+    if not chatbot.token_counter.is_loaded:
+        await asyncio.to_thread(chatbot.token_counter.load)
+    chunks = [(doc.get("similarity", 0.0), doc["content"]) for doc in docs]
+    chunks += product_chunks
+    if lexical_hits is not None:
+        if not lexical_decisive:
+            LexicalStats.fused += 1
+        # 商品名でマッチした場合は、ベクトル検索と同じく他の商品を加えない
+        chunks = fuse_lexical_hits(
+            chunks, lexical_hits, include_products=not matched_product_name
+        )
+    final_context, context_report = build_context(
+        chatbot.token_counter, product_context, chunks
+    )
+    ContextStats.record(context_report)
+    logger.info(
+        "  - 7.0 context_built: %d tokens in %d chunks "
+        "(trimmed=%d, duplicates=%d, budget=%d)",
+        context_report["used_tokens"],
+        context_report["chunks"],
+        context_report["trimmed_tokens"],
+        context_report["duplicate_tokens"],
+        context_report["budget"],
+    )
 
-    # --- 2. ベクトル検索（ドキュメント + 商品） ---
-    logger.info("6. starting_vector_search")
-    query_embedding = chatbot.emb.embed_query(query)
-    logger.info("  - 6.1 query_embedding_created")
+    if not final_context:
+        logger.warning("  ⚠️ 7.1 final_context_is_empty. returning friendly message.")
+        return PreparedAnswer(
+            answer="申し訳ありません、ご質問に関連する情報が見つかりませんでした。",
+            source="no_context",
+        )
 
-    semantic_context = ""
+    logger.debug("  - 7.2 final_context (truncated): '%s...'", final_context[:200])
 
-    # 2a. ドキュメント検索
-    try:
-        docs_response = chatbot.supabase_client.rpc(
-            "match_docs",
-            {
-                "query_embedding": query_embedding,
-                "match_threshold": MATCH_THRESHOLD,
-                "match_count": MATCH_COUNT,
-            },
-        ).execute()
-        logger.info(
-            f"  - 6.2 rpc_match_docs_executed: found {len(docs_response.data)} documents"
+    # 意味的に同じ質問で、同じコンテキストが得られていれば保存済みの回答を返す
+    prepared = PreparedAnswer(
+        context=final_context,
+        query_embedding=query_embedding,
+        context_report=context_report,
+        lexical_query=query if lexical_decisive else None,
+    )
+    cached_answer = (
+        chatbot.answer_cache.lookup(
+            query_embedding, prepared.context_fingerprint, prepared.lexical_query
         )
+        if prepared.is_cacheable
+        else None
+    )
+    if cached_answer is not None:
+        logger.info("  ✅ 7.3 answer_cache_hit")
+        prepared.answer = cached_answer
+        prepared.source = "answer_cache"
+    return prepared
 
-        if docs_response.data:
-            doc_context = "\n---\n".join([doc["content"] for doc in docs_response.data])
-            semantic_context += doc_context
 
-    except APIError as e:
-        logger.error(f"  ❌ Supabase RPC 'match_docs' failed: {e.message}")
-        raise DatabaseError(
-            f"ドキュメント検索中にデータベースエラーが発生しました: {e.message}"
-        ) from e
+async def generate_final_answer(chatbot: ChatbotSingleton, query: str):
+    """
+    正規化後に同じ質問が処理中であれば、その回答を待って共有する（single-flight）。
+    この関数内のエラーは呼び出し元(handle_chat)に伝播させ、そこで一元的に処理します。
+    """
+    return await chatbot.inflight.run(
+        normalize_string(query), lambda: compute_final_answer(chatbot, query)
+    )
 
-    # 2b. 商品検索（キーワードマッチがない場合のみ）
-    if not matched_product_name:
-        try:
-            products_response = chatbot.supabase_client.rpc(
-                "match_products",
-                {
-                    "query_embedding": query_embedding,
-                    "match_threshold": MATCH_THRESHOLD,
-                    "match_count": 3,
-                },
-            ).execute()
-            logger.info(
-                f"  - 6.3 rpc_match_products_executed: found {len(products_response.data)} products"
+
+async def compute_final_answer(chatbot: ChatbotSingleton, query: str):
+    """意図分析・検索・最終LLM呼び出しを行い回答を生成する"""
+    prepared = await prepare_answer(chatbot, query)
+    if prepared.answer is not None:
+        return prepared.answer
+
+    with span("llm"):
+        answer = await LLM_LIMITER.call(
+            chatbot.answer_chain.ainvoke(
+                {"context": prepared.context, "question": query}
             )
+        )
+    TokenUsage.record("answer", answer)
+
+    if prepared.is_cacheable:
+        chatbot.answer_cache.put(
+            prepared.query_embedding,
+            prepared.context_fingerprint,
+            answer.content,
+            prepared.lexical_query,
+        )
+    return answer.content
 
-            if products_response.data:
-                # 商品IDから詳細情報を取得
-                product_ids = [p["product_id"] for p in products_response.data]
-                details_response = (
-                    chatbot.supabase_client.from_("products")
-                    .select("name, description, price, features")
-                    .in_("id", product_ids)
-                    .execute()
-                )
 
-                if details_response.data:
-                    product_contexts = []
-                    for product in details_response.data:
-                        features = product.get("features", [])
-                        features_str = (
-                            ", ".join(features)
-                            if isinstance(features, list)
-                            else str(features)
-                            if features
-                            else ""
+async def generate_batch_answers(chatbot: ChatbotSingleton, queries: list) -> list:
+    """
+    複数の質問に generate_final_answer と同じ処理で回答する（結果は入力順）。
+    正規化後に同じ質問は1回だけ処理し、埋め込みは1回の embed_documents でまとめて生成する。
+    """
+    # 1. 正規化クエリで重複を除く
+    unique_queries = {}
+    for query in queries:
+        unique_queries.setdefault(normalize_string(query), query)
+    logger.info(f"[Batch] {len(queries)}件 (unique={len(unique_queries)})")
+
+    # 2. 検索が必要なクエリの埋め込みを一括生成し、キャッシュに投入しておく
+    model = chatbot.emb.model
+    lexical_index = None
+    if chatbot.lexical_index:
+        with suppress(Exception):
+            lexical_index = await chatbot.lexical_index.get()
+    texts_to_embed = [
+        query
+        for query in unique_queries.values()
+        if not chatbot.faq.match(query)
+        and not is_local_price_query(query)
+        and not (lexical_index and lexical_index.search(query, 1)[1])
+        and not chatbot.embedding_cache.has(model, query)
+    ]
+    if texts_to_embed:
+        embeddings = await EMBEDDING_LIMITER.call(
+            chatbot.emb.aembed_documents(texts_to_embed)
+        )
+        for query, embedding in zip(texts_to_embed, embeddings):
+            chatbot.embedding_cache.put(model, query, embedding)
+        logger.info(f"[Batch] embedded {len(texts_to_embed)} queries in one call")
+
+    # 3. 同時実行数を制限して各質問に回答する
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def answer_one(query: str) -> dict:
+        async with semaphore:
+            try:
+                return {"reply": await generate_final_answer(chatbot, query)}
+            except Exception as e:
+                logger.error(f"[Batch] failed for '{query}': {e}")
+                return {"error": "回答の生成中にエラーが発生しました。"}
+
+    results = await asyncio.gather(
+        *(answer_one(query) for query in unique_queries.values())
+    )
+    answers = dict(zip(unique_queries, results))
+    return [answers[normalize_string(query)] for query in queries]
+
+
+def format_sse(event: str, data: dict) -> str:
+    """server-sent events の1イベント分の文字列を生成する"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def stream_final_answer(chatbot: ChatbotSingleton, query: str):
+    """
+    回答を server-sent events として生成する非同期ジェネレーター。
+    検索完了時に retrieved、生成中は token、最後に done（全文）を送る。
+    定型応答・価格比較・キャッシュ済みの回答は1つの token で送る。
+    """
+    try:
+        prepared = await prepare_answer(chatbot, query)
+        retrieved = {"source": prepared.source}
+        if prepared.context_report:
+            retrieved["context_tokens"] = prepared.context_report["used_tokens"]
+            retrieved["trimmed_tokens"] = prepared.context_report["trimmed_tokens"]
+        yield format_sse("retrieved", retrieved)
+
+        if prepared.answer is not None:
+            final_answer = prepared.answer
+            yield format_sse("token", {"text": final_answer})
+        else:
+            chunks = []
+            # 最後のチャンクに含まれる usage_metadata を集計するため結合する
+            message = None
+            # ストリーミングは生成が終わるまで枠を占有する（期限は非ストリーミングと同じ）
+            with span("llm"):
+                async with aclosing(
+                    LLM_LIMITER.stream(
+                        chatbot.answer_chain.astream(
+                            {"context": prepared.context, "question": query}
                         )
-                        product_text = f"[製品情報]\n商品名: {product.get('name')}\n価格: ¥{product.get('price')}\n説明: {product.get('description')}\n機能: {features_str}"
-                        product_contexts.append(product_text)
-
-                    if semantic_context:
-                        semantic_context += "\n---\n"
-                    semantic_context += "\n---\n".join(product_contexts)
-                    logger.info(
-                        f"  - 6.4 vector_search_product_context_added: {len(product_contexts)} products"
                     )
+                ) as stream:
+                    async for chunk in stream:
+                        message = chunk if message is None else message + chunk
+                        if chunk.content:
+                            chunks.append(chunk.content)
+                            yield format_sse("token", {"text": chunk.content})
+            TokenUsage.record("answer", message)
+            final_answer = "".join(chunks)
+            if prepared.is_cacheable:
+                chatbot.answer_cache.put(
+                    prepared.query_embedding,
+                    prepared.context_fingerprint,
+                    final_answer,
+                    prepared.lexical_query,
+                )
 
-        except APIError as e:
-            logger.error(f"  ❌ Supabase RPC 'match_products' failed: {e.message}")
-            # 商品検索の失敗は致命的ではないので、ログのみ
-            logger.warning("  ⚠️ 商品のベクトル検索に失敗しましたが、処理を続行します")
+        logger.info("4. final_answer_streamed: %d chars", len(final_answer))
+        logger.debug("  - 4.1 final_answer: '%s'", final_answer)
+        timings = request_timings_var.get() or {}
+        yield format_sse(
+            "done",
+            {
+                "reply": final_answer,
+                "timings": {
+                    name: round(sec * 1000, 1) for name, sec in timings.items()
+                },
+            },
+        )
+    except UpstreamUnavailable as e:
+        logger.warning(f"[Upstream] stream_final_answer shed: {e}")
+        yield format_sse(
+            "error",
+            {
+                "error": "ただいま混み合っています。しばらくしてから再度お試しください。",
+                "retry_after": e.retry_after,
+            },
+        )
+    except Exception as e:
+        logger.error("!!! UNHANDLED EXCEPTION in stream_final_answer !!!")
+        logger.error(f"Error: {e}")
+        logger.error(f"Traceback:\n{traceback.format_exc()}")
+        yield format_sse(
+            "error",
+            {
+                "error": "予期せぬ内部サーバーエラーが発生しました。詳細はログを確認してください。"
+            },
+        )
 
-    logger.info(
-        f"  - 6.5 semantic_context_created: total length {len(semantic_context)}"
+
+# --- コールドスタート対策（起動時・定期的なウォームアップ） ---
+async def warm_up() -> dict:
+    """
+    クライアントの生成、商品カタログ・ベクトル索引・トークナイザーの読み込みを済ませ、
+    最初のリクエストが待たされないようにする。返り値はステップごとの所要時間（ミリ秒）。
+    読み込み済みのステップは何もしないので、繰り返し呼び出してもよい。
+    """
+    timings = {}
+    started = time.perf_counter()
+    chatbot = await ChatbotSingleton.get_instance()
+    timings["init"] = round((time.perf_counter() - started) * 1000, 1)
+    if chatbot.init_error:
+        return timings
+
+    # 接続の確立は、定期的なウォームアップで keep-alive を保つため毎回行う
+    steps = [
+        ("connections", chatbot.prewarm_connections),
+        ("catalog", chatbot.catalog.get),
+    ]
+    if chatbot.vector_index:
+        steps.append(("vector_index", chatbot.vector_index.get))
+    if chatbot.lexical_index:
+        steps.append(("lexical_index", chatbot.lexical_index.get))
+    if not chatbot.token_counter.is_loaded:
+        steps.append(
+            ("tokenizer", lambda: asyncio.to_thread(chatbot.token_counter.load))
+        )
+    if FAQ_EMBEDDING_THRESHOLD > 0 and chatbot.faq.missing_vector_entries():
+        steps.append(("faq_vectors", lambda: chatbot.faq.embed_missing(chatbot.emb)))
+    for name, step in steps:
+        started = time.perf_counter()
+        try:
+            await step()
+        except Exception as e:
+            # 失敗しても最初のリクエストで再試行されるので、ここでは記録のみ
+            logger.warning(f"[Warmup] {name} failed: {e}")
+            continue
+        timings[name] = round((time.perf_counter() - started) * 1000, 1)
+    logger.info(f"[Warmup] done: {timings}")
+    return timings
+
+
+def overloaded_response(error: UpstreamUnavailable) -> JSONResponse:
+    """上流の混雑・障害で処理できない場合の 429 / 503 レスポンス"""
+    return JSONResponse(
+        status_code=error.status_code,
+        headers={"Retry-After": str(error.retry_after)},
+        content={
+            "error": "ただいま混み合っています。しばらくしてから再度お試しください。",
+            "retry_after": error.retry_after,
+        },
     )
 
-    # --- 3. コンテキストを結合して最終的なプロンプトを作成 ---
-    logger.info("7. preparing_final_prompt")
-    final_context = f"{product_context}\n\n{semantic_context}".strip()
 
-    if not final_context:
-        logger.warning("  ⚠️ 7.1 final_context_is_empty. returning friendly message.")
-        return "申し訳ありません、ご質問に関連する情報が見つかりませんでした。"
+def _is_admin_request(request: Request) -> bool:
+    """管理用トークン（Authorization: Bearer または X-Admin-Token）を検証する"""
+    if not CHAT_ADMIN_TOKEN:
+        return False
+    auth_header = request.headers.get("authorization", "")
+    token = auth_header.removeprefix("Bearer ").strip() or request.headers.get(
+        "x-admin-token", ""
+    )
+    return token == CHAT_ADMIN_TOKEN
 
-    logger.info(f"  - 7.2 final_context (truncated): '{final_context[:200]}...'")
 
-    prompt_template = """
-    あなたは、企業の製品やサービスについて回答する、親切で優秀なAIアシスタント「Showcase・コンシェルジュ」です。
-    以下のルールを厳密に守って、ユーザーの質問に日本語で回答してください。
+@app.post("/api/chat/catalog/invalidate")
+async def invalidate_catalog(request: Request):
+    """
+    商品カタログキャッシュを無効化して再取得する。
+    管理画面からの操作や Supabase Database Webhook（products の変更通知）から呼び出す想定。
+    """
+    if not _is_admin_request(request):
+        return JSONResponse(status_code=403, content={"error": "権限がありません。"})
 
-    # ルール
-    - 誠実で、丁寧な言葉遣いを徹底してください。
-    - 提供された「コンテキスト情報」に書かれている事実のみに基づいて回答してください。
-    - 感謝の言葉や挨拶以外の、定型的な応答（例：「他にご不明な点はございますか？」）は不要です。自然な会話を心がけてください。
-    - コンテキスト情報に記載のない事柄については、「恐れ入れますが、その件に関する情報は持ち合わせておりません。」と正直に回答してください。
-    - 例外として、「プライバシーポリシー」や「利用規約」に関する情報が見つからなかった場合に限り、「プライバシーポリシーや利用規約については、お問い合わせページをご確認いただけます。」と案内してください。
-    - 回答は、まず結論から述べ、その後に理由や詳細を簡潔に説明してください。
+    chatbot = await ChatbotSingleton.get_instance()
+    if chatbot.init_error:
+        return JSONResponse(status_code=500, content={"error": chatbot.init_error})
 
-    # コンテキスト情報
-    {context}
+    await chatbot.catalog.refresh(from_source=True)
+    logger.info(f"[Catalog] invalidated by admin (version={chatbot.catalog.version})")
+    return JSONResponse(
+        content={"status": "ok", "catalog_version": chatbot.catalog.version}
+    )
 
-    # ユーザーの質問
-    {question}
 
-    # 回答
+@app.post("/api/chat/docs/invalidate")
+async def invalidate_docs(request: Request):
     """
-    prompt = PromptTemplate(
-        template=prompt_template, input_variables=["context", "question"]
+    doc_embeddings の更新後に呼び出し、ドキュメントに依存するキャッシュを破棄する。
+    Supabase Database Webhook（doc_embeddings の変更通知）から呼び出す想定。
+    """
+    if not _is_admin_request(request):
+        return JSONResponse(status_code=403, content={"error": "権限がありません。"})
+
+    chatbot = await ChatbotSingleton.get_instance()
+    if chatbot.init_error:
+        return JSONResponse(status_code=500, content={"error": chatbot.init_error})
+
+    chatbot.answer_cache.invalidate()
+    if chatbot.vector_index:
+        await chatbot.vector_index.refresh(from_source=True)
+    if chatbot.lexical_index:
+        await chatbot.lexical_index.refresh(from_source=True)
+    logger.info("[Docs] caches invalidated by admin")
+    return JSONResponse(content={"status": "ok"})
+
+
+@app.get("/api/chat/warmup")
+@app.post("/api/chat/warmup")
+async def chat_warmup():
+    """
+    デプロイ直後やプラットフォームの定期実行から呼び出し、インスタンスを準備しておく。
+    準備済みであればすぐに返る。
+    """
+    cold = ChatbotSingleton._instance is None
+    timings = await warm_up()
+    chatbot = await ChatbotSingleton.get_instance()
+    if chatbot.init_error:
+        return JSONResponse(status_code=500, content={"error": chatbot.init_error})
+    return JSONResponse(content={"status": "ok", "cold": cold, "timings_ms": timings})
+
+
+@app.get("/api/chat/stats")
+async def chat_stats(request: Request):
+    """意図分析のローカル判定率やキャッシュのヒット率などの統計を返す（管理用）"""
+    if not _is_admin_request(request):
+        return JSONResponse(status_code=403, content={"error": "権限がありません。"})
+
+    chatbot = await ChatbotSingleton.get_instance()
+    stats = {"intent": IntentStats.as_dict()}
+    if chatbot.embedding_cache:
+        stats["embedding_cache"] = chatbot.embedding_cache.stats()
+    if chatbot.answer_cache:
+        stats["answer_cache"] = chatbot.answer_cache.stats()
+    stats["tokens"] = TokenUsage.as_dict()
+    stats["context"] = ContextStats.as_dict()
+    stats["faq"] = FaqStats.as_dict()
+    if chatbot.lexical_index:
+        stats["lexical"] = {
+            **LexicalStats.as_dict(),
+            "items": chatbot.lexical_index.item_count,
+        }
+    if chatbot.http_pools:
+        stats["http_pools"] = {
+            name: pool.stats() for name, pool in chatbot.http_pools.items()
+        }
+    stats["upstreams"] = {
+        limiter.name: limiter.stats() for limiter in UPSTREAM_LIMITERS
+    }
+    if chatbot.inflight:
+        stats["singleflight"] = chatbot.inflight.stats()
+    if chatbot.shared_state:
+        stats["shared_state"] = chatbot.shared_state.stats(
+            [
+                cache
+                for cache in (
+                    chatbot.catalog,
+                    chatbot.vector_index,
+                    chatbot.lexical_index,
+                )
+                if cache
+            ]
+        )
+    return JSONResponse(content=stats)
+
+
+def render_metrics(chatbot: ChatbotSingleton) -> str:
+    """Prometheus のテキスト形式でメトリクスを出力する"""
+    lines = STAGE_LATENCY.render() + REQUEST_LATENCY.render()
+
+    def metric(name: str, kind: str, help_text: str, samples: list):
+        lines.extend([f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"])
+        for labels, value in samples:
+            lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+
+    caches = {
+        name: cache.stats()
+        for name, cache in (
+            ("embedding", chatbot.embedding_cache),
+            ("answer", chatbot.answer_cache),
+        )
+        if cache
+    }
+    metric(
+        "chat_cache_hits_total",
+        "counter",
+        "キャッシュのヒット数",
+        [(f'cache="{name}"', stats["hits"]) for name, stats in caches.items()],
+    )
+    metric(
+        "chat_cache_misses_total",
+        "counter",
+        "キャッシュのミス数",
+        [(f'cache="{name}"', stats["misses"]) for name, stats in caches.items()],
+    )
+    metric(
+        "chat_cache_hit_ratio",
+        "gauge",
+        "キャッシュのヒット率",
+        [(f'cache="{name}"', stats["hit_ratio"]) for name, stats in caches.items()],
+    )
+    metric(
+        "chat_cache_entries",
+        "gauge",
+        "キャッシュの保持件数",
+        [(f'cache="{name}"', stats["entries"]) for name, stats in caches.items()],
+    )
+    intent = IntentStats.as_dict()
+    metric(
+        "chat_intent_total",
+        "counter",
+        "意図分析の件数（local: ローカル判定で完結 / llm: LLMにフォールバック）",
+        [
+            ('path="local"', intent["fast_path"]),
+            ('path="llm"', intent["llm_fallback"]),
+        ],
+    )
+    metric(
+        "chat_faq_lookups_total",
+        "counter",
+        "事前定義された応答・FAQ の照合を行った質問数",
+        [("", FaqStats.lookups)],
+    )
+    metric(
+        "chat_faq_hits_total",
+        "counter",
+        "定型回答で応答した件数（source: faq / predefined, tier: lexical / embedding）",
+        [
+            (f'source="{source}",tier="{tier}",entry="{entry_id}"', count)
+            for (source, tier, entry_id), count in sorted(FaqStats.hits.items())
+        ],
+    )
+    metric(
+        "chat_lexical_total",
+        "counter",
+        "字句検索の件数（decisive: 埋め込みを省略 / fused: ベクトル検索と統合）",
+        [
+            ('result="decisive"', LexicalStats.decisive),
+            ('result="fused"', LexicalStats.fused),
+        ],
+    )
+    metric(
+        "chat_llm_tokens_total",
+        "counter",
+        "LLMの消費トークン数",
+        [
+            (f'call="{call}",kind="{kind}"', count)
+            for (call, kind), count in sorted(TokenUsage.tokens.items())
+        ],
     )
+    if chatbot.inflight:
+        inflight = chatbot.inflight.stats()
+        metric(
+            "chat_singleflight_total",
+            "counter",
+            "回答生成の件数（leader: 実行 / coalesced: 実行中の同じ質問に合流）",
+            [
+                ('role="leader"', inflight["leaders"]),
+                ('role="coalesced"', inflight["coalesced"]),
+            ],
+        )
+        metric(
+            "chat_singleflight_in_flight",
+            "gauge",
+            "実行中の回答生成の数",
+            [("", inflight["in_flight"])],
+        )
+    upstreams = {limiter.name: limiter.stats() for limiter in UPSTREAM_LIMITERS}
+    for key, kind, help_text in (
+        ("active", "gauge", "上流ごとの実行中の呼び出し数"),
+        ("waiting", "gauge", "上流ごとの待ち行列の長さ"),
+        ("rejected", "counter", "待ち行列が満杯・待ち時間超過で断った呼び出し数"),
+        ("timeouts", "counter", "期限切れになった呼び出し数"),
+        ("rate_limited", "counter", "上流からレート制限された呼び出し数"),
+        ("degraded", "counter", "混雑時に省略した呼び出し数"),
+    ):
+        metric(
+            f"chat_upstream_{key}" + ("_total" if kind == "counter" else ""),
+            kind,
+            help_text,
+            [(f'upstream="{name}"', stats[key]) for name, stats in upstreams.items()],
+        )
+    pools = {name: pool.stats() for name, pool in (chatbot.http_pools or {}).items()}
+    metric(
+        "chat_http_connections",
+        "gauge",
+        "上流ごとのHTTP接続数（in_use: 使用中 / idle: keep-alive で待機中）",
+        [
+            (f'pool="{name}",state="{state}"', stats[state])
+            for name, stats in pools.items()
+            for state in ("in_use", "idle")
+        ],
+    )
+    for key, help_text in (
+        ("requests", "上流へのHTTPリクエスト数"),
+        ("waits", "全接続が使用中で空きを待ったリクエスト数"),
+        ("connections_opened", "新規に確立したHTTP接続数"),
+        ("tls_handshakes", "TLSハンドシェイクの回数"),
+    ):
+        metric(
+            f"chat_http_{key}_total",
+            "counter",
+            help_text,
+            [(f'pool="{name}"', stats[key]) for name, stats in pools.items()],
+        )
+    context = ContextStats.as_dict()
+    metric(
+        "chat_context_tokens_total",
+        "counter",
+        "最終LLMのコンテキストのトークン数（used: 採用 / trimmed: 予算超過で削除 / "
+        "duplicate: 重複で除外）",
+        [
+            (f'kind="{kind}"', context[f"{kind}_tokens"])
+            for kind in ("used", "trimmed", "duplicate")
+        ],
+    )
+    return "\n".join(lines) + "\n"
 
-    response_chain = prompt | chatbot.llm
-    answer = await response_chain.ainvoke({"context": final_context, "question": query})
 
-    return answer.content
+@app.get("/metrics")
+@app.get("/api/chat/metrics")
+async def chat_metrics(request: Request):
+    """ステージごとの所要時間のヒストグラム・キャッシュのヒット率・トークン数（管理用）"""
+    if not _is_admin_request(request):
+        return JSONResponse(status_code=403, content={"error": "権限がありません。"})
+
+    chatbot = await ChatbotSingleton.get_instance()
+    return PlainTextResponse(
+        render_metrics(chatbot), media_type="text/plain; version=0.0.4"
+    )
 
 
 @app.post("/api/chat")
@@ -583,7 +1976,8 @@ async def handle_chat(request: Request):
         logger.info("1. chatbot_instance_retrieved")
 
         data = await request.json()
-        logger.info(f"2. request_body_parsed: {data}")
+        logger.info("2. request_body_parsed")
+        logger.debug("  - 2.1 request_body: %s", data)
 
         user_query = data.get("message")
         if not user_query:
@@ -592,14 +1986,18 @@ async def handle_chat(request: Request):
                 status_code=400, content={"error": "メッセージが必要です。"}
             )
 
-        logger.info(f"3. user_query_extracted: '{user_query}'")
+        logger.info("3. user_query_extracted: '%s'", user_query)
 
         final_answer = await generate_final_answer(chatbot, user_query)
-        logger.info(f"4. final_answer_generated: '{final_answer}'")
+        logger.info("4. final_answer_generated: %d chars", len(final_answer))
+        logger.debug("  - 4.1 final_answer: '%s'", final_answer)
 
         response = JSONResponse(content={"reply": final_answer})
         logger.info("5. response_prepared. returning...")
         return response
+    except UpstreamUnavailable as e:
+        logger.warning(f"[Upstream] handle_chat shed: {e}")
+        return overloaded_response(e)
     except Exception as e:
         error_details = traceback.format_exc()
         logger.error("!!! UNHANDLED EXCEPTION in handle_chat !!!")
@@ -611,3 +2009,100 @@ async def handle_chat(request: Request):
                 "error": "予期せぬ内部サーバーエラーが発生しました。詳細はログを確認してください。"
             },
         )
+
+
+@app.post("/api/chat/batch")
+async def handle_chat_batch(request: Request):
+    """
+    複数の質問にまとめて回答する（回答の一括検証やキャッシュの事前ウォームアップ用）。
+    リクエスト: {"messages": ["...", ...]} / レスポンス: {"replies": [{"reply": "..."}, ...]}
+    """
+    logger.info("--- handle_chat_batch_invoked ---")
+    if not _is_admin_request(request):
+        return JSONResponse(status_code=403, content={"error": "権限がありません。"})
+
+    try:
+        chatbot = await ChatbotSingleton.get_instance()
+        if chatbot.init_error:
+            logger.error(f"!!! Initialization Error Intercepted: {chatbot.init_error}")
+            return JSONResponse(status_code=500, content={"error": chatbot.init_error})
+
+        data = await request.json()
+        messages = data.get("messages")
+        if (
+            not isinstance(messages, list)
+            or not messages
+            or not all(isinstance(m, str) and m for m in messages)
+        ):
+            return JSONResponse(
+                status_code=400,
+                content={"error": "messages に質問文の配列を指定してください。"},
+            )
+        if len(messages) > BATCH_MAX_MESSAGES:
+            return JSONResponse(
+                status_code=400,
+                content={
+                    "error": f"一度に送信できる質問は{BATCH_MAX_MESSAGES}件までです。"
+                },
+            )
+
+        replies = await generate_batch_answers(chatbot, messages)
+        return JSONResponse(content={"replies": replies})
+    except Exception as e:
+        logger.error("!!! UNHANDLED EXCEPTION in handle_chat_batch !!!")
+        logger.error(f"Error: {e}")
+        logger.error(f"Traceback:\n{traceback.format_exc()}")
+        return JSONResponse(
+            status_code=500,
+            content={
+                "error": "予期せぬ内部サーバーエラーが発生しました。詳細はログを確認してください。"
+            },
+        )
+
+
+@app.post("/api/chat/stream")
+async def handle_chat_stream(request: Request):
+    """/api/chat のストリーミング版。回答を server-sent events で逐次返す"""
+    logger.info("--- handle_chat_stream_invoked ---")
+    try:
+        chatbot = await ChatbotSingleton.get_instance()
+
+        if chatbot.init_error:
+            logger.error(f"!!! Initialization Error Intercepted: {chatbot.init_error}")
+            return JSONResponse(status_code=500, content={"error": chatbot.init_error})
+
+        data = await request.json()
+        user_query = data.get("message")
+        if not user_query:
+            logger.warning("!!! 'message' key not found in request")
+            return JSONResponse(
+                status_code=400, content={"error": "メッセージが必要です。"}
+            )
+        logger.info("3. user_query_extracted: '%s'", user_query)
+
+        # 回答の生成を待ち行列に入れられない状態なら、ストリームを開始せずに断る
+        if LLM_LIMITER.is_full:
+            LLM_LIMITER.rejected += 1
+            raise UpstreamUnavailable(
+                LLM_LIMITER.name, 429, LLM_LIMITER.retry_after(), "queue is full"
+            )
+    except UpstreamUnavailable as e:
+        logger.warning(f"[Upstream] handle_chat_stream shed: {e}")
+        return overloaded_response(e)
+    except Exception as e:
+        logger.error("!!! UNHANDLED EXCEPTION in handle_chat_stream !!!")
+        logger.error(f"Error: {e}")
+        logger.error(f"Traceback:\n{traceback.format_exc()}")
+        return JSONResponse(
+            status_code=500,
+            content={
+                "error": "予期せぬ内部サーバーエラーが発生しました。詳細はログを確認してください。"
+            },
+        )
+
+    return StreamingResponse(
+        stream_final_answer(chatbot, user_query),
+        media_type="text/event-stream",
+        # プロキシでのバッファリングを無効化し、トークンを即座に届ける
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -0,0 +1,921 @@
+"""
+商品カタログ・ローカルベクトル検索・字句検索の索引
+"""
+
+import hashlib
+import heapq
+import json
+import math
+import mmap
+import os
+import re
+import unicodedata
+from bisect import bisect_left, bisect_right
+from collections import Counter, deque
+
+import numpy as np
+
+from settings import (
+    CATALOG_TTL_SECONDS,
+    LEXICAL_DECISIVE_MARGIN,
+    RRF_K,
+    VECTOR_INDEX_TTL_SECONDS,
+)
+from chat_logging import logger
+from limiters import SUPABASE_LIMITER, gather_or_cancel
+from shared_state import BackgroundRefreshCache, SharedState
+
+# --- ヘルパー関数: 高度な文字列正規化 ---
+# \s+ は1つ以上の任意の空白文字（スペース、タブ、改行など）にマッチ
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+def normalize_string(text: str) -> str:
+    """スペース、改行、タブなどの空白をすべて除去し、小文字に変換する"""
+    if not text:
+        return ""
+    text = WHITESPACE_PATTERN.sub("", text)
+    return text.lower()
+
+
+# --- 商品名の複数パターン同時マッチ（Aho-Corasick） ---
+class ProductNameMatcher:
+    """
+    正規化済みの商品名から構築した Aho-Corasick オートマトン。
+    クエリを1回走査するだけで含まれる全商品名を検出する。
+    """
+
+    def __init__(self, product_names):
+        self._goto: list[dict] = [{}]
+        self._fail: list[int] = [0]
+        # 各ノードで確定する (正規化後の長さ, 商品名) のリスト
+        self._output: list[list] = [[]]
+
+        for name in product_names:
+            key = normalize_string(name)
+            if not key:
+                continue
+            node = 0
+            for char in key:
+                next_node = self._goto[node].get(char)
+                if next_node is None:
+                    next_node = len(self._goto)
+                    self._goto[node][char] = next_node
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append([])
+                node = next_node
+            self._output[node].append((len(key), name))
+
+        # 幅優先で失敗リンクを張り、出力を継承する
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fallback = self._fail[node]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[child] = self._goto[fallback].get(char, 0)
+                self._output[child] = (
+                    self._output[child] + self._output[self._fail[child]]
+                )
+
+    def find_all(self, normalized_text: str) -> list[str]:
+        """テキスト中に含まれる商品名を、正規化後の長い順（同じ長さなら出現順）で返す"""
+        found: dict[str, int] = {}
+        node = 0
+        for char in normalized_text:
+            while node and char not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(char, 0)
+            for length, name in self._output[node]:
+                found.setdefault(name, length)
+        return sorted(found, key=lambda name: -found[name])
+
+
+# --- 価格順の商品索引 ---
+# 「前後」とみなす価格の幅（目標価格に対する割合）
+PRICE_AROUND_TOLERANCE = 0.3
+
+
+class PriceIndex:
+    """
+    価格が設定された商品を価格の昇順に並べた配列。
+    上位・下位 k 件、価格帯、指定価格の前後をいずれも二分探索 + k 件の走査で引く。
+    """
+
+    def __init__(self, products):
+        self.products = sorted(
+            (
+                product
+                for product in products
+                if isinstance(product.get("price"), (int, float))
+                and product["price"] > 0
+            ),
+            key=lambda product: product["price"],
+        )
+        self.prices = [product["price"] for product in self.products]
+
+    def __len__(self):
+        return len(self.products)
+
+    def _bounds(self, price_range: dict) -> tuple:
+        """価格帯の条件を満たす範囲 [lo, hi) を返す"""
+        lo, hi = 0, len(self.prices)
+        if price_range.get("min") is not None:
+            bisect = (
+                bisect_left if price_range.get("min_inclusive", True) else bisect_right
+            )
+            lo = bisect(self.prices, price_range["min"])
+        if price_range.get("max") is not None:
+            bisect = (
+                bisect_right if price_range.get("max_inclusive", True) else bisect_left
+            )
+            hi = bisect(self.prices, price_range["max"])
+        return lo, max(lo, hi)
+
+    def search(self, sort: str, limit: int, price_range: dict = None) -> list:
+        """価格帯（省略時は全商品）の中から安い順/高い順に limit 件を返す"""
+        lo, hi = self._bounds(price_range or {})
+        if sort == "desc":
+            return self.products[max(lo, hi - limit) : hi][::-1]
+        return self.products[lo : min(hi, lo + limit)]
+
+    def around(self, target: float, limit: int) -> list:
+        """target に近い順に limit 件を返す（PRICE_AROUND_TOLERANCE の幅の中から）"""
+        low, high = self._bounds(
+            {
+                "min": target * (1 - PRICE_AROUND_TOLERANCE),
+                "max": target * (1 + PRICE_AROUND_TOLERANCE),
+            }
+        )
+        right = bisect_left(self.prices, target, low, high)
+        left = right - 1
+        found = []
+        while len(found) < limit and (left >= low or right < high):
+            if right >= high or (
+                left >= low
+                and target - self.prices[left] <= self.prices[right] - target
+            ):
+                found.append(self.products[left])
+                left -= 1
+            else:
+                found.append(self.products[right])
+                right += 1
+        return found
+
+
+# --- 商品カタログのインメモリキャッシュ ---
+def format_product_context(product: dict) -> str:
+    """商品1件分のコンテキスト文字列を生成する"""
+    features = product.get("features", [])
+    features_str = (
+        ", ".join(features)
+        if isinstance(features, list)
+        else str(features) if features else ""
+    )
+    return f"[製品情報]\n商品名: {product.get('name')}\n価格: ¥{product.get('price')}\n説明: {product.get('description')}\n機能: {features_str}"
+
+
+class ProductCatalog(BackgroundRefreshCache):
+    """全商品の name / price / description / features を保持するキャッシュ"""
+
+    log_name = "Catalog"
+    shared_kind = "catalog"
+    shared_suffix = ".json"
+
+    def __init__(
+        self,
+        supabase_client,
+        ttl_seconds: float = CATALOG_TTL_SECONDS,
+        shared: SharedState = None,
+    ):
+        super().__init__(ttl_seconds, shared)
+        self._client = supabase_client
+        self.products: list[dict] = []
+        self.by_name: dict[str, dict] = {}
+        self.by_id: dict[str, dict] = {}
+        self.matcher = ProductNameMatcher([])
+        self.price_index = PriceIndex([])
+        self.version = 0
+        self.content_hash = None
+
+    async def _fetch(self) -> list:
+        response = await SUPABASE_LIMITER.call(
+            self._client.from_("products")
+            .select("id, name, description, price, features")
+            .execute()
+        )
+        return response.data or []
+
+    async def _reload(self) -> bool:
+        rows = await self._fetch()
+        content_hash = hashlib.sha256(
+            json.dumps(rows, sort_keys=True, default=str).encode()
+        ).hexdigest()
+        return self._apply_rows(rows, content_hash)
+
+    def _apply_rows(self, rows: list, content_hash: str) -> bool:
+        if content_hash == self.content_hash:
+            # 内容が変わっていなければ索引を作り直さない
+            return False
+
+        self.products = [row for row in rows if row.get("name")]
+        self.by_name = {row["name"]: row for row in self.products}
+        self.by_id = {row["id"]: row for row in self.products}
+        self.matcher = ProductNameMatcher(self.by_name)
+        self.price_index = PriceIndex(self.products)
+        self.content_hash = content_hash
+        self.version += 1
+        logger.info(
+            f"[Catalog] refreshed: {len(self.products)}件 (version={self.version})"
+        )
+        if self.version > 1:
+            self._notify_listeners()
+        return True
+
+    def _write_shared(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(
+                {"content_hash": self.content_hash, "rows": self.products},
+                f,
+                ensure_ascii=False,
+                default=str,
+            )
+
+    def _attach_shared(self, path: str):
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        self._apply_rows(data["rows"], data["content_hash"])
+
+
+# --- ローカルベクトル検索（match_docs / match_products のインメモリ版） ---
+def parse_embedding(value) -> np.ndarray:
+    """PostgREST が返す pgvector の値（"[0.1,...]" 形式の文字列または配列）を変換する"""
+    if isinstance(value, str):
+        value = json.loads(value)
+    return np.asarray(value, dtype=np.float32)
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """行ごとにL2正規化する（内積がそのままコサイン類似度になる）"""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def normalize_query(query_embedding) -> np.ndarray:
+    query = np.asarray(query_embedding, dtype=np.float32)
+    return query / (np.linalg.norm(query) or 1.0)
+
+
+def top_k_above(similarities: np.ndarray, threshold: float, count: int) -> np.ndarray:
+    """類似度が threshold を超える行のうち上位 count 件の位置を類似度の降順で返す"""
+    candidates = np.flatnonzero(similarities > threshold)
+    if len(candidates) > count:
+        candidates = candidates[
+            np.argpartition(-similarities[candidates], count - 1)[:count]
+        ]
+    return candidates[np.argsort(-similarities[candidates], kind="stable")]
+
+
+def pending_changes(table, changed_rows: list, alive_ids: set):
+    """
+    取り込み済みの内容と比べて実際に変わった行を返す。変更も削除もなければ None。
+    差分取得は updated_at >= 前回の最大値 で行うため、境界の行は毎回返ってくる。
+    """
+    versions = table.version_map()
+    changed_rows = [
+        row
+        for row in changed_rows
+        if row.get("embedding") is not None
+        and versions.get(row["id"]) != row.get("updated_at")
+    ]
+    if not changed_rows and alive_ids == versions.keys():
+        return None
+    return changed_rows
+
+
+class VectorTable:
+    """1テーブル分の正規化済み埋め込み行列と、各行のメタデータ"""
+
+    def __init__(self, table: str, columns: list, label_column: str = None):
+        self.table = table
+        self.columns = columns
+        self.label_column = label_column  # 絞り込みに使う列（doc_type 用の type）
+        self.rows: list[dict] = []
+        self.versions: list = []  # 各行の updated_at
+        self.matrix = np.zeros((0, 0), dtype=np.float32)
+        self.labels = np.array([], dtype=object)
+        self.synced_at = None  # 取り込み済みの updated_at の最大値
+
+    def __len__(self):
+        return len(self.rows)
+
+    def version_map(self) -> dict:
+        return {row["id"]: version for row, version in zip(self.rows, self.versions)}
+
+    def apply_changes(self, changed_rows: list, alive_ids: set):
+        """変更・追加された行を反映し、alive_ids に含まれない行を削除する"""
+        entries = {
+            row["id"]: (row, version, vector)
+            for row, version, vector in zip(self.rows, self.versions, self.matrix)
+        }
+        for row in changed_rows:
+            meta = {column: row.get(column) for column in self.columns}
+            vector = parse_embedding(row["embedding"])
+            entries[row["id"]] = (meta, row.get("updated_at"), vector)
+            if row.get("updated_at") and (
+                self.synced_at is None or row["updated_at"] > self.synced_at
+            ):
+                self.synced_at = row["updated_at"]
+
+        kept = [entries[row_id] for row_id in entries if row_id in alive_ids]
+        self.rows = [meta for meta, _, _ in kept]
+        self.versions = [version for _, version, _ in kept]
+        self.matrix = (
+            normalize_rows(np.stack([vector for _, _, vector in kept]))
+            if kept
+            else np.zeros((0, 0), dtype=np.float32)
+        )
+        if self.label_column:
+            self.labels = np.array(
+                [row[self.label_column] for row in self.rows], dtype=object
+            )
+
+    def search(self, query_embedding, threshold: float, count: int, label=None) -> list:
+        if not self.rows:
+            return []
+        similarities = self.matrix @ normalize_query(query_embedding)
+        if label is not None:
+            similarities = np.where(self.labels == label, similarities, -np.inf)
+        return [
+            {**self.rows[i], "similarity": float(similarities[i])}
+            for i in top_k_above(similarities, threshold, count)
+        ]
+
+
+# --- ベクトルスナップショット（コールドスタート用のメモリマップファイル） ---
+# ファイル構成:
+#   MAGIC(8バイト) | ヘッダー長(uint32 LE) | ヘッダー(JSON) | 各セクション（64バイト境界）
+# テーブルごとのセクション:
+#   vectors    : float32 ベクトル（正規化済み, 行 × 次元）
+#   label_codes: label_column の値のコード（uint16, 値の一覧はヘッダー）
+#   meta_offsets / meta: 各行のメタデータ（JSON）の開始位置と本体
+# ベクトルは量子化しない。numpy の整数演算には BLAS が使われず、int8 のまま計算しても
+# float32 に戻して計算しても、float32 の行列積より遅くなるため。float16 も同じで、
+# ファイルは半分になるが検索が約10倍遅くなる（benchmark.py recall の float16 の行）。
+VECTOR_SNAPSHOT_MAGIC = b"CHATVEC\x00"
+VECTOR_SNAPSHOT_FORMAT_VERSION = 2
+
+
+def write_vector_snapshot(path: str, tables: list):
+    """VectorTable の内容をスナップショットファイルに書き出す"""
+    sections = []  # (テーブル名, セクション名, バイト列)
+    header = {"format_version": VECTOR_SNAPSHOT_FORMAT_VERSION, "tables": {}}
+    for table in tables:
+        matrix = np.ascontiguousarray(table.matrix, dtype=np.float32)
+        meta = [
+            json.dumps({**row, "updated_at": version}, ensure_ascii=False).encode()
+            for row, version in zip(table.rows, table.versions)
+        ]
+        offsets = np.zeros(len(meta) + 1, dtype=np.uint64)
+        offsets[1:] = np.cumsum([len(item) for item in meta])
+        labels = []
+        if table.label_column:
+            labels = sorted({str(label) for label in table.labels})
+            codes = {label: i for i, label in enumerate(labels)}
+            label_codes = np.array(
+                [codes[str(label)] for label in table.labels], dtype=np.uint16
+            )
+        else:
+            label_codes = np.zeros(len(table), dtype=np.uint16)
+
+        header["tables"][table.table] = {
+            "count": len(table),
+            "dimension": int(matrix.shape[1]) if len(table) else 0,
+            "columns": table.columns,
+            "label_column": table.label_column,
+            "labels": labels,
+            "synced_at": table.synced_at,
+        }
+        for name, data in (
+            ("vectors", matrix.tobytes()),
+            ("label_codes", label_codes.tobytes()),
+            ("meta_offsets", offsets.tobytes()),
+            ("meta", b"".join(meta)),
+        ):
+            sections.append((table.table, name, data))
+
+    # ヘッダーにセクションの位置を書き込むため、ヘッダー長を確定させてから配置する
+    def layout(header_length: int):
+        offset = len(VECTOR_SNAPSHOT_MAGIC) + 4 + header_length
+        for table_name, name, data in sections:
+            offset += -offset % 64
+            header["tables"][table_name].setdefault("sections", {})[name] = [
+                offset,
+                len(data),
+            ]
+            offset += len(data)
+        return json.dumps(header).encode()
+
+    header_length = 0
+    while True:
+        encoded = layout(header_length)
+        if len(encoded) == header_length:
+            break
+        header_length = len(encoded)
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(VECTOR_SNAPSHOT_MAGIC)
+        f.write(len(encoded).to_bytes(4, "little"))
+        f.write(encoded)
+        for table_name, name, data in sections:
+            f.seek(header["tables"][table_name]["sections"][name][0])
+            f.write(data)
+    os.replace(tmp_path, path)
+
+
+class SnapshotTable:
+    """
+    スナップショットファイルをメモリマップした1テーブル分の索引（読み取り専用）。
+    VectorTable と同じく float32 ベクトルとの内積で厳密に検索する。
+    ファイルのページはOSのページキャッシュ経由で複数ワーカー間で共有される。
+    """
+
+    def __init__(self, name: str, info: dict, buffer):
+        self.table = name
+        self.columns = info["columns"]
+        self.label_column = info["label_column"]
+        self.synced_at = info["synced_at"]
+        self._label_names = info["labels"]
+        self._count = info["count"]
+        dimension = info["dimension"]
+        sections = info["sections"]
+
+        def view(section: str, dtype, shape):
+            offset, _ = sections[section]
+            count = int(np.prod(shape))
+            return np.frombuffer(buffer, dtype, count, offset).reshape(shape)
+
+        self.vectors = view("vectors", np.float32, (self._count, dimension))
+        self.label_codes = view("label_codes", np.uint16, (self._count,))
+        self._meta_offsets = view("meta_offsets", np.uint64, (self._count + 1,))
+        self._meta = memoryview(buffer)[sections["meta"][0] : sum(sections["meta"])]
+        self._versions = None
+
+    def __len__(self):
+        return self._count
+
+    def _row(self, i: int) -> dict:
+        start, end = int(self._meta_offsets[i]), int(self._meta_offsets[i + 1])
+        return json.loads(bytes(self._meta[start:end]))
+
+    def version_map(self) -> dict:
+        # 差分更新の判定でのみ使うため、初回呼び出し時に全行を読み込む
+        if self._versions is None:
+            rows = (self._row(i) for i in range(self._count))
+            self._versions = {row["id"]: row["updated_at"] for row in rows}
+        return self._versions
+
+    def to_vector_table(self) -> VectorTable:
+        """差分を反映できるよう、通常のインメモリ索引に展開する"""
+        table = VectorTable(self.table, self.columns, self.label_column)
+        rows = [self._row(i) for i in range(self._count)]
+        table.versions = [row.pop("updated_at") for row in rows]
+        table.rows = rows
+        table.matrix = np.array(self.vectors)
+        if self.label_column:
+            table.labels = np.array(
+                [row[self.label_column] for row in rows], dtype=object
+            )
+        table.synced_at = self.synced_at
+        return table
+
+    def search(self, query_embedding, threshold: float, count: int, label=None) -> list:
+        if not self._count:
+            return []
+        similarities = self.vectors @ normalize_query(query_embedding)
+        if label is not None:
+            if str(label) not in self._label_names:
+                return []
+            code = self._label_names.index(str(label))
+            similarities = np.where(self.label_codes == code, similarities, -np.inf)
+
+        results = []
+        for i in top_k_above(similarities, threshold, count).tolist():
+            row = self._row(i)
+            row.pop("updated_at")
+            results.append({**row, "similarity": float(similarities[i])})
+        return results
+
+
+def load_vector_snapshot(path: str) -> dict:
+    """スナップショットをメモリマップで開き、テーブル名 → SnapshotTable を返す"""
+    with open(path, "rb") as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if buffer[: len(VECTOR_SNAPSHOT_MAGIC)] != VECTOR_SNAPSHOT_MAGIC:
+        raise ValueError(f"not a vector snapshot: {path}")
+    start = len(VECTOR_SNAPSHOT_MAGIC) + 4
+    header_length = int.from_bytes(buffer[start - 4 : start], "little")
+    header = json.loads(buffer[start : start + header_length])
+    if header["format_version"] != VECTOR_SNAPSHOT_FORMAT_VERSION:
+        raise ValueError(
+            f"unsupported snapshot format version: {header['format_version']}"
+        )
+    return {
+        name: SnapshotTable(name, info, buffer)
+        for name, info in header["tables"].items()
+    }
+
+
+async def fetch_all_rows(
+    client, table: str, columns: str, since=None, page_size: int = 1000
+) -> list:
+    """テーブルの全行（since を指定した場合は updated_at がそれ以降の行）をページ単位で取得する"""
+    rows = []
+    while True:
+        query = client.from_(table).select(columns)
+        if since:
+            query = query.gte("updated_at", since)
+        response = await SUPABASE_LIMITER.call(
+            query.order("id").range(len(rows), len(rows) + page_size - 1).execute()
+        )
+        page = response.data or []
+        rows.extend(page)
+        if len(page) < page_size:
+            return rows
+
+
+class LocalVectorIndex(BackgroundRefreshCache):
+    """
+    doc_embeddings / product_embeddings をメモリに保持し、match_docs / match_products と
+    同じ条件（類似度が閾値を超えるものを類似度順に match_count 件）で検索する。
+    更新は updated_at を使った差分取得と、id一覧の突き合わせによる削除検出で行う。
+    snapshot_path を指定した場合、初回はDBを読まずにスナップショットを開き、
+    以降の更新で差分が見つかった時点でインメモリ索引に切り替える。
+    """
+
+    log_name = "VectorIndex"
+    shared_kind = "vectors"
+    shared_suffix = ".bin"
+    PAGE_SIZE = 1000
+
+    def __init__(
+        self,
+        supabase_client,
+        ttl_seconds: float = VECTOR_INDEX_TTL_SECONDS,
+        snapshot_path: str = None,
+        shared: SharedState = None,
+    ):
+        super().__init__(ttl_seconds, shared)
+        self._client = supabase_client
+        self.snapshot_path = snapshot_path
+        self._changes = 0  # 差分を反映した回数
+        self.docs = VectorTable(
+            "doc_embeddings", ["id", "type", "title", "content"], label_column="type"
+        )
+        self.products = VectorTable(
+            "product_embeddings", ["id", "product_id", "content"]
+        )
+
+    async def _fetch_all(self, table: str, columns: str, since=None) -> list:
+        return await fetch_all_rows(self._client, table, columns, since, self.PAGE_SIZE)
+
+    async def _sync(self, table):
+        alive_ids = {row["id"] for row in await self._fetch_all(table.table, "id")}
+        changed_rows = await self._fetch_all(
+            table.table,
+            ", ".join(table.columns + ["embedding", "updated_at"]),
+            since=table.synced_at,
+        )
+        changed_rows = pending_changes(table, changed_rows, alive_ids)
+        if changed_rows is None:
+            return table
+        if isinstance(table, SnapshotTable):
+            table = table.to_vector_table()
+        table.apply_changes(changed_rows, alive_ids)
+        self._changes += 1
+        return table
+
+    def _load_snapshot(self) -> bool:
+        try:
+            tables = load_vector_snapshot(self.snapshot_path)
+            self.docs = tables[self.docs.table]
+            self.products = tables[self.products.table]
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"[VectorIndex] snapshot unavailable, loading from DB: {e}")
+            return False
+        logger.info(
+            f"[VectorIndex] snapshot loaded: docs={len(self.docs)} "
+            f"products={len(self.products)}"
+        )
+        return True
+
+    async def _reload(self) -> bool:
+        if not self.is_loaded and self.snapshot_path and self._load_snapshot():
+            return True
+        changes = self._changes
+        self.docs, self.products = await gather_or_cancel(
+            self._sync(self.docs), self._sync(self.products)
+        )
+        logger.info(
+            f"[VectorIndex] synced: docs={len(self.docs)} products={len(self.products)}"
+        )
+        return self._changes != changes
+
+    def _write_shared(self, path: str):
+        tables = [
+            table.to_vector_table() if isinstance(table, SnapshotTable) else table
+            for table in (self.docs, self.products)
+        ]
+        write_vector_snapshot(path, tables)
+
+    def _attach_shared(self, path: str):
+        # メモリマップで開くので、索引の本体は全ワーカーで同じページを共有する
+        tables = load_vector_snapshot(path)
+        self.docs = tables[self.docs.table]
+        self.products = tables[self.products.table]
+        if self.is_loaded:
+            # ドキュメントが変わったので、それに基づく回答キャッシュなどを破棄させる
+            self._notify_listeners()
+
+    def match_docs(
+        self, query_embedding, match_threshold: float, match_count: int, doc_type=None
+    ) -> list:
+        return self.docs.search(
+            query_embedding, match_threshold, match_count, label=doc_type
+        )
+
+    def match_products(
+        self, query_embedding, match_threshold: float, match_count: int
+    ) -> list:
+        return self.products.search(query_embedding, match_threshold, match_count)
+
+
+# --- 字句検索（文字 n-gram の転置索引 + BM25） ---
+LEXICAL_RUN_PATTERN = re.compile(r"\w+")
+# 内容を表さない問いかけの言い回し（埋め込みを省略できるかの判定でのみ除く）
+LEXICAL_FILLER_PATTERN = re.compile(
+    r"について|を?教えて(ください|下さい)?|とは|ですか|ますか|でしょうか|ください|知りたい"
+)
+
+
+def char_ngrams(text: str) -> list:
+    """
+    日本語向けの索引語。NFKC 正規化・小文字化し、記号や空白で区切られた
+    文字の並びごとに文字 bi-gram / tri-gram を作る（形態素解析は使わない）。
+    「App 3」の「3」のような1文字だけの並びはそのまま索引語にする
+    """
+    grams = []
+    normalized = unicodedata.normalize("NFKC", text).lower()
+    for run in LEXICAL_RUN_PATTERN.findall(normalized):
+        if len(run) == 1:
+            grams.append(run)
+        for size in (2, 3):
+            grams.extend(run[i : i + size] for i in range(len(run) - size + 1))
+    return grams
+
+
+class LexicalIndex(BackgroundRefreshCache):
+    """
+    doc_embeddings のタイトル・本文と商品の名前・説明・機能の転置索引（BM25）。
+    ドキュメントは updated_at による差分取得、商品はカタログの更新のたびに、
+    変わった項目だけを索引から外して入れ直す。
+    """
+
+    log_name = "LexicalIndex"
+    shared_kind = "lexical"
+    shared_suffix = ".json"
+    K1 = 1.2
+    B = 0.75
+    # 埋め込みを省略する条件: 1位の項目が質問の索引語（問いかけの言い回しを除く）の
+    # この割合以上を含み、かつ1位のスコアが2位の LEXICAL_DECISIVE_MARGIN 倍以上
+    DECISIVE_COVERAGE = 0.8
+
+    def __init__(
+        self,
+        supabase_client,
+        catalog: ProductCatalog,
+        ttl_seconds: float = VECTOR_INDEX_TTL_SECONDS,
+        shared: SharedState = None,
+    ):
+        super().__init__(ttl_seconds, shared)
+        self._client = supabase_client
+        self._catalog = catalog
+        self._items = {}  # (種類, id) → {"text", "content", "version", "grams"}
+        self._postings = {}  # 索引語 → {(種類, id): 出現回数}
+        self._total_length = 0
+        self.docs_synced_at = None
+        self.catalog_version = None
+
+    @property
+    def item_count(self) -> int:
+        return len(self._items)
+
+    def _remove(self, key: tuple):
+        item = self._items.pop(key, None)
+        if item is None:
+            return
+        for gram in item["grams"]:
+            postings = self._postings[gram]
+            del postings[key]
+            if not postings:
+                del self._postings[gram]
+        self._total_length -= item["length"]
+
+    def _add(self, key: tuple, text: str, content: str, version):
+        self._remove(key)
+        grams = Counter(char_ngrams(text))
+        for gram, count in grams.items():
+            self._postings.setdefault(gram, {})[key] = count
+        length = sum(grams.values())
+        self._items[key] = {
+            "text": text,
+            "content": content,
+            "version": version,
+            "grams": grams,
+            "length": length,
+        }
+        self._total_length += length
+
+    async def _sync_docs(self) -> bool:
+        alive_ids = {
+            row["id"]
+            for row in await fetch_all_rows(self._client, "doc_embeddings", "id")
+        }
+        rows = await fetch_all_rows(
+            self._client,
+            "doc_embeddings",
+            "id, title, content, updated_at",
+            since=self.docs_synced_at,
+        )
+        changed = [
+            row
+            for row in rows
+            if row["id"] in alive_ids
+            and row.get("content")
+            and self._items.get(("doc", row["id"]), {}).get("version")
+            != row.get("updated_at")
+        ]
+        removed = [
+            key for key in self._items if key[0] == "doc" and key[1] not in alive_ids
+        ]
+        for row in changed:
+            text = f"{row.get('title') or ''}\n{row['content']}"
+            self._add(("doc", row["id"]), text, row["content"], row.get("updated_at"))
+            if row.get("updated_at") and (
+                self.docs_synced_at is None or row["updated_at"] > self.docs_synced_at
+            ):
+                self.docs_synced_at = row["updated_at"]
+        for key in removed:
+            self._remove(key)
+        return bool(changed or removed)
+
+    def _sync_products(self) -> bool:
+        if self._catalog.version == self.catalog_version:
+            return False
+        changed = False
+        alive = set()
+        for product in self._catalog.products:
+            key = ("product", product["id"])
+            alive.add(key)
+            content = format_product_context(product)
+            if self._items.get(key, {}).get("content") != content:
+                features = product.get("features") or []
+                if not isinstance(features, str):
+                    features = " ".join(map(str, features))
+                text = (
+                    f"{product['name']}\n{product.get('description') or ''}\n{features}"
+                )
+                self._add(key, text, content, None)
+                changed = True
+        for key in [key for key in self._items if key[0] == "product"]:
+            if key not in alive:
+                self._remove(key)
+                changed = True
+        self.catalog_version = self._catalog.version
+        return changed
+
+    async def _reload(self) -> bool:
+        await self._catalog.get()
+        changed = await self._sync_docs()
+        changed = self._sync_products() or changed
+        if changed:
+            logger.info(
+                f"[LexicalIndex] synced: items={len(self._items)} "
+                f"terms={len(self._postings)}"
+            )
+        return changed
+
+    def _write_shared(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "docs_synced_at": self.docs_synced_at,
+                    "items": [
+                        [key[0], key[1], item["text"], item["content"], item["version"]]
+                        for key, item in self._items.items()
+                    ],
+                },
+                f,
+                ensure_ascii=False,
+                default=str,
+            )
+
+    def _attach_shared(self, path: str):
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        # 公開された版との差分だけを入れ直す
+        alive = set()
+        for kind, item_id, text, content, version in data["items"]:
+            key = (kind, item_id)
+            alive.add(key)
+            item = self._items.get(key)
+            if item is None or item["text"] != text or item["content"] != content:
+                self._add(key, text, content, version)
+        for key in [key for key in self._items if key not in alive]:
+            self._remove(key)
+        self.docs_synced_at = data["docs_synced_at"]
+
+    def search(self, query: str, count: int) -> tuple:
+        """
+        BM25 で上位 count 件を返す。返り値は (項目のリスト, 埋め込みを省略してよいか)。
+        項目は {"kind": "doc" | "product", "id", "content", "score"}
+        """
+        if not self._items:
+            return [], False
+        average_length = self._total_length / len(self._items) or 1.0
+        total = len(self._items)
+        scores = {}
+        for gram in set(char_ngrams(query)):
+            postings = self._postings.get(gram)
+            if not postings:
+                continue
+            df = len(postings)
+            idf = math.log(1 + (total - df + 0.5) / (df + 0.5))
+            for key, tf in postings.items():
+                norm = self.K1 * (
+                    1 - self.B + self.B * self._items[key]["length"] / average_length
+                )
+                scores[key] = scores.get(key, 0.0) + idf * tf * (self.K1 + 1) / (
+                    tf + norm
+                )
+        top = heapq.nlargest(max(count, 2), scores.items(), key=lambda kv: kv[1])
+        hits = [
+            {
+                "kind": key[0],
+                "id": key[1],
+                "content": self._items[key]["content"],
+                "score": score,
+            }
+            for key, score in top[:count]
+        ]
+        return hits, self._is_decisive(query, top)
+
+    def _is_decisive(self, query: str, top: list) -> bool:
+        if not top or LEXICAL_DECISIVE_MARGIN <= 0:
+            return False
+        best_key, best_score = top[0]
+        if len(top) > 1 and best_score < LEXICAL_DECISIVE_MARGIN * top[1][1]:
+            return False
+        grams = set(char_ngrams(LEXICAL_FILLER_PATTERN.sub(" ", query)))
+        if not grams:
+            return False
+        covered = sum(1 for gram in grams if gram in self._items[best_key]["grams"])
+        return covered >= self.DECISIVE_COVERAGE * len(grams)
+
+
+class LexicalStats:
+    """字句検索の結果で埋め込みを省略した件数と、ベクトル検索と統合した件数を集計する"""
+
+    decisive = 0
+    fused = 0
+
+    @classmethod
+    def as_dict(cls) -> dict:
+        total = cls.decisive + cls.fused
+        return {
+            "decisive": cls.decisive,
+            "fused": cls.fused,
+            "embedding_skip_ratio": round(cls.decisive / total, 4) if total else 0.0,
+        }
+
+
+def reciprocal_rank_fusion(*rankings: list, k: int = None) -> list:
+    """
+    複数の順位付きリストを RRF（各リストでの順位 r について 1 / (k + r) の和）で統合し、
+    (スコア, 項目) をスコアの降順で返す。同じ項目はリスト間で同じ値で表す
+    """
+    k = RRF_K if k is None else k
+    scores = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, start=1):
+            scores[item] = scores.get(item, 0.0) + 1.0 / (k + rank)
+    return sorted(
+        ((score, item) for item, score in scores.items()),
+        key=lambda pair: pair[0],
+        reverse=True,
+    )
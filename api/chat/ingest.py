@@ -0,0 +1,334 @@
+"""
+ドキュメント・商品の埋め込みの取り込みスクリプト
+
+docs の Markdown を scripts/embed-documents.ts と同じ規則・同じタイトルでチャンクに分け、
+商品は products テーブルから scripts/generate-product-embeddings.ts と同じ形式の
+テキストにして、doc_embeddings / product_embeddings に保存する。
+DBに保存済みの本文と比べ、新しいチャンクと変わったチャンクだけを
+embed_documents でまとめて埋め込み（同時実行数の上限・再試行つき）、まとめて upsert する。
+
+使い方（api/chat ディレクトリで実行）:
+    python ingest.py                  # ドキュメントと商品
+    python ingest.py --docs --dry-run # 埋め込み直すチャンクを表示するだけ
+    python ingest.py --products --all # 変更の有無に関わらず埋め込み直す
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import re
+import sys
+import time
+
+import index
+import indexes
+
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../..")
+# (ファイル, doc_embeddings.type)
+DOC_SOURCES = (
+    ("docs/FAQ.md", "faq"),
+    ("docs/ユーザーガイド_JA.md", "guide"),
+    ("docs/ユーザーガイド詳細_JA.md", "guide_detail"),
+    ("docs/PRIVACY_POLICY.md", "privacy"),
+    ("docs/TERMS_OF_SERVICE.md", "terms"),
+)
+CHUNK_CHARS = 1000
+MIN_CHUNK_CHARS = 10
+PRODUCT_COLUMNS = (
+    "id, name, description, long_desc, price, category, tags, features, requirements"
+)
+RETRY_BASE_SECONDS = 1.0
+
+QA_SEPARATOR = re.compile(r"\n---+\n")
+QUESTION_PATTERN = re.compile(r"\*\*Q[:：](.*?)\*\*", re.DOTALL)
+SECTION_SEPARATOR = re.compile(r"\n(?=#+ )")
+HEADING_PATTERN = re.compile(r"^#+\s*(.+)")
+
+
+def _split_sections(text: str) -> list:
+    """見出しごとに分け、長いセクションは CHUNK_CHARS 文字ずつに切る"""
+    chunks = []
+    for section in SECTION_SEPARATOR.split(text):
+        heading = HEADING_PATTERN.match(section)
+        title = heading.group(1).strip() if heading else section[:30]
+        content = section.strip()
+        for i in range(0, len(content), CHUNK_CHARS):
+            chunks.append((title, content[i : i + CHUNK_CHARS]))
+    return chunks
+
+
+def split_markdown(text: str, doc_type: str) -> list:
+    """
+    (タイトル, 本文) のリスト。FAQ は「---」区切りの Q&A 単位（「**Q: ...**」がタイトル）、
+    それ以外と Q&A 形式でない FAQ は見出し単位で分ける。
+    doc_embeddings は (type, title) で upsert するため、同じタイトルの2つ目以降には
+    「(2)」のように番号を付ける（同じタイトルのチャンクが上書きし合わないように）
+    """
+    if doc_type == "faq":
+        chunks = []
+        for block in QA_SEPARATOR.split(text):
+            question = QUESTION_PATTERN.search(block)
+            if question:
+                chunks.append((question.group(1).strip(), block.strip()))
+            else:
+                chunks.extend(_split_sections(block))
+    else:
+        chunks = _split_sections(text)
+
+    seen = {}
+    unique = []
+    for title, content in chunks:
+        if len(content) < MIN_CHUNK_CHARS:
+            continue
+        seen[title] = seen.get(title, 0) + 1
+        unique.append(
+            (title if seen[title] == 1 else f"{title} ({seen[title]})", content)
+        )
+    return unique
+
+
+def build_doc_chunks(sources=DOC_SOURCES) -> list:
+    """doc_embeddings に保存する行（埋め込みを除く）"""
+    chunks = []
+    for path, doc_type in sources:
+        with open(os.path.join(REPO_ROOT, path), encoding="utf-8") as f:
+            text = f.read()
+        chunks.extend(
+            {"type": doc_type, "title": title, "content": content}
+            for title, content in split_markdown(text, doc_type)
+        )
+    return chunks
+
+
+def _join(values) -> str:
+    if isinstance(values, list):
+        return ", ".join(map(str, values))
+    return str(values or "")
+
+
+def format_product_text(product: dict) -> str:
+    """product_embeddings に保存する商品のテキスト"""
+    price = product.get("price")
+    return "\n".join(
+        [
+            f"商品名: {product.get('name')}",
+            f"価格: ¥{price:,}" if isinstance(price, int) else f"価格: ¥{price}",
+            f"カテゴリ: {product.get('category') or ''}",
+            f"説明: {product.get('description') or ''}",
+            f"詳細: {product.get('long_desc') or ''}",
+            f"タグ: {_join(product.get('tags'))}",
+            f"機能: {_join(product.get('features'))}",
+            f"要件: {_join(product.get('requirements'))}",
+        ]
+    )
+
+
+def _is_retryable(error: Exception) -> bool:
+    # レート制限・サーバーエラー・通信エラーは再試行し、それ以外の 4xx は再試行しない
+    status_code = getattr(error, "status_code", None)
+    return status_code is None or status_code == 429 or status_code >= 500
+
+
+async def embed_texts(
+    emb, texts: list, batch_size: int, concurrency: int, retries: int
+) -> tuple:
+    """
+    texts を batch_size 件ずつ embed_documents で埋め込む（同時に concurrency 件まで）。
+    失敗したバッチは指数バックオフで retries 回まで再試行する。
+    返り値は (テキスト → ベクトル, API呼び出し回数)
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    calls = 0
+
+    async def embed_batch(batch: list) -> list:
+        nonlocal calls
+        async with semaphore:
+            for attempt in range(retries + 1):
+                calls += 1
+                try:
+                    return await emb.aembed_documents(batch)
+                except Exception as e:
+                    if attempt == retries or not _is_retryable(e):
+                        raise
+                    delay = RETRY_BASE_SECONDS * 2**attempt * random.uniform(1, 1.5)
+                    index.logger.warning(
+                        f"[Ingest] embedding failed ({e}), retrying in {delay:.1f}s"
+                    )
+                    await asyncio.sleep(delay)
+
+    batches = [texts[i : i + batch_size] for i in range(0, len(texts), batch_size)]
+    results = await asyncio.gather(*(embed_batch(batch) for batch in batches))
+    vectors = {}
+    for batch, batch_vectors in zip(batches, results):
+        vectors.update(zip(batch, batch_vectors))
+    return vectors, calls
+
+
+async def _write_in_batches(build_query, rows: list, batch_size: int):
+    for i in range(0, len(rows), batch_size):
+        await build_query(rows[i : i + batch_size]).execute()
+
+
+async def ingest_docs(client, emb, chunks: list, options) -> dict:
+    """doc_embeddings を chunks に合わせる。返り値は件数の集計"""
+    existing = await indexes.fetch_all_rows(
+        client, "doc_embeddings", "id, type, title, content"
+    )
+    stored = {(row["type"], row["title"]): row for row in existing}
+    changed = [
+        chunk
+        for chunk in chunks
+        if options.all
+        or stored.get((chunk["type"], chunk["title"]), {}).get("content")
+        != chunk["content"]
+    ]
+    # 取り込み対象の type のうち、今回のチャンクにない行（削除・改名されたセクション）
+    managed_types = {chunk["type"] for chunk in chunks}
+    keys = {(chunk["type"], chunk["title"]) for chunk in chunks}
+    stale_ids = [
+        row["id"]
+        for key, row in stored.items()
+        if key[0] in managed_types and key not in keys
+    ]
+    report = {
+        "chunks": len(chunks),
+        "unchanged": len(chunks) - len(changed),
+        "embedded": len(changed),
+        "stale": len(stale_ids),
+    }
+    if options.dry_run:
+        for chunk in changed:
+            print(f"  embed: {chunk['type']} - {chunk['title']}")
+        return report
+
+    texts = list(dict.fromkeys(chunk["content"] for chunk in changed))
+    vectors, report["embedding_calls"] = await embed_texts(
+        emb, texts, options.batch_size, options.concurrency, options.retries
+    )
+    rows = [{**chunk, "embedding": vectors[chunk["content"]]} for chunk in changed]
+    await _write_in_batches(
+        lambda batch: client.from_("doc_embeddings").upsert(
+            batch, on_conflict="type,title"
+        ),
+        rows,
+        options.write_batch_size,
+    )
+    if options.prune and stale_ids:
+        await _write_in_batches(
+            lambda batch: client.from_("doc_embeddings").delete().in_("id", batch),
+            stale_ids,
+            options.write_batch_size,
+        )
+        report["deleted"] = len(stale_ids)
+    return report
+
+
+async def ingest_products(client, emb, options) -> dict:
+    """product_embeddings を products テーブルに合わせる。返り値は件数の集計"""
+    products = await indexes.fetch_all_rows(client, "products", PRODUCT_COLUMNS)
+    existing = await indexes.fetch_all_rows(
+        client, "product_embeddings", "product_id, content"
+    )
+    # product_id は一意（1商品1行）。商品の削除は外部キーの ON DELETE CASCADE で反映される
+    stored = {row["product_id"]: row["content"] for row in existing}
+    changed = []
+    for product in products:
+        text = format_product_text(product)
+        if options.all or stored.get(product["id"]) != text:
+            changed.append((product, text))
+    report = {
+        "chunks": len(products),
+        "unchanged": len(products) - len(changed),
+        "embedded": len(changed),
+        "stale": 0,
+    }
+    if options.dry_run:
+        for product, _ in changed:
+            print(f"  embed: product - {product['name']}")
+        return report
+
+    texts = list(dict.fromkeys(text for _, text in changed))
+    vectors, report["embedding_calls"] = await embed_texts(
+        emb, texts, options.batch_size, options.concurrency, options.retries
+    )
+    rows = [
+        {"product_id": product["id"], "content": text, "embedding": vectors[text]}
+        for product, text in changed
+    ]
+    await _write_in_batches(
+        lambda batch: client.from_("product_embeddings").upsert(
+            batch, on_conflict="product_id"
+        ),
+        rows,
+        options.write_batch_size,
+    )
+    return report
+
+
+def print_report(name: str, report: dict, seconds: float):
+    print(
+        f"{name}: chunks={report['chunks']} unchanged={report['unchanged']} "
+        f"embedded={report['embedded']} "
+        f"embedding_calls={report.get('embedding_calls', 0)} "
+        f"stale={report['stale']} deleted={report.get('deleted', 0)} "
+        f"({seconds:.1f} s)"
+    )
+
+
+async def run(options) -> bool:
+    chatbot = await index.ChatbotSingleton.get_instance()
+    if chatbot.init_error:
+        print(f"初期化に失敗しました: {chatbot.init_error}")
+        return False
+
+    both = not options.docs and not options.products
+    if options.docs or both:
+        started = time.perf_counter()
+        report = await ingest_docs(
+            chatbot.supabase_client, chatbot.emb, build_doc_chunks(), options
+        )
+        print_report("doc_embeddings", report, time.perf_counter() - started)
+    if options.products or both:
+        started = time.perf_counter()
+        report = await ingest_products(chatbot.supabase_client, chatbot.emb, options)
+        print_report("product_embeddings", report, time.perf_counter() - started)
+    return True
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--docs", action="store_true", help="ドキュメントのみ")
+    parser.add_argument("--products", action="store_true", help="商品のみ")
+    parser.add_argument(
+        "--all", action="store_true", help="変更がなくてもすべて埋め込み直す"
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="埋め込み直す項目を表示するだけ"
+    )
+    parser.add_argument(
+        "--prune",
+        action="store_true",
+        help="ドキュメントから消えたセクションの行を削除する",
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=100, help="1回の埋め込みの件数"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=4, help="埋め込みの同時実行数"
+    )
+    parser.add_argument("--retries", type=int, default=3)
+    parser.add_argument(
+        "--write-batch-size", type=int, default=100, help="1回の upsert の行数"
+    )
+    return parser
+
+
+def main():
+    options = build_parser().parse_args()
+    ok = asyncio.run(run(options))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
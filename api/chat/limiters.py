@@ -0,0 +1,313 @@
+"""
+上流（OpenAI / Supabase）呼び出しの同時実行数制限と並行実行のヘルパー
+"""
+
+import asyncio
+import math
+import time
+from collections import deque
+from contextlib import asynccontextmanager, suppress
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+from errors import UpstreamUnavailable
+from settings import (
+    EMBEDDING_MAX_CONCURRENCY,
+    EMBEDDING_TIMEOUT_SECONDS,
+    LLM_MAX_CONCURRENCY,
+    LLM_TIMEOUT_SECONDS,
+    SUPABASE_MAX_CONCURRENCY,
+    SUPABASE_TIMEOUT_SECONDS,
+    UPSTREAM_DEGRADE_WAIT_SECONDS,
+    UPSTREAM_MAX_QUEUE,
+    UPSTREAM_QUEUE_TIMEOUT_SECONDS,
+)
+from chat_logging import logger
+from metrics import span
+
+
+# --- 上流（OpenAI / Supabase）呼び出しの同時実行数制限 ---
+def parse_retry_after(value: str):
+    """
+    Retry-After ヘッダー（秒数または HTTP-date）を待つべき秒数にする。
+    解釈できない場合は None
+    """
+    value = (value or "").strip()
+    if not value:
+        return None
+    try:
+        return max(0, math.ceil(float(value)))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0, math.ceil((retry_at - datetime.now(timezone.utc)).total_seconds()))
+
+
+class UpstreamLimiter:
+    """
+    上流ごとの同時実行数を制限する。空きがなければ待ち行列（先着順）で待ち、
+    行列が埋まっている・待ち時間が上限を超えた場合は UpstreamUnavailable(429) を送出する。
+    asyncio.Semaphore と違いイベントループに束縛されないので、モジュール単位で共有できる。
+    """
+
+    def __init__(self, name: str, max_concurrency: int, max_queue: int, timeout: float):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.active = 0
+        self._waiters = deque()
+        self.admitted = 0
+        self.rejected = 0  # 待ち行列が満杯、または待ち時間の上限で断った件数
+        self.timeouts = 0  # 呼び出しの期限切れ
+        self.rate_limited = 0  # 上流からのレート制限（429）
+        self.degraded = 0  # 混雑時に呼び出し自体を省略した件数
+        self.avg_seconds = 0.0  # 呼び出し1回の所要時間の指数移動平均
+
+    @property
+    def is_saturated(self) -> bool:
+        """空きがなく、新たな呼び出しは待ち行列に入る状態か"""
+        return self.active >= self.max_concurrency
+
+    @property
+    def is_full(self) -> bool:
+        """待ち行列も埋まっており、新たな呼び出しは断られる状態か"""
+        return self.is_saturated and len(self._waiters) >= self.max_queue
+
+    def estimated_wait(self) -> float:
+        """待ち行列の末尾の呼び出しが枠を得るまでの見積もり（秒）"""
+        if not self._waiters:
+            return 0.0
+        return len(self._waiters) / self.max_concurrency * self.avg_seconds
+
+    @property
+    def is_congested(self) -> bool:
+        """待ち時間の見積もりが UPSTREAM_DEGRADE_WAIT_SECONDS を超え、省略すべき状態か"""
+        return (
+            UPSTREAM_DEGRADE_WAIT_SECONDS > 0
+            and self.estimated_wait() > UPSTREAM_DEGRADE_WAIT_SECONDS
+        )
+
+    def retry_after(self) -> int:
+        """待ち行列が捌けるまでの目安（秒）"""
+        per_call = self.avg_seconds or 1.0
+        backlog = (len(self._waiters) + 1) / self.max_concurrency
+        return max(1, math.ceil(backlog * per_call))
+
+    def _reject(self, reason: str, status_code: int = 429):
+        self.rejected += 1
+        logger.warning(
+            f"[Upstream] {self.name} rejected: {reason} "
+            f"(active={self.active}, waiting={len(self._waiters)})"
+        )
+        raise UpstreamUnavailable(self.name, status_code, self.retry_after(), reason)
+
+    async def _acquire(self):
+        if self.active < self.max_concurrency and not self._waiters:
+            self.active += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            self._reject("queue is full")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            with span(f"{self.name}_queue"):
+                await asyncio.wait_for(waiter, UPSTREAM_QUEUE_TIMEOUT_SECONDS)
+        except BaseException as e:
+            if waiter.done() and not waiter.cancelled():
+                # 枠を譲り受けた直後にキャンセルされた場合は次に回す
+                self._release()
+            else:
+                # キャンセル済みの waiter は _release が先に取り除いていることがある
+                with suppress(ValueError):
+                    self._waiters.remove(waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                self._reject("queue wait timed out")
+            raise
+
+    def _release(self):
+        # 枠は減らさずに待ち行列の先頭へ直接引き渡す
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    @asynccontextmanager
+    async def slot(self):
+        """枠を1つ確保する（ストリーミングなど、期限を呼び出し側で扱う場合）"""
+        await self._acquire()
+        self.admitted += 1
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            # openai.RateLimitError（import を遅らせるため型ではなく status_code で判定）
+            if (
+                isinstance(e, UpstreamUnavailable)
+                or getattr(e, "status_code", 0) != 429
+            ):
+                raise
+            self.rate_limited += 1
+            response = getattr(e, "response", None)
+            retry_after = parse_retry_after(
+                response.headers.get("retry-after") if response is not None else None
+            )
+            raise UpstreamUnavailable(
+                self.name,
+                503,
+                self.retry_after() if retry_after is None else max(1, retry_after),
+                "rate limited by upstream",
+            ) from e
+        finally:
+            elapsed = time.perf_counter() - started
+            self.avg_seconds = (
+                0.8 * self.avg_seconds + 0.2 * elapsed if self.avg_seconds else elapsed
+            )
+            self._release()
+
+    async def call(self, aw):
+        """枠を確保してコルーチン aw を期限付きで実行する"""
+        try:
+            async with self.slot():
+                try:
+                    return await asyncio.wait_for(aw, self.timeout)
+                except asyncio.TimeoutError as e:
+                    self.timeouts += 1
+                    raise UpstreamUnavailable(
+                        self.name, 503, self.retry_after(), "deadline exceeded"
+                    ) from e
+        finally:
+            # 枠を確保できず実行されなかった場合の「never awaited」警告を抑止
+            aw.close()
+
+    async def stream(self, chunks):
+        """
+        枠を確保して非同期ジェネレーター chunks を読み進める（ストリーミング用）。
+        call() と同じ期限を、枠を得てからの経過時間に対して設ける
+        """
+        try:
+            async with self.slot():
+                loop = asyncio.get_running_loop()
+                deadline = loop.time() + self.timeout
+                while True:
+                    try:
+                        chunk = await asyncio.wait_for(
+                            anext(chunks), max(deadline - loop.time(), 0)
+                        )
+                    except StopAsyncIteration:
+                        return
+                    except asyncio.TimeoutError as e:
+                        self.timeouts += 1
+                        raise UpstreamUnavailable(
+                            self.name, 503, self.retry_after(), "deadline exceeded"
+                        ) from e
+                    yield chunk
+        finally:
+            await chunks.aclose()
+
+    def stats(self) -> dict:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "active": self.active,
+            "waiting": len(self._waiters),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+            "rate_limited": self.rate_limited,
+            "degraded": self.degraded,
+        }
+
+
+LLM_LIMITER = UpstreamLimiter(
+    "llm", LLM_MAX_CONCURRENCY, UPSTREAM_MAX_QUEUE, LLM_TIMEOUT_SECONDS
+)
+EMBEDDING_LIMITER = UpstreamLimiter(
+    "embedding",
+    EMBEDDING_MAX_CONCURRENCY,
+    UPSTREAM_MAX_QUEUE,
+    EMBEDDING_TIMEOUT_SECONDS,
+)
+SUPABASE_LIMITER = UpstreamLimiter(
+    "supabase", SUPABASE_MAX_CONCURRENCY, UPSTREAM_MAX_QUEUE, SUPABASE_TIMEOUT_SECONDS
+)
+UPSTREAM_LIMITERS = (LLM_LIMITER, EMBEDDING_LIMITER, SUPABASE_LIMITER)
+
+
+# --- 並行実行のヘルパー ---
+async def gather_or_cancel(*aws):
+    """全て並行実行し、いずれかが失敗したら残りをキャンセルして例外を再送出する"""
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+
+def discard_task(task: asyncio.Task):
+    """投機的に開始したタスクを破棄する（完了済みなら例外を回収して警告を抑止）"""
+    if task is None:
+        return
+    if not task.done():
+        task.cancel()
+    elif not task.cancelled():
+        task.exception()
+
+
+class SingleFlight:
+    """
+    同じキーの処理が実行中なら新たに開始せず、その結果（例外も含む）を共有する。
+    処理は呼び出し元とは別のタスクで実行し、待っている呼び出し元が全員キャンセル
+    （クライアントの切断など）された場合にだけ処理自体をキャンセルする。
+    """
+
+    def __init__(self):
+        self._calls = {}  # キー → (タスク, 待機中の呼び出し元の数を持つリスト)
+        self.leaders = 0
+        self.coalesced = 0  # 実行中の処理に合流した件数（= 省略できた上流呼び出し）
+
+    async def run(self, key, factory):
+        call = self._calls.get(key)
+        if call is None:
+            task = asyncio.ensure_future(factory())
+            call = self._calls[key] = (task, [0])
+            task.add_done_callback(lambda _: self._forget(key, call))
+            self.leaders += 1
+            return await self._wait(call)
+
+        self.coalesced += 1
+        logger.info("[SingleFlight] joined in-flight request (waiters=%d)", call[1][0])
+        with span("coalesced"):
+            return await self._wait(call)
+
+    async def _wait(self, call):
+        task, waiters = call
+        waiters[0] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            waiters[0] -= 1
+            if waiters[0] == 0 and not task.done():
+                task.cancel()
+
+    def _forget(self, key, call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    def stats(self) -> dict:
+        total = self.leaders + self.coalesced
+        return {
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "in_flight": len(self._calls),
+            "coalesced_ratio": round(self.coalesced / total, 4) if total else 0.0,
+        }
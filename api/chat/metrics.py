@@ -0,0 +1,122 @@
+"""
+処理ステージごとの計測（Server-Timing / Prometheus 形式の /metrics）とトークン数の集計
+"""
+
+import asyncio
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# --- 処理ステージごとの計測（Server-Timing ヘッダー / Prometheus 形式の /metrics） ---
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class LatencyHistogram:
+    """ラベルごとの所要時間（秒）のヒストグラム"""
+
+    def __init__(self, name: str, help_text: str, label: str):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        # ラベル値 → [各バケットの件数..., 合計秒数, 件数]
+        self._series: dict[str, list] = {}
+
+    def observe(self, label_value: str, seconds: float):
+        series = self._series.setdefault(
+            label_value, [0] * len(LATENCY_BUCKETS) + [0.0, 0]
+        )
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                series[i] += 1
+                break
+        series[-2] += seconds
+        series[-1] += 1
+
+    def render(self) -> list:
+        lines = [
+            f"# HELP {self.name} {self.help_text}",
+            f"# TYPE {self.name} histogram",
+        ]
+        for label_value, series in sorted(self._series.items()):
+            label = f'{self.label}="{label_value}"'
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {series[-1]}')
+            lines.append(f"{self.name}_sum{{{label}}} {series[-2]:.6f}")
+            lines.append(f"{self.name}_count{{{label}}} {series[-1]}")
+        return lines
+
+
+STAGE_LATENCY = LatencyHistogram(
+    "chat_stage_duration_seconds", "回答処理のステージごとの所要時間", "stage"
+)
+REQUEST_LATENCY = LatencyHistogram(
+    "chat_request_duration_seconds", "エンドポイントごとのレスポンスまでの時間", "route"
+)
+
+# 現在のリクエストで計測したステージ → 所要時間（秒）。
+# create_task で起動したタスクにもコンテキストごと引き継がれる
+request_timings_var: ContextVar = ContextVar("request_timings", default=None)
+
+
+def _record_span(name: str, seconds: float):
+    STAGE_LATENCY.observe(name, seconds)
+    timings = request_timings_var.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+@contextmanager
+def span(name: str):
+    """with ブロックの所要時間をステージ name として記録する"""
+    started = time.perf_counter()
+    try:
+        yield
+    except asyncio.CancelledError:
+        # 投機的に開始して破棄した処理は計測に含めない
+        raise
+    except Exception:
+        _record_span(name, time.perf_counter() - started)
+        raise
+    _record_span(name, time.perf_counter() - started)
+
+
+def mark_degraded(stage: str):
+    """混雑で stage を省略したことを Server-Timing に記録する（degraded_{stage};dur=0）"""
+    timings = request_timings_var.get()
+    if timings is not None:
+        timings[f"degraded_{stage}"] = 0.0
+
+
+async def traced(name: str, aw):
+    """awaitable の完了までをステージ name として記録する（create_task 用）"""
+    with span(name):
+        return await aw
+
+
+def format_server_timing(timings: dict) -> str:
+    return ", ".join(
+        f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items()
+    )
+
+
+class TokenUsage:
+    """LLM呼び出しの用途（intent / answer）ごとの消費トークン数を集計する"""
+
+    tokens: dict = {}  # (用途, "prompt" / "completion") → トークン数
+
+    @classmethod
+    def record(cls, call: str, message):
+        usage = getattr(message, "usage_metadata", None)
+        if not usage:
+            return
+        for kind, key in (("prompt", "input_tokens"), ("completion", "output_tokens")):
+            cls.tokens[(call, kind)] = cls.tokens.get((call, kind), 0) + usage.get(
+                key, 0
+            )
+
+    @classmethod
+    def as_dict(cls) -> dict:
+        return {f"{call}_{kind}": count for (call, kind), count in cls.tokens.items()}
@@ -0,0 +1,129 @@
+"""
+チャットAPIの設定（定数と環境変数）
+"""
+
+import os
+
+# --- 設定定数 ---
+MATCH_THRESHOLD = 0.05
+MATCH_COUNT = 5
+
+# --- .envファイルのパスを動的に検索して読み込む ---
+# Vercel では環境変数はプラットフォームから渡され .env も配置されないため、探索を省く
+if not os.environ.get("VERCEL"):
+    from dotenv import load_dotenv, find_dotenv
+
+    dotenv_path = find_dotenv()
+    if dotenv_path:
+        load_dotenv(dotenv_path=dotenv_path, override=True)
+    else:
+        load_dotenv(override=True)  # フォールバック
+
+# --- 環境変数で調整可能な設定 ---
+# 商品カタログキャッシュの有効期間（秒）。期限切れ後の最初のアクセスでバックグラウンド更新する
+CATALOG_TTL_SECONDS = float(os.environ.get("CATALOG_TTL_SECONDS", "300"))
+# ローカル意図分類の確信度がこの値未満の場合のみLLMで意図分析する
+INTENT_CONFIDENCE_THRESHOLD = float(
+    os.environ.get("INTENT_CONFIDENCE_THRESHOLD", "0.8")
+)
+# クエリ埋め込みキャッシュの最大件数（LRUで古いものから破棄）
+EMBEDDING_CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", "1000"))
+# 指定するとクエリ埋め込みキャッシュをこのファイルに保存し、再起動後も引き継ぐ
+EMBEDDING_CACHE_PATH = os.environ.get("EMBEDDING_CACHE_PATH")
+# 回答キャッシュ: 類似とみなすコサイン距離の上限、有効期間（秒）、最大件数
+ANSWER_CACHE_MAX_DISTANCE = float(os.environ.get("ANSWER_CACHE_MAX_DISTANCE", "0.05"))
+ANSWER_CACHE_TTL_SECONDS = float(os.environ.get("ANSWER_CACHE_TTL_SECONDS", "3600"))
+ANSWER_CACHE_SIZE = int(os.environ.get("ANSWER_CACHE_SIZE", "500"))
+# バッチ処理: 1リクエストあたりの最大件数と、同時に処理するクエリ数の上限
+BATCH_MAX_MESSAGES = int(os.environ.get("BATCH_MAX_MESSAGES", "200"))
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", "4"))
+# 最終LLMに渡すコンテキストのトークン数の上限と、トークン数を数えるエンコーディング
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "2000"))
+CONTEXT_TOKENIZER = os.environ.get("CONTEXT_TOKENIZER", "o200k_base")
+# tiktoken のエンコーディングを同梱するディレクトリ（build_tokenizer.py で作成する）
+CONTEXT_TOKENIZER_DIR = os.environ.get(
+    "CONTEXT_TOKENIZER_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "tiktoken-cache"),
+)
+# 既に採用した段落との文字3-gramの Jaccard 係数がこの値以上なら重複として除外する
+CONTEXT_DEDUP_THRESHOLD = float(os.environ.get("CONTEXT_DEDUP_THRESHOLD", "0.7"))
+# 上流ごとの同時実行数の上限（プロセス単位）
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", "8"))
+EMBEDDING_MAX_CONCURRENCY = int(os.environ.get("EMBEDDING_MAX_CONCURRENCY", "16"))
+SUPABASE_MAX_CONCURRENCY = int(os.environ.get("SUPABASE_MAX_CONCURRENCY", "16"))
+# 上限に達した上流ごとの待ち行列の長さと、待ち時間の上限（秒）。超えたら 429 を返す
+UPSTREAM_MAX_QUEUE = int(os.environ.get("UPSTREAM_MAX_QUEUE", "64"))
+UPSTREAM_QUEUE_TIMEOUT_SECONDS = float(
+    os.environ.get("UPSTREAM_QUEUE_TIMEOUT_SECONDS", "5")
+)
+# 待ち行列で待つ時間の見積もりがこの秒数を超えたら、省略できる呼び出しを省略する（0 で無効）
+UPSTREAM_DEGRADE_WAIT_SECONDS = float(
+    os.environ.get("UPSTREAM_DEGRADE_WAIT_SECONDS", "0.5")
+)
+# 上流の呼び出し1回あたりの期限（秒）。超えたら 503 を返す
+LLM_TIMEOUT_SECONDS = float(os.environ.get("LLM_TIMEOUT_SECONDS", "30"))
+EMBEDDING_TIMEOUT_SECONDS = float(os.environ.get("EMBEDDING_TIMEOUT_SECONDS", "10"))
+SUPABASE_TIMEOUT_SECONDS = float(os.environ.get("SUPABASE_TIMEOUT_SECONDS", "10"))
+# "1" の場合、doc_embeddings / product_embeddings をメモリに読み込みローカルでベクトル検索する
+LOCAL_VECTOR_INDEX = os.environ.get("LOCAL_VECTOR_INDEX", "").lower() in ("1", "true")
+# ローカルベクトル索引の差分更新の間隔（秒）
+VECTOR_INDEX_TTL_SECONDS = float(os.environ.get("VECTOR_INDEX_TTL_SECONDS", "300"))
+# ローカルベクトル索引の初期状態として読み込むスナップショット（build_snapshot.py で作成）
+VECTOR_SNAPSHOT_PATH = os.environ.get("VECTOR_SNAPSHOT_PATH")
+# 複数ワーカーで商品カタログ・ベクトル索引を共有するディレクトリ（/dev/shm 配下を推奨）。
+# 設定すると1つのワーカーだけがDBから読み込んで公開し、他のワーカーはそれを読み取る
+SHARED_STATE_DIR = os.environ.get("SHARED_STATE_DIR")
+# 読み取り側のワーカーが公開中の版を確認する間隔（秒）
+SHARED_STATE_POLL_SECONDS = float(os.environ.get("SHARED_STATE_POLL_SECONDS", "5"))
+# 起動直後、公開担当のワーカーが最初の版を公開するのを待つ時間の上限（秒）
+SHARED_STATE_WAIT_SECONDS = float(os.environ.get("SHARED_STATE_WAIT_SECONDS", "30"))
+# "1" の場合、doc_embeddings のタイトル・本文と商品情報の文字 n-gram 索引（BM25）を作り、
+# ベクトル検索の結果と順位を統合する
+LEXICAL_INDEX = os.environ.get("LEXICAL_INDEX", "").lower() in ("1", "true")
+# 字句検索の1位のスコアが2位のこの倍数以上で、質問の語をほぼ含む場合は埋め込みを省略する（0 で無効）
+LEXICAL_DECISIVE_MARGIN = float(os.environ.get("LEXICAL_DECISIVE_MARGIN", "2.0"))
+# 字句検索とベクトル検索の順位を統合する RRF（reciprocal rank fusion）の定数 k
+RRF_K = int(os.environ.get("RRF_K", "60"))
+# "1" の場合、起動時にバックグラウンドでクライアント生成・カタログ読み込みなどを済ませる
+WARMUP_ON_STARTUP = os.environ.get("WARMUP_ON_STARTUP", "1").lower() in ("1", "true")
+# OpenAI / Supabase それぞれと共有するHTTP接続プールの設定
+HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", "20"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(
+    os.environ.get("HTTP_MAX_KEEPALIVE_CONNECTIONS", "10")
+)
+# 使われていない接続を保持する時間（秒）。httpx の既定（5秒）より長くしてTLSの再接続を減らす
+HTTP_KEEPALIVE_EXPIRY_SECONDS = float(
+    os.environ.get("HTTP_KEEPALIVE_EXPIRY_SECONDS", "60")
+)
+HTTP_CONNECT_TIMEOUT_SECONDS = float(
+    os.environ.get("HTTP_CONNECT_TIMEOUT_SECONDS", "5")
+)
+HTTP_READ_TIMEOUT_SECONDS = float(os.environ.get("HTTP_READ_TIMEOUT_SECONDS", "60"))
+# 空き接続を待つ時間の上限（秒）
+HTTP_POOL_TIMEOUT_SECONDS = float(os.environ.get("HTTP_POOL_TIMEOUT_SECONDS", "5"))
+# "1" の場合、h2 がインストールされていれば HTTP/2 で接続する
+HTTP2_ENABLED = os.environ.get("HTTP2_ENABLED", "1").lower() in ("1", "true")
+# ウォームアップ時に上流ごとに確立しておく接続数
+HTTP_PREWARM_CONNECTIONS = int(os.environ.get("HTTP_PREWARM_CONNECTIONS", "2"))
+# よくある質問の定型回答の表（build_faq.py で docs/FAQ.md から作成）
+FAQ_PATH = os.environ.get(
+    "FAQ_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "faq.json")
+)
+# FAQ の正規表現による照合を行う質問の最大文字数（正規化後）
+FAQ_MAX_QUERY_CHARS = int(os.environ.get("FAQ_MAX_QUERY_CHARS", "40"))
+# FAQ の質問の埋め込みとのコサイン類似度がこの値以上なら定型回答を返す（0 で無効）
+FAQ_EMBEDDING_THRESHOLD = float(os.environ.get("FAQ_EMBEDDING_THRESHOLD", "0"))
+# FAQ の質問の埋め込み（build_faq.py --embed で作成）。ないものは初回に埋め込む
+FAQ_EMBEDDINGS_PATH = os.environ.get(
+    "FAQ_EMBEDDINGS_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "faq-embeddings.npz"),
+)
+# 管理用エンドポイント（キャッシュ無効化など）の認証トークン。未設定の場合は無効
+CHAT_ADMIN_TOKEN = os.environ.get("CHAT_ADMIN_TOKEN")
+# ログのレベルと出力形式（text / json）
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text").lower()
+# "1" の場合、ログの書き出しを別スレッドで行い、イベントループを書き込みで止めない
+LOG_ASYNC = os.environ.get("LOG_ASYNC", "").lower() in ("1", "true")
+# リクエストごとの詳細ログ（WARNING 未満）を出力するリクエストの割合（0.0〜1.0）
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", "1.0"))
@@ -0,0 +1,316 @@
+"""
+ワーカー間で共有する状態と、DBの内容を保持するキャッシュの共通処理
+"""
+
+import asyncio
+import json
+import os
+import time
+import uuid
+from contextlib import asynccontextmanager
+
+from settings import SHARED_STATE_POLL_SECONDS, SHARED_STATE_WAIT_SECONDS
+from chat_logging import logger
+
+
+# --- ワーカー間で共有する状態（商品カタログ・ベクトル索引） ---
+class SharedState:
+    """
+    複数ワーカーが共有するディレクトリ（/dev/shm などのメモリ上のファイルシステム）。
+    公開担当のワーカー（ロックを取れた1プロセス）がDBから読み込んだ内容をファイルに書き、
+    他のワーカーはそれを読み取る。公開はデータファイルを書き終えてから参照先
+    （{kind}.current.json）を os.replace で差し替えるため、書きかけの状態は見えない。
+    メモリまで共有するのはメモリマップで開くベクトル索引のみで、商品カタログと字句索引は
+    公開された JSON を各ワーカーが自分のヒープに読み込む（共有されるのはDBの読み込み）。
+    """
+
+    POINTER_SUFFIX = ".current.json"
+    KEEP_VERSIONS = 2  # 公開中の版を含めて残すデータファイルの数
+    WAIT_INTERVAL_SECONDS = 0.1
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._lock_file = None
+        self.published = 0
+        self.attached = 0
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    @property
+    def is_publisher(self) -> bool:
+        return self._lock_file is not None
+
+    def acquire_publisher(self) -> bool:
+        """
+        公開担当のロックを取る（取得済みなら True）。担当のプロセスが終了すると
+        ロックが外れ、次に更新を確認したワーカーが引き継ぐ
+        """
+        if self._lock_file is None:
+            import fcntl
+
+            lock_file = open(self._path("publisher.lock"), "a")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return False
+            self._lock_file = lock_file
+            logger.info(
+                f"[SharedState] publishing from this worker (pid={os.getpid()})"
+            )
+        return True
+
+    def close(self):
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    @asynccontextmanager
+    async def writing(self, kind: str):
+        """
+        kind の読み込みから公開までを1プロセスずつに限る。公開担当と、管理用エンドポイントで
+        更新した他のワーカーが同時に公開して、新しい版を古い内容で上書きしないように
+        """
+        import fcntl
+
+        lock_file = open(self._path(f"{kind}.write.lock"), "a")
+        try:
+            await asyncio.to_thread(fcntl.flock, lock_file, fcntl.LOCK_EX)
+            yield
+        finally:
+            lock_file.close()
+
+    def current(self, kind: str):
+        """公開中の版（{"id", "path", "published_at"}）。未公開なら None"""
+        try:
+            with open(self._path(kind + self.POINTER_SUFFIX), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    async def wait_for(self, kind: str, timeout: float):
+        """
+        最初の版が公開されるのを待つ。公開担当のワーカーが終了していて
+        自分が担当になった場合は None を返す（自分で読み込んで公開する）
+        """
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            pointer = self.current(kind)
+            if pointer is not None or self.acquire_publisher():
+                return pointer
+            await asyncio.sleep(self.WAIT_INTERVAL_SECONDS)
+        return None
+
+    def publish(self, kind: str, suffix: str, write) -> dict:
+        """write(path) でデータファイルを書き、参照先を差し替えて新しい版として公開する"""
+        version_id = uuid.uuid4().hex
+        path = self._path(f"{kind}-{version_id}{suffix}")
+        write(path)
+        pointer = {"id": version_id, "path": path, "published_at": time.time()}
+        pointer_path = self._path(kind + self.POINTER_SUFFIX)
+        tmp_path = f"{pointer_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(pointer, f)
+        os.replace(tmp_path, pointer_path)
+        self.published += 1
+        self._remove_old_versions(kind, suffix, path)
+        return pointer
+
+    def _remove_old_versions(self, kind: str, suffix: str, current_path: str):
+        # メモリマップ済みのファイルは削除しても読み取り側の参照は有効なまま
+        paths = [
+            self._path(name)
+            for name in os.listdir(self.directory)
+            if name.startswith(f"{kind}-") and name.endswith(suffix)
+        ]
+        paths = sorted(
+            (path for path in paths if path != current_path),
+            key=os.path.getmtime,
+            reverse=True,
+        )
+        for path in paths[self.KEEP_VERSIONS - 1 :]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def stats(self, caches: list) -> dict:
+        versions = {}
+        for cache in caches:
+            pointer = self.current(cache.shared_kind)
+            versions[cache.shared_kind] = {
+                "attached": cache.shared_version,
+                "current": pointer["id"] if pointer else None,
+                "age_seconds": (
+                    round(time.time() - pointer["published_at"], 1) if pointer else None
+                ),
+            }
+        return {
+            "directory": self.directory,
+            "role": "publisher" if self.is_publisher else "follower",
+            "published": self.published,
+            "attached": self.attached,
+            "versions": versions,
+        }
+
+
+# --- DBの内容を保持するキャッシュの共通処理 ---
+class BackgroundRefreshCache:
+    """
+    DBから読み込んだ内容を保持するキャッシュの基底クラス。
+    TTL経過後は古いデータを返しつつバックグラウンドで再取得し、
+    invalidate() で明示的に無効化できる。サブクラスは _reload()（内容が変わったら
+    True を返す）を実装する。shared を指定した場合、公開担当のワーカーだけがDBから
+    読み込んで公開し（_write_shared）、他のワーカーは公開中の版を読み込む（_attach_shared）。
+    """
+
+    log_name = "Cache"
+    shared_kind = None  # 共有ディレクトリでのファイル名
+    shared_suffix = ""
+
+    def __init__(self, ttl_seconds: float, shared: SharedState = None):
+        self.ttl_seconds = ttl_seconds
+        self.is_loaded = False
+        self.loaded_at = 0.0
+        # 最後の読み込みを始めた時刻と、invalidate() のたびに増える世代
+        self._load_started_at = 0.0
+        self._generation = 0
+        self._lock = asyncio.Lock()
+        self._refresh_task = None
+        self._listeners = []
+        self.shared = shared
+        self.shared_version = None  # 読み込み済み（または公開した）版のID
+
+    def add_listener(self, callback):
+        """内容が変化した更新のたびに呼ばれるコールバックを登録する"""
+        self._listeners.append(callback)
+
+    def _notify_listeners(self):
+        for callback in self._listeners:
+            callback(self)
+
+    @property
+    def is_stale(self) -> bool:
+        ttl = self.ttl_seconds
+        if self.shared and not self.shared.is_publisher:
+            # 公開中の版の確認はファイルを読むだけなので短い間隔で行う
+            ttl = min(ttl, SHARED_STATE_POLL_SECONDS)
+        return time.monotonic() - self.loaded_at > ttl
+
+    async def _reload(self) -> bool:
+        raise NotImplementedError
+
+    def _write_shared(self, path: str):
+        raise NotImplementedError
+
+    def _attach_shared(self, path: str):
+        raise NotImplementedError
+
+    async def refresh(self, from_source: bool = False, if_unloaded: bool = False):
+        """
+        DBから再取得してキャッシュを差し替える。共有状態を使う場合、DBを読むのは
+        公開担当のワーカーと from_source=True（管理用エンドポイントからの更新）のみ。
+        どちらも SharedState.writing で公開を1ワーカーずつに限る。
+        if_unloaded=True では、ロック待ちの間に読み込み済みになっていれば何もしない
+        """
+        requested_at = time.monotonic()
+        async with self._lock:
+            if self._load_started_at > requested_at or (if_unloaded and self.is_loaded):
+                # ロック待ちの間に、要求より後に始まった読み込み（初回の読み込みを
+                # 待っていた場合はどの読み込みでもよい）が終わっている
+                return
+            self._load_started_at = time.monotonic()
+            generation = self._generation
+            if self.shared is None:
+                await self._reload()
+            elif from_source or self.shared.acquire_publisher():
+                await self._reload_and_publish()
+            else:
+                await self._follow()
+            if generation == self._generation:
+                # 読み込み中に invalidate() された場合は期限切れのまま残す
+                self.loaded_at = time.monotonic()
+            self.is_loaded = True
+
+    async def _reload_and_publish(self):
+        # DBの読み込みもロックの中で行い、後から公開するワーカーほど新しい内容を読む
+        async with self.shared.writing(self.shared_kind):
+            changed = await self._reload()
+            pointer = self.shared.current(self.shared_kind)
+            if (
+                not changed
+                and pointer is not None
+                and pointer["id"] == self.shared_version
+            ):
+                return
+            # 書き出しはファイルI/Oなのでスレッドで行う（その間も古い版で応答を続ける）
+            pointer = await asyncio.to_thread(
+                self.shared.publish,
+                self.shared_kind,
+                self.shared_suffix,
+                self._write_shared,
+            )
+        # 公開したファイルを読み直し、自分も他のワーカーと同じページを共有する
+        self._attach_shared(pointer["path"])
+        self.shared_version = pointer["id"]
+        logger.info(f"[{self.log_name}] published version {pointer['id'][:8]}")
+
+    async def _follow(self):
+        pointer = self.shared.current(self.shared_kind)
+        if pointer is None and not self.is_loaded:
+            pointer = await self.shared.wait_for(
+                self.shared_kind, SHARED_STATE_WAIT_SECONDS
+            )
+        if pointer is None:
+            if not self.is_loaded:
+                # 公開担当が見つからない（または自分が担当になった）ので自分で読み込む
+                await self._reload_and_publish()
+            return
+        if pointer["id"] == self.shared_version:
+            return
+        try:
+            self._attach_shared(pointer["path"])
+        except (OSError, ValueError, KeyError) as e:
+            # 読み込む前にさらに新しい版で置き換えられた場合など。次の確認で読み直す
+            logger.warning(f"[{self.log_name}] failed to attach shared version: {e}")
+            if not self.is_loaded:
+                await self._reload_and_publish()
+            return
+        self.shared_version = pointer["id"]
+        self.shared.attached += 1
+        logger.info(f"[{self.log_name}] attached shared version {pointer['id'][:8]}")
+
+    async def _refresh_in_background(self):
+        try:
+            generation = None
+            # 更新中に invalidate() されたら、その後に始まる読み込みをもう一度行う
+            while generation != self._generation:
+                generation = self._generation
+                await self.refresh()
+        except Exception as e:
+            # 更新に失敗しても既存のキャッシュで応答を続ける
+            logger.warning(f"[{self.log_name}] background refresh failed: {e}")
+
+    def _schedule_refresh(self):
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._refresh_in_background())
+
+    async def get(self):
+        """
+        ホットパス用の取得。初回のみ読み込みを待ち、
+        以降は期限切れでも即座に返してバックグラウンドで更新する。
+        """
+        if not self.is_loaded:
+            await self.refresh(if_unloaded=True)
+        elif self.is_stale:
+            self._schedule_refresh()
+        return self
+
+    def invalidate(self, *_):
+        """キャッシュを期限切れ扱いにし、次回アクセスを待たずに再取得を開始する"""
+        self._generation += 1
+        self.loaded_at = 0.0
+        if self.is_loaded:
+            self._schedule_refresh()
@@ -21,38 +21,53 @@ const embeddings = new OpenAIEmbeddings({
 	model: "text-embedding-3-small",
 });
 
+type Chunk = { title: string; content: string };
+
+// セクション単位（# or ## 見出しごと）、1000文字ごとにさらに分割
+function splitSections(text: string): Chunk[] {
+	const chunks: Chunk[] = [];
+	const sections = text.split(/\n(?=#+ )/);
+	for (const section of sections) {
+		const titleMatch = section.match(/^#+\s*(.+)/);
+		const title = titleMatch ? titleMatch[1].trim() : section.slice(0, 30);
+		const content = section.trim();
+		for (let i = 0; i < content.length; i += 1000) {
+			chunks.push({ title, content: content.slice(i, i + 1000) });
+		}
+	}
+	return chunks;
+}
+
 // チャンク分割（Q&A単位、セクション単位、1000文字程度）
-function splitMarkdown(
-	text: string,
-	type: string
-): { title: string; content: string }[] {
-	const chunks: { title: string; content: string }[] = [];
+// api/chat/ingest.py の split_markdown と同じ規則・同じタイトルにする
+function splitMarkdown(text: string, type: string): Chunk[] {
+	const chunks: Chunk[] = [];
 	if (type === "faq") {
-		// Q&A単位で分割
+		// Q&A単位で分割（Q&A 形式でないブロックはセクション単位）
 		const qaBlocks = text.split(/\n---+\n/);
 		for (const block of qaBlocks) {
-			const qMatch = block.match(/\*\*Q[:：](.*?)\*\*/s);      const _aMatch = block.match(/\*\*A[:：](.*?)\*\*/s);
-			const title = qMatch ? qMatch[1].trim() : block.slice(0, 30);
-			const content = block.trim();
-			if (content.length > 0) chunks.push({ title, content });
-		}
-	} else {
-		// セクション単位（# or ## 見出しごと）
-		const sections = text.split(/\n(?=#+ )/);
-		for (const section of sections) {
-			const titleMatch = section.match(/^#+\s*(.+)/);
-			const title = titleMatch ? titleMatch[1].trim() : section.slice(0, 30);
-			const content = section.trim();
-			if (content.length > 0) {
-				// 1000文字ごとにさらに分割
-				for (let i = 0; i < content.length; i += 1000) {
-					const chunk = content.slice(i, i + 1000);
-					chunks.push({ title, content: chunk });
-				}
+			const qMatch = block.match(/\*\*Q[:：](.*?)\*\*/s);
+			if (qMatch) {
+				chunks.push({ title: qMatch[1].trim(), content: block.trim() });
+			} else {
+				chunks.push(...splitSections(block));
 			}
 		}
+	} else {
+		chunks.push(...splitSections(text));
 	}
-	return chunks;
+
+	// (type, title) で upsert するため、同じタイトルの2つ目以降には「(2)」のように
+	// 番号を付ける（同じタイトルのチャンクが上書きし合わないように）
+	const seen = new Map<string, number>();
+	const unique: Chunk[] = [];
+	for (const { title, content } of chunks) {
+		if (content.length < 10) continue;
+		const count = (seen.get(title) ?? 0) + 1;
+		seen.set(title, count);
+		unique.push({ title: count === 1 ? title : `${title} (${count})`, content });
+	}
+	return unique;
 }
 
 async function main() {
@@ -61,7 +76,6 @@ async function main() {
 		const text = await Deno.readTextFile(doc.path);
 		const chunks = splitMarkdown(text, doc.type);
 		for (const { title, content } of chunks) {
-			if (content.length < 10) continue;
 			const embedding = await embeddings.embedQuery(content);
 			// Supabaseに保存
 			const { error } = await supabase.from("doc_embeddings").upsert(